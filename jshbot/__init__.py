@@ -19,7 +19,15 @@ import jshbot.plugins as plugins
 import jshbot.commands as commands
 import jshbot.configurations as configurations
 import jshbot.data as data
+import jshbot.storage as storage
+import jshbot.journal as journal
+import jshbot.database as database
 import jshbot.utilities as utilities
+import jshbot.scheduler as scheduler
+import jshbot.ratelimit as ratelimit
+import jshbot.menus as menus
+import jshbot.executor as executor
+import jshbot.commandqueue as commandqueue
 
 # Base is imported through the plugins module
 # Other plugins are imported in a similar fashion
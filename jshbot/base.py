@@ -202,7 +202,13 @@ def get_commands(bot):
             SubCommand(
                 Opt('maintenance'),
                 Opt('silent', optional=True, doc='Don\'t display the maintenance error.'),
-                Arg('message', argtype=ArgTypes.MERGED_OPTIONAL))],
+                Arg('message', argtype=ArgTypes.MERGED_OPTIONAL)),
+            SubCommand(
+                Opt('slowqueries'),
+                Arg('number', argtype=ArgTypes.OPTIONAL, convert=int, default=10,
+                    check=lambda b, m, v, *a: 1 <= v <= 50,
+                    check_error='Must be between 1 and 50 inclusive.'),
+                doc='Lists the slowest database statements by their maximum time.')],
         shortcuts=[
             Shortcut(
                 'reload', 'reload {arguments}',
@@ -221,6 +227,7 @@ def get_commands(bot):
             SubCommand(Opt('logs'), doc='Uploads logs to the debug channel.'),
             SubCommand(Opt('toggle'), doc='Toggles the debug mode.'),
             SubCommand(Opt('resetlocals'), doc='Resets the debug local variables.'),
+            SubCommand(Opt('stats'), doc='Shows internal statistics.'),
             SubCommand(
                 Arg('python', argtype=ArgTypes.MERGED),
                 doc='Evaluates or executes the given code.')],
@@ -998,9 +1005,115 @@ async def botowner_wrapper(bot, context):
             await bot.change_presence(activity=game, status=discord.Status.dnd)
             response.content = "Maintenance mode enabled{}.".format(' (silent)' if silent else '')
 
+    elif subcommand.index == 11:  # Slow queries
+        if not bot.db_log:
+            raise CBException("Query timing is not available.")
+        slowest = bot.db_log.get_slowest(arguments[0])
+        if not slowest:
+            raise CBException("No queries have been made yet.")
+        entries = []
+        for shape, calls, average, maximum, slow in slowest:
+            entries.append('{:.1f} ms max, {:.1f} ms average, {} calls ({} slow)\n{}'.format(
+                maximum, average, calls, slow, shape))
+        text = '\n\n'.join(entries)
+        if len(text) > 1900:
+            await utilities.send_text_as_file(message.channel, text, 'slowqueries')
+            response.content = "Slowest statements:"
+        else:
+            response.content = "Slowest statements:\n```\n{}```".format(text)
+
     return response
 
 
+def _get_stats(bot):
+    """Collects internal statistics for the debug stats command."""
+    locations, subtrees, marks = bot.data_changed.get_stats()
+    lines = [
+        'Data:',
+        '  Changed locations: {}'.format(locations),
+        '  Changed subtrees: {}'.format(subtrees),
+        '  Changes marked since boot: {}'.format(marks),
+        '  Subtrees serialized/reused by saves: {}/{}'.format(
+            bot.data_writer.serialized, bot.data_writer.reused),
+        '  Locations loaded: {}/{} ({:.2f} MB)'.format(
+            len(bot.data.loaded), len(bot.data), bot.data.total / 1024 / 1024),
+        '  Loads/evictions: {}/{}'.format(bot.data.loads, bot.data.evictions)]
+    if bot.journal:
+        lines.append('  Journal size: {} bytes'.format(bot.journal.size))
+    limiter = bot.spam_limiter.get_stats()
+    lines += [
+        'Command rate limiter:',
+        '  Users tracked: {tracked}'.format(**limiter),
+        '  Commands limited: {limited}'.format(**limiter)]
+    queue = bot.command_queue.get_stats()
+    lines += [
+        'Command queue:',
+        '  Capacity in use: {in_use}/{capacity}'.format(**queue),
+        '  Waiting: {waiting} ({guilds_waiting} servers)'.format(**queue),
+        '  Completed: {completed} ({queued} queued, {rejected} rejected)'.format(**queue),
+        '  Queue time: {average_wait:.2f} ms average, {max_wait:.2f} ms max'.format(**queue)]
+    lines += [
+        'Plugin events:',
+        '  Listener calls: {}'.format(sum(bot.event_counts.values()))]
+    lines += ['  {}: {}'.format(*it) for it in bot.event_counts.most_common(5)]
+    for plugin, lane in bot.event_executor.get_stats().items():
+        lines.append(
+            '  {}: {queued} queued (peak {peak}), {running} running, '
+            '{calls} calls, {dropped} dropped'.format(plugin, **lane))
+    menu_stats = bot.menu_router.get_stats()
+    lines += [
+        'Interactive menus:',
+        '  Open menus: {open}'.format(**menu_stats),
+        '  Reactions routed: {routed}'.format(**menu_stats)]
+    schedule = bot.scheduler.get_stats()
+    lines += [
+        'Scheduler:',
+        '  Entries in memory: {pending} (loaded up to {horizon})'.format(**schedule),
+        '  Fired: {fired} in {batches} batches'.format(**schedule),
+        '  Caught up on startup: {caught_up}'.format(**schedule)]
+    if schedule['shards']:
+        lines.append('  Shards owned: {owned}/{shards} ({nodes} processes)'.format(**schedule))
+    if bot.db_pool:
+        pool = bot.db_pool.get_stats()
+        lines += [
+            'Database pool:',
+            '  Connections in use: {in_use}/{size} ({queued} queued)'.format(**pool),
+            '  Queries run: {runs} ({saturated} while saturated)'.format(**pool),
+            '  Wait time: {average_wait:.2f} ms average, {max_wait:.2f} ms max'.format(**pool)]
+    catalog = bot.db_catalog
+    lines += [
+        'Schema catalog:',
+        '  Relations/types: {}/{}'.format(len(catalog.relations), len(catalog.types)),
+        '  Loads: {}{}'.format(catalog.loads, ' (stale)' if catalog.stale else '')]
+    statements = bot.db_statements.get_stats()
+    built = [it.cache_info() for it in (
+        data._select_query, data._insert_query, data._update_query, data._delete_query)]
+    lines += [
+        'Database queries:',
+        '  Statements prepared/executed: {prepares}/{executes}'.format(**statements),
+        '  Query text cache hits/misses: {}/{}'.format(
+            sum(it.hits for it in built), sum(it.misses for it in built))]
+    if bot.db_log:
+        timing = bot.db_log.get_stats()
+        lines += [
+            'Database timing:',
+            '  Queries/slow queries: {queries}/{slow}'.format(**timing)]
+        for title, histograms in (('table', timing['tables']), ('plugin', timing['plugins'])):
+            for name, histogram in sorted(histograms.items()):
+                lines.append('  {} {}: {} calls, p50 < {} ms, p99 < {} ms'.format(
+                    title.capitalize(), name, sum(histogram),
+                    bot.db_log.get_percentile(histogram, 0.5),
+                    bot.db_log.get_percentile(histogram, 0.99)))
+    if bot.db_cache:
+        cache = bot.db_cache.get_stats()
+        lines += [
+            'Database result cache:',
+            '  Entries: {} ({:.2f} MB)'.format(cache['entries'], cache['size'] / 1024 / 1024),
+            '  Hits/misses: {hits}/{misses}'.format(**cache),
+            '  Invalidated/evicted: {invalidations}/{evictions}'.format(**cache)]
+    return '\n'.join(lines)
+
+
 async def debug_wrapper(bot, context):
     message, _, subcommand, options, arguments, _, cleaned_content = context[:7]
     response, message_type, extra = ('', MessageTypes.NORMAL, None)
@@ -1059,7 +1172,15 @@ async def debug_wrapper(bot, context):
         _setup_debug_environment(bot)
         response = "Debug environment local dictionary reset."
 
-    elif subcommand.index == 6:  # Repl thingy
+    elif subcommand.index == 6:  # Internal statistics
+        text = _get_stats(bot)
+        if len(text) > 1900:
+            await utilities.send_text_as_file(message.channel, text, 'stats')
+            response = "Internal statistics:"
+        else:
+            response = '```\n{}```'.format(text)
+
+    elif subcommand.index == 7:  # Repl thingy
         global_dictionary['bot'] = bot
         global_dictionary['message'] = message
         global_dictionary['author'] = message.author
@@ -1371,13 +1492,13 @@ async def handle_active_message(bot, context, response):
             plugins_to_reload = list(bot.plugins.keys())
             plugins_to_reload.remove('core')
 
-        data.save_data(bot)  # Safety save
+        await data.save_data_async(bot)  # Safety save
         logger.info("Reloading plugins and commands...")
 
         for plugin_name in plugins_to_reload:
             plugins.load_plugin(bot, plugin_name)
         # TODO: Resetting volatile data can screw up other plugins
-        bot.volatile_data = {'global_users': {}, 'global_plugins': {}}
+        data.reset_data(bot, volatile=True)
         data.check_all(bot)
 
         for plugin_name in plugins_to_reload:
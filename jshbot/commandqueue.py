@@ -0,0 +1,106 @@
+"""Fair scheduling for command execution.
+
+Commands run within a global capacity. Each command uses up its cost (see
+the cost keyword argument of commands.Command and SubCommand), so expensive
+commands leave less room for others. Once the bot is at capacity, commands
+wait in a queue for their guild. Guilds take turns as capacity frees up, so a
+busy guild can't starve the others. Each guild's queue has a limit, past
+which new commands are rejected.
+"""
+import asyncio
+import time
+
+from collections import OrderedDict, deque
+
+from jshbot.exceptions import ConfiguredBotException
+
+CBException = ConfiguredBotException('Command queue')
+
+
+class CommandQueue():
+    def __init__(self, capacity=8, queue_size=10):
+        """Runs commands within the given capacity.
+
+        Keyword arguments:
+        capacity -- The total cost of the commands that can run at once.
+        queue_size -- How many commands each guild can have waiting.
+        """
+        self.capacity = max(capacity, 1)
+        self.queue_size = queue_size
+        self.in_use = 0
+        self.queues = OrderedDict()  # guild ID: deque of (cost, future), in turn order
+        self.waiting = 0
+        self.completed = 0
+        self.queued = 0
+        self.rejected = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def _grant(self):
+        """Starts waiting commands while there is capacity, one guild at a time."""
+        while self.queues:
+            guild_id, queue = next(iter(self.queues.items()))
+            cost, future = queue[0]
+            if not future.done():  # Otherwise cancelled
+                if self.in_use + cost > self.capacity:
+                    break  # Expensive commands are not skipped over
+                self.in_use += cost
+                future.set_result(None)
+            queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self.queues.move_to_end(guild_id)
+            else:
+                del self.queues[guild_id]
+
+    async def run(self, guild_id, cost, function, *args):
+        """Awaits function(*args) once there is capacity for the cost.
+
+        Raises a bot exception if the guild already has too many commands waiting.
+        """
+        cost = min(max(cost, 1), self.capacity)
+        if not self.queues and self.in_use + cost <= self.capacity:
+            self.in_use += cost
+        else:
+            queue = self.queues.get(guild_id)
+            if queue is None:
+                queue = self.queues[guild_id] = deque()
+            elif len(queue) >= self.queue_size:
+                self.rejected += 1
+                raise CBException(
+                    "Too many commands are waiting to run here. Please try again later.",
+                    autodelete=10)
+            future = asyncio.get_event_loop().create_future()
+            queue.append((cost, future))
+            self.waiting += 1
+            start = time.perf_counter()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():  # Granted, but not run
+                    self.in_use -= cost
+                    self._grant()
+                raise
+            wait = time.perf_counter() - start
+            self.queued += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        try:
+            return await function(*args)
+        finally:
+            self.in_use -= cost
+            self.completed += 1
+            self._grant()
+
+    def get_stats(self):
+        return {
+            'capacity': self.capacity,
+            'in_use': self.in_use,
+            'waiting': self.waiting,
+            'guilds_waiting': len(self.queues),
+            'completed': self.completed,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'average_wait': (self.total_wait / self.queued * 1000) if self.queued else 0,
+            'max_wait': self.max_wait * 1000
+        }
@@ -173,7 +173,7 @@ class SubCommand():
     def __init__(
             self, *optargs, doc=None, confidence_threshold=None,
             function=None, elevated_level=None, allow_direct=None,
-            strict_syntax=None, no_selfbot=None, pre_check=None, id=None):
+            strict_syntax=None, no_selfbot=None, pre_check=None, cost=None, id=None):
         """
         Arguments:
         optargs -- Composed of a sequence of Opt and Arg objects.
@@ -203,6 +203,7 @@ class SubCommand():
         self.strict_syntax = strict_syntax
         self.no_selfbot = no_selfbot
         self.pre_check = pre_check
+        self.cost = cost
         self.help_embed_fields = []
         self.short_help_embed_fields = []
         self.keywords = []
@@ -307,7 +308,7 @@ class Command():
     def __init__(
             self, base, subcommands=[], description='', other='',
             category='miscellaneous', shortcuts=[], function=None, hidden=False, elevated_level=0,
-            allow_direct=True, strict_syntax=False, no_selfbot=False, pre_check=None):
+            allow_direct=True, strict_syntax=False, no_selfbot=False, pre_check=None, cost=1):
         """
         Arguments:
         base -- The base command name. Acts as a secondary invoker of sorts.
@@ -325,6 +326,8 @@ class Command():
         strict_syntax -- Parameter order is strictly maintained.
         no_selfbot -- Disallows the command to be used in selfbot mode.
         pre_check -- An async function called with (bot, context) params before the execution.
+        cost -- How much of the command queue capacity the command uses while it runs.
+            Expensive commands (like ones that download or render) should cost more.
         """
         self.base = base.lower().strip()
         if not subcommands:
@@ -341,6 +344,7 @@ class Command():
         self.strict_syntax = strict_syntax
         self.no_selfbot = no_selfbot
         self.pre_check = pre_check
+        self.cost = cost
         self.help_embed_fields = []
         self.plugin = None  # Assigned later on
 
@@ -351,7 +355,7 @@ class Command():
         #   replace subcommand properties with configured values
         replacements = [
             'function', 'elevated_level', 'allow_direct',
-            'strict_syntax', 'no_selfbot', 'pre_check']
+            'strict_syntax', 'no_selfbot', 'pre_check', 'cost']
         self.help_lines = []
         self.clean_help_lines = []
         self.keywords = []
@@ -1,6 +1,7 @@
 import asyncio
 import traceback
 import logging
+import math
 import random
 import shutil
 import time
@@ -11,13 +12,12 @@ import discord
 import yaml
 
 from logging.handlers import RotatingFileHandler
-from concurrent.futures import FIRST_COMPLETED
 from collections import namedtuple, deque, OrderedDict
 from discord.abc import PrivateChannel
 
 from jshbot import (
-    plugins, commands, parser, data, utilities,
-    base, logger, core_version, core_date)
+    plugins, commands, parser, data, utilities, storage, journal, scheduler, ratelimit,
+    menus, executor, commandqueue, base, logger, core_version, core_date)
 from jshbot.exceptions import BotException, ConfiguredBotException, ErrorTypes
 from jshbot.commands import Response, MessageTypes, Elevation
 
@@ -60,16 +60,25 @@ def get_new_bot(client_type, path, debug, docker_mode):
             super().__init__(intents=_intents)
 
             data.check_folders(self)
+            self.data_writer = data.create_writer(self)
+            self.save_task = None
+            self.save_pending = None
+            if config.get('data_journal', True):
+                self.journal = journal.Journal(path + '/data/journal/')
+            else:
+                self.journal = None
 
             logger.debug("Connecting to database...")
             self.db_templates = {}
+            self.db_partitions = {}
             self.db_connection = None
+            self.db_pool = None
             data.db_connect(self)
 
             logger.debug("Loading plugins...")
-            self.data = {'global_users': {}, 'global_plugins': {}}
-            self.volatile_data = {'global_users': {}, 'global_plugins': {}}
-            self.data_changed = []
+            data.reset_data(self)
+            data.reset_data(self, volatile=True)
+            self.data_changed = storage.DirtyTracker()
             self.tables_changed = []
             self.dump_exclusions = []
             self.plugins = OrderedDict()
@@ -79,9 +88,17 @@ def get_new_bot(client_type, path, debug, docker_mode):
             plugins.add_plugins(self)
 
             self.edit_dictionary = {}
-            self.spam_dictionary = {}
+            self.edit_expiry = OrderedDict()  # message ID: deadline (in expiry order)
+            self.edit_added = asyncio.Event()
+            self.menu_router = menus.MenuRouter()
+            self.command_queue = commandqueue.CommandQueue(
+                config.get('command_concurrency', 8), config.get('command_queue_size', 10))
+            self.event_executor = executor.EventExecutor(
+                config.get('event_concurrency', 16), config.get('event_queue_size', 1000),
+                config.get('event_overflow', 'shed'))
             self.spam_limit = config['command_limit']
             self.spam_timeout = config['command_limit_timeout']
+            self.spam_limiter = ratelimit.RateLimiter(self.spam_limit, self.spam_timeout)
             self.use_verbose_output = config['use_verbose_output']
             self.exception_messages = config['exception_messages']
             self.command_invokers = config['command_invokers']
@@ -90,7 +107,11 @@ def get_new_bot(client_type, path, debug, docker_mode):
             self.edit_timeout = config['edit_timeout']
             self.selfbot = config['selfbot_mode']
             self.owners = config['owners']
-            self.schedule_timer = None
+            self.scheduler = scheduler.Scheduler(
+                self, config.get('schedule_lookahead', 3600),
+                config.get('schedule_catch_up_concurrency', 8),
+                config.get('schedule_catch_up_interval', 1),
+                config.get('schedule_shards', 0), config.get('schedule_poll_interval', 5))
             self.response_deque = deque(maxlen=50)
             self.error_deque = deque(maxlen=50)
             self.maintenance_message = ''
@@ -220,8 +241,14 @@ def get_new_bot(client_type, path, debug, docker_mode):
             return context
 
         async def _get_response(self, context):
-            """Takes a context and builds a response."""
-            response = await commands.execute(self, context)
+            """Takes a context and builds a response, waiting in the command queue if needed."""
+            if context.elevation == Elevation.BOT_OWNERS:  # Never queued
+                response = await commands.execute(self, context)
+            else:
+                guild_id = context.guild.id if context.guild else None
+                cost = context.subcommand.cost if context.subcommand else 1
+                response = await self.command_queue.run(
+                    guild_id, cost, commands.execute, self, context)
             if response is None:
                 response = Response()
             elif self.selfbot and response.content:
@@ -301,7 +328,6 @@ def get_new_bot(client_type, path, debug, docker_mode):
             # Check that user is not spamming
             author_id = message.author.id
             direct = isinstance(message.channel, PrivateChannel)
-            spam_value = self.spam_dictionary.get(author_id, 0)
             if elevation > Elevation.ALL or direct:  # Moderators ignore custom limit
                 spam_limit = self.spam_limit
             else:
@@ -309,14 +335,14 @@ def get_new_bot(client_type, path, debug, docker_mode):
                     self.spam_limit, data.get(
                         self, 'core', 'spam_limit',
                         guild_id=message.guild.id, default=self.spam_limit))
-            if spam_value >= spam_limit:
-                if spam_value == spam_limit:
-                    self.spam_dictionary[author_id] = spam_limit + 1
+            wait = self.spam_limiter.hit(author_id, spam_limit)
+            if wait:
+                if self.spam_limiter.warn(author_id):
                     plugins.broadcast_event(self, 'bot_on_user_ratelimit', message.author)
                     await message.channel.send(content=(
                         "{0}, you appear to be issuing/editing "
                         "commands too quickly. Please wait {1} seconds.".format(
-                            message.author.mention, self.spam_timeout)))
+                            message.author.mention, math.ceil(wait))))
                 return
 
             context = None
@@ -356,12 +382,6 @@ def get_new_bot(client_type, path, debug, docker_mode):
                 message_reference = await self.respond(
                     message, context, response, replacement_message=replacement_message)
 
-            # Incremement the spam dictionary entry
-            if author_id in self.spam_dictionary:
-                self.spam_dictionary[author_id] += 1
-            else:
-                self.spam_dictionary[author_id] = 1
-
             self.last_response = message_reference
             self.last_context = context
 
@@ -406,23 +426,12 @@ def get_new_bot(client_type, path, debug, docker_mode):
             # Change behavior based on message type
             if response.message_type is MessageTypes.NORMAL and message_reference:
 
-                # Edited commands are handled in base.py
-                wait_time = self.edit_timeout
-                if wait_time:
+                # Edited commands are handled in base.py, and expired in edit_expiry_loop
+                if self.edit_timeout:
                     self.edit_dictionary[message.id] = message_reference
-                    await asyncio.sleep(wait_time)
-                    if message.id in self.edit_dictionary:
-                        del self.edit_dictionary[message.id]
-
-                        # Check for bot error - remove footer notification
-                        if message_reference.embeds:
-                            embed = message_reference.embeds[0]
-                            if embed.footer.text and embed.footer.text.startswith('\u200b' * 3):
-                                embed.set_footer()
-                                try:
-                                    await message_reference.edit(embed=embed)
-                                except:
-                                    pass
+                    self.edit_expiry.pop(message.id, None)
+                    self.edit_expiry[message.id] = time.monotonic() + self.edit_timeout
+                    self.edit_added.set()
 
             elif response.message_type is MessageTypes.REPLACE:
                 try:
@@ -463,6 +472,7 @@ def get_new_bot(client_type, path, debug, docker_mode):
                 else:
                     permissions = None
 
+                menu = None
                 try:
                     buttons = response.extra['buttons']
                     kwargs = response.extra.get('kwargs', {})
@@ -472,29 +482,36 @@ def get_new_bot(client_type, path, debug, docker_mode):
                         events = [('raw_' + it) for it in events]
                     if 'timeout' not in kwargs:
                         kwargs['timeout'] = 300
-                    if 'check' not in kwargs:
+                    if 'check' not in kwargs:  # Only events for this message are routed
                         if use_raw:
                             kwargs['check'] = (
-                                lambda p: (
-                                    p.message_id == message_reference.id and not
-                                    (p.member.bot if p.member else False)))
+                                lambda p: not (p.member.bot if p.member else False))
                         else:
-                            kwargs['check'] = (
-                                lambda r, u: r.message.id == message_reference.id and not u.bot)
+                            kwargs['check'] = lambda r, u: not u.bot
                     level = context.subcommand.elevated_level if context.subcommand else None
                     level = response.extra.get('elevation', level or Elevation.ALL)
-                    for button in buttons:
-                        await message_reference.add_reaction(button)
+
+                    # Read reaction additions (or removals if they can't be removed)
+                    # The menu is opened first so that reactions added before it is ready
+                    #   come from the gateway instead of fetching the message again
+                    if permissions.manage_messages:
+                        events = events[:1]
+                    menu = self.menu_router.open(
+                        message_reference.id, events, kwargs['timeout'], kwargs['check'])
+
+                    # Requests are sent in order within the same rate limit bucket
+                    await asyncio.gather(*(message_reference.add_reaction(it) for it in buttons))
 
                     # Ensure reactions are valid
-                    channel = message_reference.channel
-                    reaction_check = await channel.fetch_message(message_reference.id)
-                    for reaction in reaction_check.reactions:
-                        if not reaction.me or reaction.count > 1:
-                            async for user in reaction.users():
-                                if user != self.user and permissions.manage_messages:
-                                    asyncio.ensure_future(
-                                        message_reference.remove_reaction(reaction, user))
+                    for result in menu.drain():
+                        if use_raw:
+                            user = discord.Object(id=result.user_id)
+                            reaction = result.emoji
+                        else:
+                            reaction, user = result
+                        if user.id != self.user.id and permissions.manage_messages:
+                            asyncio.ensure_future(
+                                message_reference.remove_reaction(reaction, user))
 
                     # Notify plugin that reactions have been added
                     await response.extra_function(self, context, response, None, False)
@@ -503,9 +520,8 @@ def get_new_bot(client_type, path, debug, docker_mode):
                     process_result = True
                     while process_result is not False:
                         try:
-                            # Read reaction additions (or removals)
+                            result = await menu.read()
                             if permissions.manage_messages:  # Can remove reactions
-                                result = await self.wait_for(events[0], **kwargs)
                                 if use_raw:
                                     if result.user_id != self.user.id:
                                         asyncio.ensure_future(
@@ -520,14 +536,6 @@ def get_new_bot(client_type, path, debug, docker_mode):
                                             message_reference.remove_reaction(*result))
                                     else:
                                         continue
-                            else:  # Cannot remove reactions
-                                add_task = self.wait_for(events[0], **kwargs)
-                                remove_task = self.wait_for(events[1], **kwargs)
-                                done, pending = await asyncio.wait(
-                                    [add_task, remove_task], return_when=FIRST_COMPLETED)
-                                result = next(iter(done)).result()
-                                for future in pending:
-                                    future.cancel()
 
                             # Check reaction validity
                             if use_raw:
@@ -575,6 +583,7 @@ def get_new_bot(client_type, path, debug, docker_mode):
                             # Notify plugin that a valid reaction was read
                             process_result = await response.extra_function(
                                 self, context, response, result, False)
+                    self.menu_router.close(menu)
 
                     # Clear reactions after timeout
                     try:
@@ -590,6 +599,8 @@ def get_new_bot(client_type, path, debug, docker_mode):
                             except:
                                 pass
                 except Exception as e:
+                    if menu:
+                        self.menu_router.close(menu)
                     message_reference = await self.handle_error(
                         e, message, context, response, edit=message_reference)
                     self.last_response = message_reference
@@ -771,8 +782,10 @@ def get_new_bot(client_type, path, debug, docker_mode):
             logger.info("=== {0: ^40} ===".format(self.user.name + ' online'))
 
             if self.fresh_boot:
-                asyncio.ensure_future(self.spam_clear_loop())
                 asyncio.ensure_future(self.save_loop())
+                asyncio.ensure_future(self.edit_expiry_loop())
+                if self.journal:
+                    asyncio.ensure_future(self.journal_loop())
                 asyncio.ensure_future(self.backup_loop())
 
                 if self.selfbot:
@@ -793,6 +806,8 @@ def get_new_bot(client_type, path, debug, docker_mode):
         # Take advantage of dispatch to intercept all events
         def dispatch(self, event, *args, **kwargs):
             super().dispatch(event, *args, **kwargs)
+            if event in menus.REACTION_EVENTS:
+                self.menu_router.route(event, *args)
             plugins.broadcast_event(self, 'on_' + event, *args, **kwargs)
 
         async def selfbot_away_loop(self):
@@ -804,17 +819,44 @@ def get_new_bot(client_type, path, debug, docker_mode):
                 if not isinstance(self_status, discord.Status.idle):
                     await self.change_presence(game=self_game, afk=True)
 
-        async def spam_clear_loop(self):
-            """Loop to clear the spam dictionary periodically."""
-            try:
-                interval = self.configurations['core']['command_limit_timeout']
-                interval = 0 if interval <= 0 else int(interval)
-            except:
-                logger.warn("Command limit timeout not configured.")
-                interval = 0
-            while interval:
-                await asyncio.sleep(interval)
-                self.spam_dictionary.clear()
+        async def _clear_error_footers(self, message_references):
+            """Removes the error footer notification from the given messages."""
+            for message_reference in message_references:
+                embed = message_reference.embeds[0]
+                embed.set_footer()
+                try:
+                    await message_reference.edit(embed=embed)
+                except:
+                    pass
+
+        async def edit_expiry_loop(self):
+            """Stops tracking responses for edits once the edit timeout passes.
+
+            Since every entry has the same timeout, entries expire in the order they were
+            added. Expired entries are handled in batches, at most once per second.
+            """
+            while True:
+                if not self.edit_expiry:
+                    self.edit_added.clear()
+                    await self.edit_added.wait()
+                deadline = next(iter(self.edit_expiry.values()))
+                await asyncio.sleep(max(deadline - time.monotonic(), 1))
+                now = time.monotonic()
+                errors = []
+                while self.edit_expiry:
+                    message_id, deadline = next(iter(self.edit_expiry.items()))
+                    if deadline > now:
+                        break
+                    del self.edit_expiry[message_id]
+                    message_reference = self.edit_dictionary.pop(message_id, None)
+
+                    # Check for bot error - remove footer notification
+                    if message_reference and message_reference.embeds:
+                        embed = message_reference.embeds[0]
+                        if embed.footer.text and embed.footer.text.startswith('\u200b' * 3):
+                            errors.append(message_reference)
+                if errors:
+                    asyncio.ensure_future(self._clear_error_footers(errors))
 
         async def save_loop(self):
             """Runs the loop that periodically saves data (minutes)."""
@@ -826,7 +868,25 @@ def get_new_bot(client_type, path, debug, docker_mode):
                 interval = 0
             while interval:
                 await asyncio.sleep(interval * 60)
-                self.save_data()
+                await self.save_data_async()
+
+        async def journal_loop(self):
+            """Flushes the data journal (seconds), and compacts it if it gets too large."""
+            config = self.configurations['core']
+            interval = max(float(config.get('journal_flush_interval', 1)), 0.1)
+            limit = float(config.get('journal_compaction_size', 16)) * 1024 * 1024
+            threshold = limit
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await data.flush_journal(self)
+                except Exception as e:
+                    logger.error("Failed to flush the journal: %s", e)
+                if self.journal.size > threshold:
+                    logger.debug("Compacting the journal (%s bytes)", self.journal.size)
+                    await self.save_data_async()
+                    # Don't retry immediately if the save couldn't clear the journal
+                    threshold = max(limit, self.journal.size + limit)
 
         async def backup_loop(self):
             """Runs the loop that periodically backs up data (hours)."""
@@ -859,6 +919,14 @@ def get_new_bot(client_type, path, debug, docker_mode):
             data.save_data(self, force=force)
             logger.info("Save complete.")
 
+        async def save_data_async(self, force=False):
+            if force:
+                logger.info("Forcing data save...")
+            else:
+                logger.info("Saving data...")
+            await data.save_data_async(self, force=force)
+            logger.info("Save complete.")
+
         def restart(self):
             logger.info("Attempting to restart the bot...")
             self.save_data(force=True)
@@ -869,6 +937,8 @@ def get_new_bot(client_type, path, debug, docker_mode):
             logger.debug("Writing data on shutdown...")
             if self.fresh_boot is not None:  # Don't write blank data
                 self.save_data(force=True)
+            if self.db_pool:
+                self.db_pool.close()
             logger.info("Closing down!")
             try:
                 self.loop.close()
@@ -1,18 +1,29 @@
+import asyncio
+import copy
 import discord
+import functools
 import os
 import io
 import json
 import psycopg2
 import psycopg2.extras
+import re
+import sys
+import tempfile
+import time
 
 from types import GeneratorType
 
-from jshbot import core, utilities, logger, configurations
+from jshbot import core, utilities, storage, database, logger, configurations
 from jshbot.exceptions import BotException, ConfiguredBotException, ErrorTypes
 from jshbot.commands import Elevation
 
 CBException = ConfiguredBotException('Data')
 
+TABLE_CONSTRAINT = re.compile(
+    r'^((?:CONSTRAINT\s+\S+\s+)?(?:PRIMARY\s+KEY|UNIQUE))\s*\((.*?)\)(.*)$', re.I | re.S)
+COLUMN_CONSTRAINT = re.compile(r'(\s+CONSTRAINT\s+\S+)?\s+(PRIMARY\s+KEY|UNIQUE)\b', re.I)
+
 
 def check_folders(bot):
     """Checks that all of the folders are present at startup."""
@@ -25,14 +36,113 @@ def check_folders(bot):
 
 
 def check_all(bot):
-    """Refreshes the guild listing in the global data dictionary."""
+    """Refreshes the guild listing in the global data dictionary.
+
+    Guild data is not loaded until it is accessed.
+    """
     for guild in bot.guilds:
         guild_id = str(guild.id)
-        if guild_id not in bot.data:  # Mirrored with volatile data
-            bot.data[guild_id] = {}
-            bot.volatile_data[guild_id] = {}
-        elif guild_id not in bot.volatile_data:  # Just volatile data
-            bot.volatile_data[guild_id] = {}
+        bot.data.register(guild_id)
+        bot.volatile_data.register(guild_id)
+
+
+def create_writer(bot):
+    """Creates the data writer for the storage backend set in the core config.
+
+    If the backend is not the files backend and it is empty, any existing data
+    files are copied into it.
+    """
+    directory = bot.path + '/data/'
+    config = bot.configurations['core']
+    backend_name = config.get('data_backend', 'json') or 'json'
+    try:
+        data_format = storage.get_format(config.get('data_format', 'pretty') or 'pretty')
+    except BotException as e:
+        raise CBException(e.error_details, error_type=ErrorTypes.STARTUP)
+    backends = {
+        'json': lambda: storage.FileBackend(directory, data_format),
+        'sqlite': lambda: storage.SQLiteBackend(directory + 'data.sqlite3'),
+        'postgresql': lambda: storage.PostgreSQLBackend(get_connection_parameters(bot))
+    }
+    if backend_name not in backends:
+        raise CBException(
+            "Unknown data backend '{}'.".format(backend_name), error_type=ErrorTypes.STARTUP)
+    try:
+        backend = backends[backend_name]()
+        if backend_name != 'json' and not backend.keys():
+            total = storage.migrate(storage.FileBackend(directory), backend)
+            if total:
+                logger.info("Copied %s data files to the %s backend.", total, backend_name)
+    except Exception as e:
+        raise CBException(
+            "Failed to set up the data backend.", e=e, error_type=ErrorTypes.STARTUP)
+    return storage.SnapshotWriter(backend)
+
+
+def import_backup(bot, directory):
+    """Replaces the data in the storage backend with the data in the unpacked backup.
+
+    The backup can hold data files, or the SQLite database of the sqlite
+    backend. Locations that are not in the backup are removed. Returns the
+    number of locations copied.
+    """
+    destination = bot.data_writer.backend
+    if os.path.isfile(directory + 'data.sqlite3'):
+        source = storage.SQLiteBackend(directory + 'data.sqlite3')
+    else:
+        source = storage.FileBackend(directory)
+    try:
+        restored = set(source.keys())
+        for key in destination.keys():
+            if key not in restored:
+                destination.remove(key)
+        return storage.migrate(source, destination)
+    finally:
+        if isinstance(source, storage.SQLiteBackend):
+            source.connection.close()
+
+
+def reset_data(bot, volatile=False):
+    """Replaces the data (or volatile data) dictionary with an empty one.
+
+    Guilds are registered with check_all, and their data is loaded from the
+    data directory the first time it is accessed. If the data_memory_budget
+    is set, guilds that have not been used recently and have no unsaved
+    changes are unloaded again to stay within the budget.
+    """
+    if volatile:
+        bot.volatile_data = storage.LazyData(lambda key: ({}, 0))
+        bot.volatile_data.update({'global_users': {}, 'global_plugins': {}})
+    else:
+        config = bot.configurations['core']
+        budget = config.get('data_memory_budget', 0) or 0
+        bot.data_writer.forget()  # Files may have been replaced
+        bot.data = storage.LazyData(
+            functools.partial(_load_location, bot), budget=budget * 1024 * 1024,
+            check=functools.partial(_can_evict, bot), evicted=bot.data_writer.forget,
+            pinned=('global_users', 'global_plugins'), idle=config.get('data_unload_idle', 300))
+        bot.data.update({'global_users': {}, 'global_plugins': {}})
+
+
+def _load_location(bot, location_key):
+    """Reads the data for the location from storage. Returns a tuple of (data, size)."""
+    try:
+        value, size, outdated = bot.data_writer.load(location_key)
+        if outdated:  # Rewrite it in the current format with the next save
+            bot.data_changed.mark(location_key)
+        return value, size
+    except KeyError:
+        logger.warn("Data for {} not found.".format(location_key))
+    except ValueError as e:
+        logger.error("Data for %s is corrupted: %s", location_key, e)
+    except Exception as e:
+        raise CBException("Failed to load data for {}.".format(location_key), e=e)
+    return {}, 0
+
+
+def _can_evict(bot, location_key):
+    """Checks that the location can be unloaded without losing anything."""
+    return location_key not in bot.data_changed and bot.data_writer.is_written(location_key)
 
 
 def get_location(bot, guild_id, channel_id, user_id, volatile, create=True):
@@ -88,6 +198,29 @@ def get_location(bot, guild_id, channel_id, user_id, volatile, create=True):
     return (current, key)
 
 
+def _get_subpath(guild_id, channel_id, user_id):
+    """Gets the keys that lead from the location key to the data (see get_location)."""
+    if guild_id:
+        return [str(it) for it in (channel_id, user_id) if it]
+    elif user_id:
+        return [str(user_id)]
+    else:
+        return []
+
+
+def _changed(bot, location_key, path, *value):
+    """Marks the location as changed and records the change in the journal.
+
+    The path is set to the value if one is given, otherwise it is deleted.
+    """
+    bot.data_changed.mark(location_key, path[0])
+    if bot.journal:
+        try:
+            bot.journal.record(location_key, path, *value)
+        except Exception as e:  # Not serializable - only the next save will have it
+            logger.warn("Failed to journal a change to %s: %s", location_key, e)
+
+
 def get(bot, plugin_name, key, guild_id=None, channel_id=None, user_id=None,
         default=None, volatile=False, create=False, save=False):
     """Gets the data with the given key.
@@ -103,26 +236,28 @@ def get(bot, plugin_name, key, guild_id=None, channel_id=None, user_id=None,
 
     If save is True, this marks the given location to be saved. Used if the
     internal data structure you are trying to access needs to be modified in
-    a way that these given functions cannot.
+    a way that these given functions cannot. Note that these changes are not
+    journaled, so they are only persisted by the next save.
     """
     current, location_key = get_location(
         bot, guild_id, channel_id, user_id, volatile, create=create)
 
-    if save and not volatile and location_key not in bot.data_changed:
-        bot.data_changed.append(location_key)
+    path = _get_subpath(guild_id, channel_id, user_id) + [plugin_name]
+    if save and not volatile:
+        bot.data_changed.mark(location_key, path[0])
 
     current_plugin = current.get(plugin_name, None)
     if create and current_plugin is None:
         current[plugin_name] = {}
         current_plugin = current[plugin_name]
-        if not volatile and location_key not in bot.data_changed:
-            bot.data_changed.append(location_key)
+        if not volatile:
+            _changed(bot, location_key, path, {})
 
     if key:
         if create and key not in current_plugin:
             current_plugin[key] = default
-            if not volatile and location_key not in bot.data_changed:
-                bot.data_changed.append(location_key)
+            if not volatile:
+                _changed(bot, location_key, path + [key], default)
         if current_plugin is None:
             return default
         else:
@@ -144,15 +279,19 @@ def add(bot, plugin_name, key, value, guild_id=None, channel_id=None,
         current[plugin_name] = {}
     current[plugin_name][key] = value
 
-    if not volatile and location_key not in bot.data_changed:
-        bot.data_changed.append(location_key)
+    if not volatile:
+        path = _get_subpath(guild_id, channel_id, user_id) + [plugin_name, key]
+        _changed(bot, location_key, path, value)
 
 
 def set_save_flag(bot, plugin_name, guild_id=None, channel_id=None, user_id=None):
-    """Flags the given location for unsaved changes."""
+    """Flags the given location for unsaved changes.
+
+    Like get with save=True, the changes are not journaled.
+    """
     _, location_key = get_location(bot, guild_id, channel_id, user_id, False)
-    if location_key not in bot.data_changed:
-        bot.data_changed.append(location_key)
+    path = _get_subpath(guild_id, channel_id, user_id) + [plugin_name]
+    bot.data_changed.mark(location_key, path[0])
 
 
 def remove(bot, plugin_name, key, guild_id=None, channel_id=None,
@@ -176,8 +315,9 @@ def remove(bot, plugin_name, key, guild_id=None, channel_id=None,
         else:
             raise CBException("Key '{}' not found.".format(key))
 
-    if not volatile and location_key not in bot.data_changed:
-        bot.data_changed.append(location_key)
+    if not volatile:
+        path = _get_subpath(guild_id, channel_id, user_id) + [plugin_name]
+        _changed(bot, location_key, path + [key] if key else path)
 
     if key:
         return current[plugin_name].pop(key)
@@ -201,13 +341,14 @@ def list_data_append(
     if key not in current[plugin_name]:  # List doesn't exist
         current[plugin_name][key] = [value]
     else:  # List already exists
-        current = current[plugin_name][key]
-        if not isinstance(current, list):
+        current_list = current[plugin_name][key]
+        if not isinstance(current_list, list):
             raise CBException("Data is not a list.")
-        elif duplicates or value not in current:
-            current.append(value)
-        if not volatile and location_key not in bot.data_changed:
-            bot.data_changed.append(location_key)
+        elif duplicates or value not in current_list:
+            current_list.append(value)
+    if not volatile:
+        path = _get_subpath(guild_id, channel_id, user_id) + [plugin_name, key]
+        _changed(bot, location_key, path, current[plugin_name][key])
 
 
 def list_data_remove(
@@ -238,10 +379,8 @@ def list_data_remove(
         else:
             raise CBException("List is empty.")
 
-    if not volatile and location_key not in bot.data_changed:
-        bot.data_changed.append(location_key)
     if value is None:
-        return current.pop()
+        result = current.pop()
     else:  # Pop value
         if value not in current:
             if safe:
@@ -250,7 +389,11 @@ def list_data_remove(
                 raise CBException("Value '{}' not found in list.".format(value))
         else:
             current.remove(value)
-            return value
+            result = value
+    if not volatile:
+        path = _get_subpath(guild_id, channel_id, user_id) + [plugin_name, key]
+        _changed(bot, location_key, path, current)
+    return result
 
 
 def list_data_toggle(
@@ -267,75 +410,255 @@ def list_data_toggle(
         current[plugin_name] = {}
     if key not in current[plugin_name]:  # List doesn't exist
         current[plugin_name][key] = [value]
-        return True
+        appended = True
     else:  # List already exists
-        current = current[plugin_name][key]
-        if not isinstance(current, list):
+        current_list = current[plugin_name][key]
+        if not isinstance(current_list, list):
             raise CBException("Data is not a list.")
-        appended = value not in current
-        current.append(value) if appended else current.remove(value)
-        return appended
+        appended = value not in current_list
+        current_list.append(value) if appended else current_list.remove(value)
+    if not volatile:
+        path = _get_subpath(guild_id, channel_id, user_id) + [plugin_name, key]
+        _changed(bot, location_key, path, current[plugin_name][key])
+    return appended
+
+
+def _take_snapshot(bot, force):
+    """Copies the data that needs to be saved and clears the changes.
+
+    Returns a tuple of (checkpoint, arguments). The arguments are passed to the
+    data writer, and the checkpoint is passed to _compact once written. The
+    snapshot shares nothing with bot.data, so it can be written on another
+    thread while the data keeps changing. Only the parts of each location that
+    changed are copied unless forced.
+    """
+    checkpoint = bot.journal.checkpoint() if bot.journal else None
+    taken = bot.data_changed.take()
+    try:
+        sequence = bot.data_writer.next_sequence()
+        return _copy_changes(bot, force, checkpoint, sequence, taken)
+    except Exception:
+        bot.data_changed.restore(taken)
+        _abandon(bot, checkpoint)
+        raise
+
+
+def _copy_changes(bot, force, checkpoint, sequence, changes):
+    """Takes the snapshot for _take_snapshot from the changes it took."""
+    if force:  # Guilds that are not loaded are already saved
+        changes = dict.fromkeys(bot.data.loaded_keys())
+    snapshot, failed = {}, []
+    for location_key, keys in changes.items():
+        if location_key not in bot.data:
+            continue
+        location = bot.data[location_key]
+        cached = bot.data_writer.get_reusable(location_key, sequence)
+        if keys is None or cached is None:
+            keys = location
+        else:  # Also copy anything that was never written
+            keys = set(it for it in keys if it in location)
+            keys.update(it for it in location if it not in cached)
+        try:
+            values = {key: copy.deepcopy(location[key]) for key in keys}
+        except Exception as e:
+            logger.error(
+                'Failed to copy data for %s: (%s) %s', location_key, type(e).__name__, e)
+            failed.append(location_key)
+        else:
+            snapshot[location_key] = (list(location), values)
+    _mark_failed(bot, failed)
+    if failed and checkpoint is not None:  # Keep the journal for what wasn't copied
+        bot.journal.complete(checkpoint, False)
+        checkpoint = None
+    keep = set(bot.data) if force else None
+    return checkpoint, (sequence, snapshot, keep)
+
+
+def _mark_failed(bot, failed):
+    """Marks locations that failed to save so that they are tried again."""
+    for key in failed:
+        if key in bot.data:
+            bot.data_changed.mark(key)
+
+
+def _update_sizes(bot, snapshot):
+    """Updates the sizes of the written locations, then unloads data if over budget."""
+    for key in snapshot:
+        size = bot.data_writer.sizes.get(key)
+        if size is not None:
+            bot.data.resize(key, size)
+    bot.data.evict()
+
+
+def _abandon(bot, checkpoint):
+    """Completes the journal checkpoint as failed if a save raised before completing it.
+
+    Otherwise the checkpoint would stay outstanding, and the journal could
+    never be compacted again.
+    """
+    if checkpoint is not None and checkpoint in bot.journal.outstanding:
+        bot.journal.complete(checkpoint, False)
+
+
+def _compact(bot, checkpoint, failed):
+    """Completes the journal checkpoint for a written snapshot.
+
+    Returns the checkpoint to be passed to journal.delete, or None if there is
+    nothing that can be deleted.
+    """
+    if checkpoint is None:
+        return
+    return bot.journal.complete(checkpoint, not failed)
 
 
 def save_data(bot, force=False):
     """Saves all of the current data in the data dictionary.
 
     Does not save volatile_data, though. Backs up data if forced.
+    This writes on the calling thread, so it blocks the event loop until
+    finished. Use save_data_async whenever the loop is running.
     """
+    if bot.journal:  # Make sure nothing is lost if this save fails
+        bot.journal.flush()
+
     if bot.data_changed or force:  # Only save if something changed or forced
-        # Loop through keys
-        directory = bot.path + '/data/'
-
-        if force:  # Save all data
-            for key, value in bot.data.items():
-                with open(directory + key + '.json', 'w') as current_file:
-                    try:
-                        json.dump(value, current_file, indent=4)
-                    except TypeError as e:
-                        logger.error('Failed to save data for %s: (TypeError) %s', key, e)
-            # Check to see if any guild was removed
-            files = os.listdir(directory)
-            for check_file in files:
-                if check_file.endswith('.json') and check_file[:-5] not in bot.data:
-                    logger.debug("Removing file {}".format(check_file))
-                    os.remove(directory + check_file)
-
-        else:  # Save data that has changed
-            for key in bot.data_changed:
-                with open(directory + key + '.json', 'w') as current_file:
-                    json.dump(bot.data[key], current_file, indent=4)
-                logger.debug("Saved {}".format(directory + key + '.json'))
-
-        bot.data_changed = []
+        checkpoint, arguments = _take_snapshot(bot, force)
+        try:
+            failed = bot.data_writer.write(*arguments)
+            _mark_failed(bot, failed)
+            _update_sizes(bot, arguments[1])
+            checkpoint = _compact(bot, checkpoint, failed)
+        except Exception:
+            _mark_failed(bot, arguments[1])
+            _abandon(bot, checkpoint)
+            raise
+        if bot.journal:
+            bot.journal.delete(checkpoint)
 
     if force:
         utilities.make_backup(bot)
 
 
+async def save_data_async(bot, force=False):
+    """Saves data like save_data, but serializes and writes on a worker thread.
+
+    A snapshot of the changed locations is taken on the event loop, so
+    anything changed after this is called will be picked up by the next save.
+
+    Only one save runs at a time. Saves requested while another one is running
+    are coalesced into a single follow-up save (forced if any of the requests
+    were forced), and callers wait until that save finishes.
+    """
+    if bot.save_task and not bot.save_task.done():
+        if bot.save_pending:
+            bot.save_pending[0] = bot.save_pending[0] or force
+        else:
+            bot.save_pending = [force, asyncio.get_event_loop().create_future()]
+        await asyncio.shield(bot.save_pending[1])
+    else:
+        bot.save_task = asyncio.ensure_future(_save_loop(bot, force))
+        await asyncio.shield(bot.save_task)
+
+
+async def _save_loop(bot, force):
+    """Runs the given save, then any save requested while it was running.
+
+    Saves that fail raise in their callers, and the saves after them still run.
+    """
+    error, waiter = None, None
+    try:
+        try:
+            await _save_snapshot(bot, force)
+        except Exception as e:
+            error = e
+        while bot.save_pending:
+            force, waiter = bot.save_pending
+            bot.save_pending = None
+            try:
+                await _save_snapshot(bot, force)
+            except Exception as e:
+                waiter.set_exception(e)
+            else:
+                waiter.set_result(None)
+    except BaseException:  # Cancelled, so nothing else will be saved
+        for it in (waiter, bot.save_pending and bot.save_pending[1]):
+            if it and not it.done():
+                it.cancel()
+        bot.save_pending = None
+        raise
+    if error:
+        raise error
+
+
+async def _save_snapshot(bot, force):
+    if bot.data_changed or force:
+        checkpoint, arguments = _take_snapshot(bot, force)
+        try:
+            failed = await utilities.future(bot.data_writer.write, *arguments)
+            _mark_failed(bot, failed)
+            _update_sizes(bot, arguments[1])
+            checkpoint = _compact(bot, checkpoint, failed)
+        except BaseException:  # Includes cancellation
+            _mark_failed(bot, arguments[1])
+            _abandon(bot, checkpoint)
+            raise
+        if checkpoint is not None:
+            try:
+                await utilities.future(bot.journal.delete, checkpoint)
+            except Exception as e:
+                logger.error("Failed to compact the journal: %s", e)
+    if force:
+        try:
+            await utilities.future(utilities.make_backup, bot)
+        except Exception as e:
+            logger.error("Failed to make a backup: %s", e)
+
+
+async def flush_journal(bot):
+    """Writes buffered journal records to disk on a worker thread."""
+    entries = bot.journal.take()
+    if entries:
+        await utilities.future(bot.journal.write, entries)
+
+
+def _replay_journal(bot):
+    """Applies journaled changes that were not saved before the last shutdown."""
+    replayed = 0
+    for record in bot.journal.replay():
+        location_key, path = record[0], record[1]
+        if location_key not in bot.data:  # Guild is no longer available
+            continue
+        current = bot.data[location_key]
+        for key in path[:-1]:
+            if not isinstance(current.get(key), dict):
+                current[key] = {}
+            current = current[key]
+        if len(record) > 2:
+            current[path[-1]] = record[2]
+        else:
+            current.pop(path[-1], None)
+        bot.data_changed.mark(location_key, path[0])
+        replayed += 1
+    if replayed:
+        logger.info("Replayed %s journaled changes.", replayed)
+
+
 def load_data(bot):
-    """Loads the data from the data directory."""
+    """Loads the data from the storage backend.
+
+    Only global data is read here. Guild data is read on first access.
+    """
 
     logger.debug("Loading data...")
-    directory = bot.path + '/data/'
+    reset_data(bot)
     for guild in bot.guilds:
-        guild_id = str(guild.id)
-        try:
-            with open(directory + guild_id + '.json', 'r') as guild_file:
-                bot.data[guild_id] = json.load(guild_file)
-        except:
-            logger.warn("Data for guild {} not found.".format(guild_id))
-            bot.data[guild_id] = {}
+        bot.data.register(str(guild.id))
 
-    try:
-        with open(directory + 'global_plugins.json', 'r') as plugins_file:
-            bot.data['global_plugins'] = json.load(plugins_file)
-    except:
-        logger.warn("Global data for plugins not found.")
-    try:
-        with open(directory + 'global_users.json', 'r') as users_file:
-            bot.data['global_users'] = json.load(users_file)
-    except:
-        logger.warn("Global data for users not found.")
+    for key in ('global_plugins', 'global_users'):
+        bot.data[key] = _load_location(bot, key)[0]
+
+    if bot.journal:
+        _replay_journal(bot)
     logger.debug("Data loaded.")
 
 
@@ -366,13 +689,13 @@ def clean_data(bot):
     plugins = list(bot.plugins.keys())
     guilds = list(str(guild.id) for guild in bot.guilds)
 
-    data_items = list(bot.data.items())
-    for key, value in data_items:
+    for key in list(bot.data):
 
         if key[0].isdigit():  # Server
             if key not in guilds:  # Server cannot be found, remove it
                 logger.warn("Removing guild {}".format(key))
                 del bot.data[key]
+                continue
             else:  # Recursively clean the data
                 guild = bot.get_guild(key)
                 channels = [str(channel.id) for channel in guild.channels]
@@ -382,6 +705,8 @@ def clean_data(bot):
         else:  # Global plugins or users
             clean_location(bot, plugins, [], [], bot.data[key])
 
+        bot.data_changed.mark(key)  # Keeps it loaded until saved
+
     save_data(bot, force=True)
 
 
@@ -884,50 +1209,762 @@ def add_guild(bot, guild):
     if guild_id not in bot.data:
         bot.data[guild_id] = {}
         bot.volatile_data[guild_id] = {}
-        bot.data_changed.append(guild_id)
+        bot.data_changed.mark(guild_id)
+
+
+def get_connection_parameters(bot):
+    """Gets the parameters used to connect to the database."""
+    connection_parameters = bot.configurations['core']['database_credentials']
+    if not connection_parameters:  # Default for docker-compose setup
+        connection_parameters = "dbname='postgres' user='postgres' host='db'"
+    return connection_parameters
 
 
 def db_connect(bot):
-    """Attempts to connect to the database."""
+    """Attempts to connect to the database, and sets up the connection pool."""
+    config = bot.configurations['core']
+    bot.db_statements = database.StatementCache(config.get('database_prepare_threshold', 5))
+    bot.db_catalog = database.SchemaCatalog()
+    bot.db_log = database.QueryLog(
+        config.get('database_slow_query_threshold', 100),
+        config.get('database_explain_slow_queries', False))
+    cache_size = config.get('database_cache_size', 16)
+    bot.db_cache = database.ResultCache(cache_size * 1024 * 1024) if cache_size else None
     try:
-        connection_parameters = bot.configurations['core']['database_credentials']
-        if not connection_parameters:  # Default for docker-compose setup
-            connection_parameters = "dbname='postgres' user='postgres' host='db'"
-        bot.db_connection = psycopg2.connect(connection_parameters)
+        bot.db_connection = psycopg2.connect(
+            get_connection_parameters(bot), connection_factory=database.PreparingConnection)
+        bot.db_catalog.load(bot.db_connection)
+        pool_size = config.get('database_pool_size', 4) or 4
+        bot.db_pool = database.ConnectionPool(get_connection_parameters(bot), pool_size)
     except Exception as e:
         raise CBException("Failed to connect to the database.", e=e, error_type=ErrorTypes.STARTUP)
 
 
+def _start_query(bot):
+    """Gets the start time and calling plugin of a database call for _end_query."""
+    if not bot.db_log:
+        return
+    plugin, frame = 'core', sys._getframe(2)
+    while frame:
+        name = frame.f_globals.get('__name__')
+        if name in bot.plugins:
+            plugin = name
+            break
+        frame = frame.f_back
+    return time.perf_counter(), plugin
+
+
+def _end_query(bot, timing, query, input_args, connection=None, explain=True):
+    """Records how long the query took since _start_query.
+
+    Slow queries are explained on the pool while the event loop is running, so
+    that it is not blocked. Otherwise, they are explained on the given connection.
+    """
+    if not timing:
+        return
+    start, plugin = timing
+    slow = bot.db_log.record(query, input_args, time.perf_counter() - start, plugin)
+    if not (slow and explain):
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:  # Like on startup, before the loop runs
+        if connection:
+            bot.db_log.explain_query(connection, query, input_args)
+        return
+    if bot.db_pool:
+        asyncio.ensure_future(bot.db_pool.run(bot.db_log.explain_query, query, input_args))
+
+
+def _copy_query(full_table, query):
+    """Gets the query text recorded for a copy."""
+    return "COPY ({}) TO STDOUT".format(query) if query else "COPY {} TO STDOUT".format(full_table)
+
+
+def _copy(connection, full_table, query, input_args, include_headers, cursor_kwargs, target=None):
+    """Copies a table or query result on the connection into the target file.
+
+    If no target is given, a string file is used. Returns the target, rewound if possible.
+    """
+    if target is None:
+        target = io.StringIO()
+    try:
+        if query:
+            sql = connection.cursor().mogrify(
+                "COPY ({}) TO STDOUT WITH CSV".format(query), input_args).decode()
+        else:
+            sql = "COPY {} TO STDOUT WITH CSV".format(full_table)
+        if include_headers:
+            sql += " HEADER"
+        cursor = connection.cursor(**cursor_kwargs)
+        cursor.copy_expert(sql, target)
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    if target.seekable():
+        target.seek(0)
+    return target
+
+
 # TODO: Test
 def db_copy(
         bot, table='', table_suffix='', query='', input_args=[],
         include_headers=True, safe=False, cursor_kwargs={}, propagate_error=False):
     """Returns the contents of a table as a string in CSV format."""
-    string_file = io.StringIO()
-    if query:
-        cursor = bot.db_connection.cursor()
-        sql = cursor.mogrify("COPY ({}) TO STDOUT WITH CSV".format(query), input_args)
-    else:
-        if table_suffix:
-            table_suffix = '_{}'.format(table_suffix)
-        sql = "COPY {} TO STDOUT WITH CSV".format(table + table_suffix)
-    if include_headers:
-        sql += " HEADER"
+    full_table, query, input_args = _route_copy(bot, table, table_suffix, query, input_args)
+    timing = _start_query(bot)
+    try:
+        return _copy(
+            bot.db_connection, full_table, query, input_args, include_headers, cursor_kwargs)
+    except Exception as e:
+        bot.extra = e
+        if propagate_error:
+            raise e
+        elif safe:
+            return
+        raise CBException("Failed to execute copy.", e=e)
+    finally:
+        _end_query(bot, timing, _copy_query(full_table, query), input_args)
+
+
+async def db_copy_async(
+        bot, table='', table_suffix='', query='', input_args=[],
+        include_headers=True, safe=False, cursor_kwargs={}, propagate_error=False):
+    """Returns the contents of a table as a string in CSV format. See db_copy."""
+    full_table, query, input_args = _route_copy(bot, table, table_suffix, query, input_args)
+    timing = _start_query(bot)
+    try:
+        return await bot.db_pool.run(
+            _copy, full_table, query, input_args, include_headers, cursor_kwargs)
+    except Exception as e:
+        bot.extra = e
+        if propagate_error:
+            raise e
+        elif safe:
+            return
+        raise CBException("Failed to execute copy.", e=e)
+    finally:
+        _end_query(bot, timing, _copy_query(full_table, query), input_args)
+
+
+def _get_copy_file(bot):
+    """Gets a temporary binary file in the temp folder that is deleted once closed."""
+    return tempfile.TemporaryFile(dir='{}/temp'.format(bot.path))
 
+
+def db_copy_to_file(
+        bot, table='', table_suffix='', query='', input_args=[],
+        include_headers=True, safe=False, cursor_kwargs={}, propagate_error=False):
+    """Copies the contents of a table in CSV format into a temporary file.
+
+    Unlike db_copy, the result is never held in memory. Returns the open
+    binary file, which is deleted once it is closed.
+    """
+    full_table, query, input_args = _route_copy(bot, table, table_suffix, query, input_args)
+    target = _get_copy_file(bot)
+    timing = _start_query(bot)
     try:
-        cursor = bot.db_connection.cursor(**cursor_kwargs)
-        cursor.copy_expert(sql, string_file)
+        return _copy(
+            bot.db_connection, full_table, query, input_args,
+            include_headers, cursor_kwargs, target=target)
     except Exception as e:
+        target.close()
         bot.extra = e
-        bot.db_connection.rollback()
         if propagate_error:
             raise e
         elif safe:
             return
         raise CBException("Failed to execute copy.", e=e)
-    bot.db_connection.commit()
-    string_file.seek(0)
-    return string_file
+    finally:
+        _end_query(bot, timing, _copy_query(full_table, query), input_args)
+
+
+async def db_copy_to_file_async(
+        bot, table='', table_suffix='', query='', input_args=[],
+        include_headers=True, safe=False, cursor_kwargs={}, propagate_error=False):
+    """Copies a table into a temporary file on a pooled connection. See db_copy_to_file."""
+    full_table, query, input_args = _route_copy(bot, table, table_suffix, query, input_args)
+    target = _get_copy_file(bot)
+    timing = _start_query(bot)
+    try:
+        return await bot.db_pool.run(
+            _copy, full_table, query, input_args, include_headers, cursor_kwargs, target=target)
+    except Exception as e:
+        target.close()
+        bot.extra = e
+        if propagate_error:
+            raise e
+        elif safe:
+            return
+        raise CBException("Failed to execute copy.", e=e)
+    finally:
+        _end_query(bot, timing, _copy_query(full_table, query), input_args)
+
+
+class _StreamWriter():
+    """A file-like object that passes what is written to an asyncio queue in chunks.
+
+    Writing blocks the calling thread while the queue is full.
+    """
+
+    def __init__(self, loop, queue, chunk_size):
+        self.loop = loop
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.cancelled = False
+
+    def seekable(self):
+        return False
+
+    def _put(self, item):
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+    def write(self, data):
+        if self.cancelled:
+            raise BrokenPipeError("The copy stream was closed.")
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def finish(self, error=None):
+        """Sends the rest of the buffer, followed by the error or None to end the stream."""
+        if self.cancelled:
+            return
+        if self.buffer and not error:
+            self._put(bytes(self.buffer))
+        self._put(error)
+
+
+def _copy_stream(
+        connection, full_table, query, input_args, include_headers, cursor_kwargs, writer):
+    try:
+        _copy(connection, full_table, query, input_args, include_headers, cursor_kwargs, writer)
+    except Exception as e:
+        writer.finish(error=e)
+    else:
+        writer.finish()
+
+
+async def db_copy_stream(
+        bot, table='', table_suffix='', query='', input_args=[],
+        include_headers=True, cursor_kwargs={}, chunk_size=65536, queue_size=16):
+    """Yields the contents of a table in CSV format as chunks of bytes.
+
+    This is an async iterator. The copy runs on a pooled connection and only
+    gets ahead of the consumer by up to queue_size chunks, so memory use is
+    bounded no matter how large the table is. If the stream is not consumed
+    fully, close it (or use contextlib.aclosing) to end the copy promptly.
+
+    Keyword arguments:
+    chunk_size -- Approximate size of each chunk in bytes.
+    queue_size -- Number of chunks that can be waiting to be consumed.
+    """
+    full_table, query, input_args = _route_copy(bot, table, table_suffix, query, input_args)
+    queue = asyncio.Queue(maxsize=queue_size)
+    writer = _StreamWriter(asyncio.get_event_loop(), queue, chunk_size)
+    timing = _start_query(bot)
+    task = asyncio.ensure_future(bot.db_pool.run(
+        _copy_stream, full_table, query, input_args, include_headers, cursor_kwargs, writer))
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            elif isinstance(chunk, Exception):
+                bot.extra = chunk
+                raise CBException("Failed to execute copy.", e=chunk)
+            yield chunk
+    finally:
+        if not task.done():  # Stopped early; unblock the writer so that it can fail
+            writer.cancelled = True
+            while not queue.empty():
+                queue.get_nowait()
+        await task
+        _end_query(bot, timing, _copy_query(full_table, query), input_args)
+
+
+def _execute(connection, query, input_args, cursor_kwargs, statements):
+    """Executes and commits the query on the connection. Rolls back on failure.
+
+    Queries that run often are run as prepared statements (see database.StatementCache).
+    """
+    try:
+        cursor = connection.cursor(**cursor_kwargs)
+        if 'name' in cursor_kwargs:  # Server side cursors can't use EXECUTE
+            cursor.execute(query, input_args)
+        else:
+            statements.execute(connection, cursor, query, input_args)
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return cursor
+
+
+def _mark_table(bot, mark):
+    if mark and bot.db_cache:
+        bot.db_cache.invalidate(mark)
+    if mark and mark not in bot.tables_changed:
+        bot.tables_changed.append(mark)
+
+
+def _get_cache_key(query, input_args, cursor_kwargs, from_arg, table_suffix):
+    """Gets the result cache key and tables for a selection.
+
+    Returns (None, None) if the selection can't be cached.
+    """
+    if 'name' in cursor_kwargs:  # Server side cursors fetch lazily
+        return None, None
+    key = (query, _hashable(input_args), tuple(sorted(cursor_kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None, None
+    if not isinstance(from_arg, (list, tuple)):
+        from_arg = [from_arg]
+    return key, tuple(_get_full_table(it, table_suffix) for it in from_arg)
+
+
+def _get_full_table(table, table_suffix):
+    return table + ('_{}'.format(table_suffix) if table_suffix else '')
+
+
+def _get_partitioning(bot, table, table_suffix=None):
+    """Gets the partitioning of the table, or None if it is not partitioned.
+
+    If a table suffix is given, None is also returned if there is no suffix to route.
+    """
+    partitions = getattr(bot, 'db_partitions', None)
+    if table_suffix == '' or not partitions:
+        return
+    return partitions.get(table)
+
+
+def _partition_where(conditions, where_arg):
+    if where_arg:
+        conditions = conditions + ['({})'.format(where_arg)]
+    return ' AND '.join(conditions)
+
+
+def _partition_condition(table, partitioning, input_args, qualify=False):
+    """Gets the condition that selects the rows of a table suffix.
+
+    The table suffix is a parameter (see _bind_partition), so queries for
+    different suffixes are the same, and can be cached and prepared.
+    """
+    column = '{}.{}'.format(table, partitioning.key) if qualify else partitioning.key
+    placeholder = '%(_table_suffix)s' if isinstance(input_args, dict) else '%s'
+    return '{} = {}'.format(column, placeholder)
+
+
+def _bind_partition(input_args, preceding, table_suffix, count):
+    """Adds the table suffix to the input arguments for each partition condition.
+
+    The conditions start the WHERE clause, so the suffixes go after the
+    arguments of the placeholders in the preceding parts of the query.
+    """
+    if isinstance(input_args, dict):
+        return dict(input_args, _table_suffix=table_suffix)
+    index = sum(it.replace('%%', '').count('%s') for it in preceding)
+    input_args = list(input_args)
+    return input_args[:index] + [table_suffix] * count + input_args[index:]
+
+
+def _route(bot, table, table_suffix, where_arg, input_args, preceding=''):
+    """Routes the table suffix to a partition if the table is partitioned.
+
+    Returns a tuple of (table_suffix, where_arg, input_args) to use instead.
+
+    Keyword arguments:
+    preceding -- The part of the query before the WHERE clause that can have
+        placeholders (like the SET clause of an update).
+    """
+    partitioning = _get_partitioning(bot, table, table_suffix)
+    if not partitioning:
+        return table_suffix, where_arg, input_args
+    condition = _partition_condition(table, partitioning, input_args)
+    input_args = _bind_partition(input_args, [preceding], table_suffix, 1)
+    return '', _partition_where([condition], where_arg), input_args
+
+
+def _route_select(bot, select_arg, from_arg, table_suffix, where_arg, input_args):
+    """Routes the table suffix for each partitioned table in from_arg.
+
+    Returns a tuple of (from_arg, table_suffix, where_arg, input_args) to use instead.
+    """
+    if not table_suffix or not getattr(bot, 'db_partitions', None):
+        return from_arg, table_suffix, where_arg, input_args
+    tables = list(from_arg) if isinstance(from_arg, (list, tuple)) else [from_arg]
+    partitioned = [it for it in tables if it in bot.db_partitions]
+    if not partitioned:
+        return from_arg, table_suffix, where_arg, input_args
+    conditions = [
+        _partition_condition(it, bot.db_partitions[it], input_args, qualify=len(tables) > 1)
+        for it in partitioned]
+    preceding = list(select_arg) if isinstance(select_arg, (list, tuple)) else [select_arg]
+    input_args = _bind_partition(input_args, preceding, table_suffix, len(conditions))
+    tables = [it if it in partitioned else _get_full_table(it, table_suffix) for it in tables]
+    return tables, '', _partition_where(conditions, where_arg), input_args
+
+
+def _route_insert(bot, table, table_suffix, specifiers, input_args):
+    """Adds the partition key to the inserted values if the table is partitioned.
+
+    Returns a tuple of (table_suffix, specifiers, input_args) to use instead.
+    """
+    partitioning = _get_partitioning(bot, table, table_suffix)
+    if not partitioning:
+        return table_suffix, specifiers, input_args
+    if specifiers:
+        if not isinstance(specifiers, (list, tuple)):
+            specifiers = [specifiers]
+        specifiers = list(specifiers) + [partitioning.key]
+    return '', specifiers, list(input_args) + [table_suffix]
+
+
+def _route_rows(bot, table, table_suffix, specifiers, rows):
+    """Adds the partition key to each row if the table is partitioned.
+
+    Returns a tuple of (rows, table_suffix, specifiers) to use instead.
+    """
+    if not _get_partitioning(bot, table, table_suffix):
+        return rows, table_suffix, specifiers
+    _, specifiers, _ = _route_insert(bot, table, table_suffix, specifiers, [])
+    return (list(row) + [table_suffix] for row in rows), '', specifiers
+
+
+def _route_copy(bot, table, table_suffix, query, input_args):
+    """Gets the full table and query to copy from.
+
+    Returns a tuple of (full_table, query, input_args).
+    """
+    partitioning = _get_partitioning(bot, table, table_suffix)
+    if not partitioning or query:
+        return _get_full_table(table, table_suffix), query, input_args
+    condition = _partition_condition(table, partitioning, [])
+    return table, "SELECT * FROM {} WHERE {}".format(table, condition), [table_suffix]
+
+
+def _get_partition_name(table, partitioning, value):
+    """Gets the name of the partition that holds the key value (range partitioning only)."""
+    start = int(value) // partitioning.interval * partitioning.interval
+    return '{}__{}'.format(table, start), start
+
+
+def _split_specification(specification):
+    """Splits a table specification at the commas that separate columns and constraints."""
+    parts, depth, quote, start = [], 0, None, 0
+    for index, character in enumerate(specification):
+        if quote:
+            if character == quote:
+                quote = None
+        elif character in ('"', "'"):
+            quote = character
+        elif character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif character == ',' and depth == 0:
+            parts.append(specification[start:index].strip())
+            start = index + 1
+    parts.append(specification[start:].strip())
+    return [it for it in parts if it]
+
+
+def _partition_specification(specification, key):
+    """Adds the partition key to the primary key and unique constraints of the specification.
+
+    PostgreSQL rejects these constraints on a partitioned table unless they
+    include the partition key. Column constraints are turned into table
+    constraints so that the key can be added to them.
+    """
+    parts, constraints = [], []
+    for part in _split_specification(specification):
+        match = TABLE_CONSTRAINT.match(part)
+        if match:
+            columns = [it.strip() for it in match.group(2).split(',')]
+            if key not in columns:
+                columns.append(key)
+            parts.append('{} ({}){}'.format(match.group(1), ', '.join(columns), match.group(3)))
+            continue
+        masked = re.sub(r"'[^']*'|\"[^\"]*\"", lambda it: ' ' * len(it.group()), part)
+        for match in reversed(list(COLUMN_CONSTRAINT.finditer(masked))):
+            name, kind = match.group(1) or '', ' '.join(match.group(2).upper().split())
+            replacement = ' NOT NULL' if kind == 'PRIMARY KEY' else ''
+            part = part[:match.start()] + replacement + part[match.end():]
+            columns = [part.split()[0]]
+            if key not in columns:
+                columns.append(key)
+            name = (name.strip() + ' ') if name else ''
+            constraints.append('{}{} ({})'.format(name, kind, ', '.join(columns)))
+        parts.append(part)
+    return ', '.join(parts + constraints)
+
+
+def _partition_queries(bot, table, table_suffix, template, specification):
+    """Gets the queries that create a partitioned table and its partitions.
+
+    The parent table gets the partition key as its last column. Hash
+    partitions are all created with the table. Range partitions are only
+    created for the table suffix (if given). Only relations missing from
+    the catalog are created, and the table itself is only created if a
+    template or specification is given.
+    """
+    partitioning = bot.db_partitions[table]
+    queries = []
+    if not bot.db_catalog.has_relation(table):
+        if not (template or specification):  # Can't create partitions without the table
+            return queries
+        specification = _partition_specification(
+            specification or bot.db_templates.get(template, ''), partitioning.key)
+        columns = _create_table_query(bot, table, '', None, specification)[:-1]
+        queries.append("{}, {} {} NOT NULL) PARTITION BY {} ({})".format(
+            columns, partitioning.key, partitioning.key_type,
+            partitioning.method.upper(), partitioning.key))
+    if partitioning.method == 'hash':
+        for remainder in range(partitioning.partitions):
+            name = '{}__{}'.format(table, remainder)
+            if not bot.db_catalog.has_relation(name):
+                queries.append(
+                    "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                    "FOR VALUES WITH (MODULUS {}, REMAINDER {})".format(
+                        name, table, partitioning.partitions, remainder))
+    elif table_suffix not in (None, ''):
+        name, start = _get_partition_name(table, partitioning, table_suffix)
+        if not bot.db_catalog.has_relation(name):
+            queries.append(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                "FOR VALUES FROM ({}) TO ({})".format(
+                    name, table, start, start + partitioning.interval))
+    return queries
+
+
+def _get_legacy_tables(bot, table, suffixes=None):
+    """Gets a list of (suffixed table, suffix) tuples that should be moved into partitions.
+
+    If no suffixes are given, tables with numeric suffixes are found if the
+    partition key is an integer. Other suffixes can't be told apart from
+    unrelated tables that share the prefix, so they must be given explicitly.
+    """
+    prefix = table.lower() + '_'
+    tables = bot.db_catalog.get_tables()
+    if suffixes is not None:
+        names = ((_get_full_table(table, it), str(it)) for it in suffixes)
+        return [(name, suffix) for name, suffix in names if name.lower() in tables]
+    elif 'int' not in bot.db_partitions[table].key_type.lower():
+        return []
+    legacy_tables = []
+    for name in sorted(tables):
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and suffix.isascii() and suffix.isdigit():
+            legacy_tables.append((name, suffix))
+    return legacy_tables
+
+
+def _migrate_partitions(connection, table, key, legacy_tables):
+    """Moves the rows of each suffixed table into the partitioned table, then drops it.
+
+    Each table is moved in its own transaction. Returns the list of tables moved.
+    """
+    moved = []
+    for name, suffix in legacy_tables:
+        try:
+            cursor = connection.cursor()
+            cursor.execute("INSERT INTO {} SELECT *, %s FROM {}".format(table, name), [suffix])
+            cursor.execute("DROP TABLE {}".format(name))
+        except Exception as e:
+            connection.rollback()
+            logger.warn("Failed to move table %s into partitioned table %s: %s", name, table, e)
+            continue
+        connection.commit()
+        moved.append(name)
+    return moved
+
+
+def db_add_partitioning(
+        bot, table, key='guild_id', key_type='bigint', method='hash', partitions=16,
+        interval=None):
+    """Makes the table a partitioned table.
+
+    Instead of creating a separate table for each table suffix, one table is
+    created, and table suffixes given to db_* functions are transparently
+    routed to its partitions by storing the suffix as the key column. This
+    should be called before the table is created (like in an on_load function).
+
+    Keyword arguments:
+    key -- Name of the partition key column, which is added to the end of the table.
+    key_type -- Type of the partition key column.
+    method -- Either 'hash' to split rows across a fixed number of partitions (like
+        for guild IDs), or 'range' for partitions that each cover an interval of
+        key values (like for timestamps).
+    partitions -- Number of partitions for hash partitioning.
+    interval -- Size of each partition for range partitioning.
+    """
+    if method not in ('hash', 'range'):
+        raise CBException("Invalid partitioning method: {}".format(method))
+    if method == 'range' and not interval:
+        raise CBException("Range partitioning requires an interval.")
+    bot.db_partitions[table] = database.Partitioning(
+        key, key_type, method, partitions, interval)
+
+
+def db_migrate_partitions(bot, table, suffixes=None):
+    """Moves existing suffixed tables (like table_123) into the partitioned table.
+
+    This is done automatically when the partitioned table is created.
+    Returns the list of tables moved.
+
+    Keyword arguments:
+    suffixes -- The table suffixes to move. By default, only tables with
+        numeric suffixes are moved, and only if the partition key is an integer.
+    """
+    partitioning = bot.db_partitions[table]
+    legacy_tables = _get_legacy_tables(bot, table, suffixes)
+    for name, suffix in legacy_tables:
+        for query in _partition_queries(bot, table, suffix, None, ''):
+            db_execute(bot, query)
+    moved = _migrate_partitions(bot.db_connection, table, partitioning.key, legacy_tables)
+    return _migrated(bot, table, moved)
+
+
+async def db_migrate_partitions_async(bot, table, suffixes=None):
+    """Moves existing suffixed tables on a pooled connection. See db_migrate_partitions."""
+    partitioning = bot.db_partitions[table]
+    legacy_tables = _get_legacy_tables(bot, table, suffixes)
+    for name, suffix in legacy_tables:
+        for query in _partition_queries(bot, table, suffix, None, ''):
+            await db_execute_async(bot, query)
+    moved = await bot.db_pool.run(
+        _migrate_partitions, table, partitioning.key, legacy_tables)
+    return _migrated(bot, table, moved)
+
+
+def _migrated(bot, table, moved):
+    for name in moved:
+        logger.info("Moved table %s into partitioned table %s.", name, table)
+        bot.db_catalog.apply("DROP TABLE {}".format(name))
+        _mark_table(bot, name)
+    if moved:
+        _mark_table(bot, table)
+        bot.db_statements.invalidate()
+    return moved
+
+
+def _get_cursor_kwargs(cursor_kwargs, use_tuple_cursor):
+    if use_tuple_cursor:
+        return dict(cursor_kwargs, cursor_factory=psycopg2.extras.NamedTupleCursor)
+    return cursor_kwargs
+
+
+def _hashable(argument):
+    """Converts lists to tuples so that query arguments can be cached."""
+    return tuple(argument) if isinstance(argument, list) else argument
+
+
+# Query text for the same arguments is only built once
+@functools.lru_cache(maxsize=1024)
+def _select_query(select_arg, from_arg, where_arg, additional, limit, table_suffix):
+    """Builds the query for db_select. Returns None if no table was given.
+
+    List arguments must be passed through _hashable.
+    """
+    if not isinstance(select_arg, tuple):
+        select_arg = [select_arg]
+    query = "SELECT {} ".format(', '.join(select_arg))
+    if not from_arg:
+        return
+    elif not isinstance(from_arg, tuple):
+        from_arg = [from_arg]
+    if table_suffix:
+        table_suffix = '_{}'.format(table_suffix)
+    query += "FROM {}".format(', '.join((it + table_suffix) for it in from_arg))
+    if where_arg:
+        query += ' WHERE {}'.format(where_arg)
+    if additional:
+        query += ' {}'.format(additional)
+    if limit:
+        query += ' LIMIT {}'.format(limit)
+    return query
+
+
+@functools.lru_cache(maxsize=1024)
+def _insert_query(table, specifiers, count, table_suffix, return_inserted):
+    """Builds the query for db_insert with the given number of values.
+
+    List arguments must be passed through _hashable.
+    """
+    if not isinstance(specifiers, tuple):
+        specifiers = [specifiers]
+    query = "INSERT INTO {} ".format(_get_full_table(table, table_suffix))
+    if specifiers:
+        query += "({}) ".format(', '.join(specifiers))
+    query += "VALUES ({})".format(', '.join('%s' for it in range(count)))
+    if return_inserted:
+        query += " RETURNING *"
+    return query
+
+
+def _is_missing_relation(error):
+    stripped = str(error).split('\n')[0]
+    return stripped.startswith('relation') and stripped.endswith('does not exist')
+
+
+@functools.lru_cache(maxsize=1024)
+def _update_query(table, table_suffix, set_arg, where_arg, return_updated):
+    query = "UPDATE {} SET {}".format(_get_full_table(table, table_suffix), set_arg)
+    if where_arg:
+        query += " WHERE {}".format(where_arg)
+    if return_updated:
+        query += " RETURNING *"
+    return query
+
+
+@functools.lru_cache(maxsize=1024)
+def _delete_query(table, table_suffix, where_arg):
+    return "DELETE FROM {} WHERE {}".format(_get_full_table(table, table_suffix), where_arg)
+
+
+def _create_table_query(bot, table, table_suffix, template, specification):
+    if specification:
+        table_specification = specification
+    else:
+        table_specification = bot.db_templates.get(template)
+        if not table_specification:
+            raise CBException("No template specified for table creation.")
+    full_table = _get_full_table(table, table_suffix)
+    return "CREATE TABLE IF NOT EXISTS {} ({})".format(full_table, table_specification)
+
+
+def _drop_table_query(table, table_suffix, safe):
+    if_exists = 'IF EXISTS ' if safe else ''
+    return "DROP TABLE {}{}".format(if_exists, _get_full_table(table, table_suffix))
+
+
+def _exists_name(bot, entry, table, table_suffix):
+    """Gets the name checked by db_exists.
+
+    For partitioned tables, this is the partition that the table suffix is routed to.
+    """
+    if not any((entry, table, table_suffix)):
+        raise CBException("No DB check name provided.")
+    partitioning = _get_partitioning(bot, table, table_suffix) if table else None
+    if partitioning:
+        if partitioning.method == 'range':
+            return _get_partition_name(table, partitioning, table_suffix)[0]
+        return table
+    elif table:
+        entry = _get_full_table(table, table_suffix)
+    return entry
+
+
+def _exists_result(bot, name, check_type):
+    if check_type:
+        return bot.db_catalog.has_type(name)
+    return bot.db_catalog.has_relation(name)
 
 
 def db_execute(
@@ -935,6 +1972,9 @@ def db_execute(
         propagate_error=False, mark=None):
     """Executes the given query.
 
+    This blocks the event loop until the query finishes. Use db_execute_async
+    whenever possible.
+
     Keyword arguments:
     input_args -- Arguments passed into the query via old pyformat. (sanitized)
     safe -- Will not throw an exception (overwritten by propagate_error).
@@ -942,26 +1982,52 @@ def db_execute(
     propagate_error -- Allows any exception thrown by the executed query to propagate up.
     mark -- Marks the table as dirty.
     """
+    timing = _start_query(bot)
     try:
-        cursor = bot.db_connection.cursor(**cursor_kwargs)
-        cursor.execute(query, input_args)
+        cursor = _execute(
+            bot.db_connection, query, input_args, cursor_kwargs, bot.db_statements)
     except Exception as e:
-        bot.db_connection.rollback()
         if propagate_error:
             raise e
         elif safe:
             return
         raise CBException("Failed to execute query.", e=e)
-    bot.db_connection.commit()
-    if mark and mark not in bot.tables_changed:
-        bot.tables_changed.append(mark)
+    finally:
+        _end_query(bot, timing, query, input_args, connection=bot.db_connection)
+    bot.db_catalog.apply(query)
+    _mark_table(bot, mark)
+    return cursor
+
+
+async def db_execute_async(
+        bot, query, input_args=[], safe=False, cursor_kwargs={},
+        propagate_error=False, mark=None):
+    """Executes the given query on a pooled connection. See db_execute.
+
+    The query runs on a database worker thread, so the event loop is not
+    blocked. The returned cursor has already fetched its results.
+    """
+    timing = _start_query(bot)
+    try:
+        cursor = await bot.db_pool.run(
+            _execute, query, input_args, cursor_kwargs, bot.db_statements)
+    except Exception as e:
+        if propagate_error:
+            raise e
+        elif safe:
+            return
+        raise CBException("Failed to execute query.", e=e)
+    finally:
+        _end_query(bot, timing, query, input_args)
+    bot.db_catalog.apply(query)
+    _mark_table(bot, mark)
     return cursor
 
 
 def db_select(
         bot, select_arg=['*'], from_arg=[], where_arg='', additional='', limit=None,
         input_args=[], table_suffix='', safe=True, propagate_error=False, cursor_kwargs={},
-        use_tuple_cursor=True):
+        use_tuple_cursor=True, cache=False):
     """Makes a selection query. Returns a cursor.
 
     Keyword arguments:
@@ -974,32 +2040,75 @@ def db_select(
     table_suffix -- Suffix appended to each entry in from_arg. (unsanitized)
     safe -- Will not throw an exception.
     use_tuple_cursor -- Changes the cursor factory to the namedtuple variant (sugar).
+    cache -- Caches the results until a table in from_arg is marked as changed. Tables
+        read any other way (like with a JOIN in additional) are not tracked.
     """
-    if use_tuple_cursor:
-        cursor_kwargs.update({'cursor_factory': psycopg2.extras.NamedTupleCursor})
-    if not isinstance(select_arg, (list, tuple)):
-        select_arg = [select_arg]
-    query = "SELECT {} ".format(', '.join(select_arg))
-    if not from_arg:
+    cursor_kwargs = _get_cursor_kwargs(cursor_kwargs, use_tuple_cursor)
+    from_arg, table_suffix, where_arg, input_args = _route_select(
+        bot, select_arg, from_arg, table_suffix, where_arg, input_args)
+    query = _select_query(
+        _hashable(select_arg), _hashable(from_arg), where_arg, additional, limit, table_suffix)
+    if query is None:
         if safe:
             return
         raise CBException("No table specified for selection.")
-    elif not isinstance(from_arg, (list, tuple)):
-        from_arg = [from_arg]
-    if table_suffix:
-        table_suffix = '_{}'.format(table_suffix)
-    query += "FROM {}".format(', '.join((it + table_suffix) for it in from_arg))
-    if where_arg:
-        query += ' WHERE {}'.format(where_arg)
-    if additional:
-        query += ' {}'.format(additional)
-    if limit:
-        query += ' LIMIT {}'.format(limit)
+
+    key = None
+    if cache and bot.db_cache:
+        key, tables = _get_cache_key(query, input_args, cursor_kwargs, from_arg, table_suffix)
+    if key is not None:
+        cursor = bot.db_cache.get(key)
+        if cursor:
+            return cursor
+        versions = bot.db_cache.get_versions(tables)
 
     try:
-        return db_execute(
+        cursor = db_execute(
             bot, query, input_args=input_args, cursor_kwargs=cursor_kwargs,
             propagate_error=propagate_error, safe=safe)
+        if key is None or cursor is None:
+            return cursor
+        return bot.db_cache.put(key, tables, versions, cursor)
+    except Exception as e:
+        if safe:
+            return
+        elif propagate_error or isinstance(e, BotException):
+            raise e
+        else:
+            raise CBException("Database selection failed.", e=e)
+
+
+async def db_select_async(
+        bot, select_arg=['*'], from_arg=[], where_arg='', additional='', limit=None,
+        input_args=[], table_suffix='', safe=True, propagate_error=False, cursor_kwargs={},
+        use_tuple_cursor=True, cache=False):
+    """Makes a selection query on a pooled connection. See db_select."""
+    cursor_kwargs = _get_cursor_kwargs(cursor_kwargs, use_tuple_cursor)
+    from_arg, table_suffix, where_arg, input_args = _route_select(
+        bot, select_arg, from_arg, table_suffix, where_arg, input_args)
+    query = _select_query(
+        _hashable(select_arg), _hashable(from_arg), where_arg, additional, limit, table_suffix)
+    if query is None:
+        if safe:
+            return
+        raise CBException("No table specified for selection.")
+
+    key = None
+    if cache and bot.db_cache:
+        key, tables = _get_cache_key(query, input_args, cursor_kwargs, from_arg, table_suffix)
+    if key is not None:
+        cursor = bot.db_cache.get(key)
+        if cursor:
+            return cursor
+        versions = bot.db_cache.get_versions(tables)
+
+    try:
+        cursor = await db_execute_async(
+            bot, query, input_args=input_args, cursor_kwargs=cursor_kwargs,
+            propagate_error=propagate_error, safe=safe)
+        if key is None or cursor is None:
+            return cursor
+        return bot.db_cache.put(key, tables, versions, cursor)
     except Exception as e:
         if safe:
             return
@@ -1019,36 +2128,78 @@ def db_insert(
     input_args -- Arguments passed into the query via old pyformat. (sanitized)
     table_suffix -- Suffix appended to each entry in from_arg. (unsanitized)
     safe -- Will not throw an exception.
-    create -- If the table does not exist, it will be created.
+    create -- Template used to create the table if it does not exist.
     mark -- Marks the table as dirty.
     return_inserted -- Returns the value inserted using RETURNING *.
     use_tuple_cursor -- Changes the cursor factory to the namedtuple variant (sugar).
     """
-    if use_tuple_cursor:
-        cursor_kwargs.update({'cursor_factory': psycopg2.extras.NamedTupleCursor})
-    if not isinstance(specifiers, (list, tuple)):
-        specifiers = [specifiers]
+    cursor_kwargs = _get_cursor_kwargs(cursor_kwargs, use_tuple_cursor)
     if not isinstance(input_args, (list, tuple)):
         input_args = [input_args]
-    full_table = table + ('_{}'.format(table_suffix) if table_suffix else '')
-    query = "INSERT INTO {} ".format(full_table)
-    if specifiers:
-        query += "({}) ".format(', '.join(specifiers))
-    query += "VALUES ({})".format(', '.join('%s' for it in range(len(input_args))))
-    if return_inserted:
-        query += " RETURNING *"
+    routed_suffix, specifiers, input_args = _route_insert(
+        bot, table, table_suffix, specifiers, input_args)
+    query = _insert_query(
+        table, _hashable(specifiers), len(input_args), routed_suffix, return_inserted)
+    if create and not db_exists(bot, table=table, table_suffix=table_suffix):
+        db_create_table(
+            bot, table, table_suffix=table_suffix, template=create, mark=mark)
+    elif routed_suffix != table_suffix:  # Range partitions are created as needed
+        for partition_query in _partition_queries(bot, table, table_suffix, None, ''):
+            db_execute(bot, partition_query)
     try:
         return db_execute(
-            bot, query, input_args=input_args, propagate_error=True, cursor_kwargs=cursor_kwargs)
+            bot, query, input_args=input_args, propagate_error=True, cursor_kwargs=cursor_kwargs,
+            mark=_get_full_table(table, routed_suffix) if mark else None)
     except psycopg2.ProgrammingError as e:
-        stripped = str(e).split('\n')[0]
-        if stripped.startswith('relation') and stripped.endswith('does not exist'):
+        if _is_missing_relation(e):
+            bot.db_catalog.invalidate()  # Dropped outside of the bot
             if create:
                 db_create_table(
                     bot, table, table_suffix=table_suffix, template=create, mark=mark)
                 return db_insert(
                     bot, table, specifiers=specifiers, input_args=input_args,
-                    table_suffix=table_suffix, safe=safe, create=False, mark=mark,
+                    table_suffix=routed_suffix, safe=safe, create=False, mark=mark,
+                    return_inserted=return_inserted, cursor_kwargs=cursor_kwargs,
+                    use_tuple_cursor=use_tuple_cursor)
+        if safe:
+            return
+        raise CBException("Invalid insert syntax.", e=e)
+    except BotException as e:
+        raise e
+    except Exception as e:
+        raise CBException("Failed to insert into database.", e=e)
+
+
+async def db_insert_async(
+        bot, table, specifiers=[], input_args=[], table_suffix='', safe=True, create=False,
+        mark=True, return_inserted=True, cursor_kwargs={}, use_tuple_cursor=True):
+    """Inserts the input arguments into the given table on a pooled connection. See db_insert."""
+    cursor_kwargs = _get_cursor_kwargs(cursor_kwargs, use_tuple_cursor)
+    if not isinstance(input_args, (list, tuple)):
+        input_args = [input_args]
+    routed_suffix, specifiers, input_args = _route_insert(
+        bot, table, table_suffix, specifiers, input_args)
+    query = _insert_query(
+        table, _hashable(specifiers), len(input_args), routed_suffix, return_inserted)
+    if create and not await db_exists_async(bot, table=table, table_suffix=table_suffix):
+        await db_create_table_async(
+            bot, table, table_suffix=table_suffix, template=create, mark=mark)
+    elif routed_suffix != table_suffix:  # Range partitions are created as needed
+        for partition_query in _partition_queries(bot, table, table_suffix, None, ''):
+            await db_execute_async(bot, partition_query)
+    try:
+        return await db_execute_async(
+            bot, query, input_args=input_args, propagate_error=True, cursor_kwargs=cursor_kwargs,
+            mark=_get_full_table(table, routed_suffix) if mark else None)
+    except psycopg2.ProgrammingError as e:
+        if _is_missing_relation(e):
+            bot.db_catalog.invalidate()  # Dropped outside of the bot
+            if create:
+                await db_create_table_async(
+                    bot, table, table_suffix=table_suffix, template=create, mark=mark)
+                return await db_insert_async(
+                    bot, table, specifiers=specifiers, input_args=input_args,
+                    table_suffix=routed_suffix, safe=safe, create=False, mark=mark,
                     return_inserted=return_inserted, cursor_kwargs=cursor_kwargs,
                     use_tuple_cursor=use_tuple_cursor)
         if safe:
@@ -1060,23 +2211,221 @@ def db_insert(
         raise CBException("Failed to insert into database.", e=e)
 
 
+_copy_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_text(value):
+    """Formats the value for COPY FROM in the text format."""
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return str(value).translate(_copy_escapes)
+
+
+class _CopyReader():
+    """A file-like object that reads rows as COPY text data, a batch at a time."""
+
+    def __init__(self, rows, batch_size):
+        self.rows = iter(rows)
+        self.batch_size = batch_size
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            lines = []
+            for row in self.rows:
+                lines.append('\t'.join(_copy_text(it) for it in row) + '\n')
+                if len(lines) >= self.batch_size:
+                    break
+            if not lines:
+                break
+            self.count += len(lines)
+            self.buffer += ''.join(lines)
+        if size < 0:
+            size = len(self.buffer)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    readline = read
+
+
+def _count_rows(rows, counter):
+    for row in rows:
+        counter[0] += 1
+        yield row
+
+
+def _insert_many_query(full_table, specifiers, method):
+    """Gets the query for db_insert_many. Rows are given in place of %s."""
+    columns = ' ({})'.format(', '.join(specifiers)) if specifiers else ''
+    if method == 'copy':
+        return 'COPY {}{} FROM STDIN'.format(full_table, columns)
+    return 'INSERT INTO {}{} VALUES %s'.format(full_table, columns)
+
+
+def _insert_many(connection, full_table, specifiers, batch_size, method, create_query, rows):
+    """Inserts all rows on the connection in a single transaction.
+
+    Returns the number of rows inserted.
+    """
+    query = _insert_many_query(full_table, specifiers, method)
+    try:
+        cursor = connection.cursor()
+        if create_query:
+            cursor.execute(create_query)
+        if method == 'copy':
+            reader = _CopyReader(rows, batch_size)
+            cursor.copy_expert(query, reader, size=65536)
+            count = reader.count
+        else:
+            counter = [0]
+            psycopg2.extras.execute_values(
+                cursor, query, _count_rows(rows, counter), page_size=batch_size)
+            count = counter[0]
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return count
+
+
+def _insert_many_arguments(bot, table, specifiers, table_suffix, batch_size, method, create):
+    if method not in ('values', 'copy'):
+        raise CBException("Invalid insert method: {}".format(method))
+    if not isinstance(specifiers, (list, tuple)):
+        specifiers = [specifiers]
+    if create:
+        create = _create_table_query(bot, table, table_suffix, create, '')
+    return (_get_full_table(table, table_suffix), specifiers, max(batch_size, 1), method, create)
+
+
+def db_insert_many(
+        bot, table, rows, specifiers=[], table_suffix='', batch_size=1000, method='values',
+        create=False, mark=True, safe=False, propagate_error=False):
+    """Inserts every row in the given iterable into the table in one transaction.
+
+    Rows are consumed as they are sent, so a generator can be given to insert
+    large amounts of data without holding it all in memory. Nothing is
+    inserted if any row fails. Returns the number of rows inserted.
+
+    Keyword arguments:
+    rows -- Iterable of row value sequences. (sanitized)
+    specifiers -- Specifies which column values are given in each row. (unsanitized)
+    table_suffix -- Suffix appended to the table name. (unsanitized)
+    batch_size -- Number of rows sent to the database at a time.
+    method -- Either 'values' for multi-row INSERT statements, or 'copy' for
+        COPY FROM STDIN. COPY is faster, but values are sent as text, so
+        columns like arrays should use 'values'.
+    create -- Template used to create the table if it does not exist.
+    mark -- Marks the table as dirty.
+    safe -- Returns None instead of throwing an exception.
+    """
+    if create and db_exists(bot, table=table, table_suffix=table_suffix):
+        create = False
+    elif create and _get_partitioning(bot, table):
+        db_create_table(bot, table, table_suffix=table_suffix, template=create, mark=mark)
+        create = False
+    elif _get_partitioning(bot, table, table_suffix):
+        for query in _partition_queries(bot, table, table_suffix, None, ''):
+            db_execute(bot, query)
+    rows, table_suffix, specifiers = _route_rows(bot, table, table_suffix, specifiers, rows)
+    arguments = _insert_many_arguments(
+        bot, table, specifiers, table_suffix, batch_size, method, create)
+    timing = _start_query(bot)
+    try:
+        count = _insert_many(bot.db_connection, *arguments, rows)
+    except Exception as e:
+        bot.extra = e
+        if propagate_error:
+            raise e
+        elif safe:
+            return
+        raise CBException("Failed to insert rows into database.", e=e)
+    finally:
+        _end_query(
+            bot, timing, _insert_many_query(*arguments[:2], method), [], explain=False)
+    if arguments[4]:
+        bot.db_catalog.apply(arguments[4])
+    if mark:
+        _mark_table(bot, arguments[0])
+    return count
+
+
+async def db_insert_many_async(
+        bot, table, rows, specifiers=[], table_suffix='', batch_size=1000, method='values',
+        create=False, mark=True, safe=False, propagate_error=False):
+    """Inserts every row in the given iterable on a pooled connection. See db_insert_many.
+
+    The rows are consumed on the pool's worker thread.
+    """
+    if create and await db_exists_async(bot, table=table, table_suffix=table_suffix):
+        create = False
+    elif create and _get_partitioning(bot, table):
+        await db_create_table_async(
+            bot, table, table_suffix=table_suffix, template=create, mark=mark)
+        create = False
+    elif _get_partitioning(bot, table, table_suffix):
+        for query in _partition_queries(bot, table, table_suffix, None, ''):
+            await db_execute_async(bot, query)
+    rows, table_suffix, specifiers = _route_rows(bot, table, table_suffix, specifiers, rows)
+    arguments = _insert_many_arguments(
+        bot, table, specifiers, table_suffix, batch_size, method, create)
+    timing = _start_query(bot)
+    try:
+        count = await bot.db_pool.run(_insert_many, *arguments, rows)
+    except Exception as e:
+        bot.extra = e
+        if propagate_error:
+            raise e
+        elif safe:
+            return
+        raise CBException("Failed to insert rows into database.", e=e)
+    finally:
+        _end_query(
+            bot, timing, _insert_many_query(*arguments[:2], method), [], explain=False)
+    if arguments[4]:
+        bot.db_catalog.apply(arguments[4])
+    if mark:
+        _mark_table(bot, arguments[0])
+    return count
+
+
 def db_update(
         bot, table, table_suffix='', set_arg='', where_arg='',
-        input_args=[], return_updated=True, mark=True):
+        input_args=[], return_updated=True, mark=True, use_tuple_cursor=False):
     """Updates the given table, specified by SET and WHERE if given."""
-    full_table = table + ('_{}'.format(table_suffix) if table_suffix else '')
-    query = "UPDATE {} SET {}".format(full_table, set_arg)
-    if where_arg:
-        query += " WHERE {}".format(where_arg)
-    if return_updated:
-        query += " RETURNING *"
-    return db_execute(bot, query, input_args=input_args, mark=full_table if mark else None)
+    table_suffix, where_arg, input_args = _route(
+        bot, table, table_suffix, where_arg, input_args, set_arg)
+    query = _update_query(table, table_suffix, set_arg, where_arg, return_updated)
+    full_table = _get_full_table(table, table_suffix)
+    return db_execute(
+        bot, query, input_args=input_args, mark=full_table if mark else None,
+        cursor_kwargs=_get_cursor_kwargs({}, use_tuple_cursor))
+
+
+async def db_update_async(
+        bot, table, table_suffix='', set_arg='', where_arg='',
+        input_args=[], return_updated=True, mark=True, use_tuple_cursor=False):
+    """Updates the given table on a pooled connection. See db_update."""
+    table_suffix, where_arg, input_args = _route(
+        bot, table, table_suffix, where_arg, input_args, set_arg)
+    query = _update_query(table, table_suffix, set_arg, where_arg, return_updated)
+    full_table = _get_full_table(table, table_suffix)
+    return await db_execute_async(
+        bot, query, input_args=input_args, mark=full_table if mark else None,
+        cursor_kwargs=_get_cursor_kwargs({}, use_tuple_cursor))
 
 
 def db_delete(bot, table, table_suffix='', where_arg='', input_args=[], safe=True, mark=True):
     """Deletes entries from the given table. Returns the number of entries deleted."""
-    full_table = table + ('_{}'.format(table_suffix) if table_suffix else '')
-    query = "DELETE FROM {} WHERE {}".format(full_table, where_arg)
+    table_suffix, where_arg, input_args = _route(
+        bot, table, table_suffix, where_arg, input_args)
+    query = _delete_query(table, table_suffix, where_arg)
+    full_table = _get_full_table(table, table_suffix)
     try:
         cursor = db_execute(
             bot, query, input_args=input_args, propagate_error=True,
@@ -1091,46 +2440,120 @@ def db_delete(bot, table, table_suffix='', where_arg='', input_args=[], safe=Tru
             raise CBException("Invalid delete syntax", e=e)
 
 
+async def db_delete_async(
+        bot, table, table_suffix='', where_arg='', input_args=[], safe=True, mark=True):
+    """Deletes entries from the given table on a pooled connection. See db_delete."""
+    table_suffix, where_arg, input_args = _route(
+        bot, table, table_suffix, where_arg, input_args)
+    query = _delete_query(table, table_suffix, where_arg)
+    full_table = _get_full_table(table, table_suffix)
+    try:
+        cursor = await db_execute_async(
+            bot, query, input_args=input_args, propagate_error=True,
+            mark=full_table if mark else None)
+        return cursor.rowcount
+    except Exception as e:
+        if safe:
+            return
+        elif isinstance(e, BotException):
+            raise e
+        else:
+            raise CBException("Invalid delete syntax", e=e)
+
+
 def db_create_table(
         bot, table, table_suffix='', template=None, specification='', mark=True):
-    """Creates the table with the given template."""
-    if specification:
-        table_specification = specification
-    else:
-        table_specification = bot.db_templates.get(template)
-        if not table_specification:
-            raise CBException("No template specified for table creation.")
-    full_table = table + ('_{}'.format(table_suffix) if table_suffix else '')
-    query = "CREATE TABLE IF NOT EXISTS {} ({})".format(full_table, table_specification)
+    """Creates the table with the given template.
+
+    Partitioned tables (see db_add_partitioning) are created along with their
+    partitions, and existing suffixed tables are moved into them (see
+    db_migrate_partitions).
+    """
+    if _get_partitioning(bot, table):
+        queries = _partition_queries(bot, table, table_suffix, template, specification)
+        created = not bot.db_catalog.has_relation(table)
+        for query in queries:
+            db_execute(bot, query, mark=table if mark else None)
+        if created and queries:
+            db_migrate_partitions(bot, table)
+        return
+    query = _create_table_query(bot, table, table_suffix, template, specification)
+    full_table = _get_full_table(table, table_suffix)
+    bot.db_statements.invalidate()
     db_execute(bot, query, mark=full_table if mark else None)
 
 
+async def db_create_table_async(
+        bot, table, table_suffix='', template=None, specification='', mark=True):
+    """Creates the table with the given template on a pooled connection. See db_create_table."""
+    if _get_partitioning(bot, table):
+        queries = _partition_queries(bot, table, table_suffix, template, specification)
+        created = not bot.db_catalog.has_relation(table)
+        for query in queries:
+            await db_execute_async(bot, query, mark=table if mark else None)
+        if created and queries:
+            await db_migrate_partitions_async(bot, table)
+        return
+    query = _create_table_query(bot, table, table_suffix, template, specification)
+    full_table = _get_full_table(table, table_suffix)
+    bot.db_statements.invalidate()
+    await db_execute_async(bot, query, mark=full_table if mark else None)
+
+
 def db_drop_table(bot, table, table_suffix='', safe=False):
-    """Drops the specified table."""
-    full_table = table + ('_{}'.format(table_suffix) if table_suffix else '')
-    if_exists = 'IF EXISTS ' if safe else ''
-    query = "DROP TABLE {}{}".format(if_exists, full_table)
+    """Drops the specified table.
+
+    For partitioned tables, the rows of the table suffix are deleted instead.
+    """
+    if _get_partitioning(bot, table, table_suffix):
+        db_delete(bot, table, table_suffix=table_suffix, safe=safe)
+        return
+    query = _drop_table_query(table, table_suffix, safe)
+    bot.db_statements.invalidate()
     try:
-        db_execute(bot, query, propagate_error=True)
+        db_execute(
+            bot, query, propagate_error=True, mark=_get_full_table(table, table_suffix))
+    except Exception as e:
+        if not safe:
+            raise e
+
+
+async def db_drop_table_async(bot, table, table_suffix='', safe=False):
+    """Drops the specified table on a pooled connection. See db_drop_table."""
+    if _get_partitioning(bot, table, table_suffix):
+        await db_delete_async(bot, table, table_suffix=table_suffix, safe=safe)
+        return
+    query = _drop_table_query(table, table_suffix, safe)
+    bot.db_statements.invalidate()
+    try:
+        await db_execute_async(
+            bot, query, propagate_error=True, mark=_get_full_table(table, table_suffix))
     except Exception as e:
         if not safe:
             raise e
 
 
 def db_exists(bot, entry='', table='', table_suffix='', check_type=False):
-    """Checks the existence of the given entry (table, index, etc.)"""
-    if check_type:
-        query = "SELECT True FROM pg_type WHERE typname=%s"
-    else:
-        query = "SELECT to_regclass(%s)"
-    if not any((entry, table, table_suffix)):
-        raise CBException("No DB check name provided.")
-    if table:
-        entry = table + ('_{}'.format(table_suffix) if table_suffix else '')
-    result = db_execute(bot, query, input_args=[entry]).fetchone()
-    if isinstance(result, tuple):
-        result = result[0]
-    return result
+    """Checks the existence of the given entry (table, index, etc.)
+
+    This is answered by the schema catalog, which only needs to query the
+    database after a schema change that it could not follow.
+    """
+    name = _exists_name(bot, entry, table, table_suffix)
+    if bot.db_catalog.stale:
+        bot.db_catalog.load(bot.db_connection)
+    return _exists_result(bot, name, check_type)
+
+
+async def db_exists_async(bot, entry='', table='', table_suffix='', check_type=False):
+    """Checks the existence of the given entry. See db_exists.
+
+    If the schema catalog needs to be reloaded, it is loaded on a pooled connection.
+    """
+    name = _exists_name(bot, entry, table, table_suffix)
+    if bot.db_catalog.stale:
+        await bot.db_pool.run(bot.db_catalog.load)
+    return _exists_result(bot, name, check_type)
 
 
 def db_dump_exclude(bot, table_name):
@@ -0,0 +1,637 @@
+"""Connection pool and statement cache for the database.
+
+Queries are run on a small thread pool, and every thread borrows a
+connection from a psycopg2 connection pool of the same size, so no more than
+that many queries run at once. Anything past that waits in the executor
+queue, which is what the wait time metrics measure.
+
+Queries that are run often are prepared on the server with PREPARE, and are
+then run with EXECUTE so that they don't have to be planned every time.
+
+Selections can opt into a result cache, which is invalidated whenever a
+table they read from is marked as changed.
+
+Known tables, indexes and types are kept in an in-memory catalog, so that
+checking whether they exist doesn't need a round trip.
+
+Every query is timed. Latency histograms are kept per table and per calling
+plugin, and queries slower than a threshold are logged (without their
+arguments) by statement shape, which is the query with its literals removed.
+"""
+import asyncio
+import copy
+import functools
+import re
+import sys
+import threading
+import time
+
+import psycopg2.extensions
+import psycopg2.pool
+
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from jshbot import logger
+
+
+class ConnectionPool():
+    def __init__(self, connection_parameters, size):
+        """Connects to the database with the given number of connections.
+
+        Every connection is kept open. The pool closes connections past its
+        minimum when they are put back, which would also close the cursors
+        returned by run before they are read.
+        """
+        self.size = size
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            size, size, connection_parameters, connection_factory=PreparingConnection)
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='jshbot-db')
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.queued = 0
+        self.runs = 0
+        self.saturated = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    async def run(self, function, *args, **kwargs):
+        """Calls function(connection, *args, **kwargs) on a pooled connection.
+
+        The function runs on a worker thread and is responsible for committing
+        or rolling back. Returns what the function returns.
+        """
+        with self.lock:
+            if self.in_use + self.queued >= self.size:
+                self.saturated += 1
+            self.queued += 1
+        function = functools.partial(self._run, time.perf_counter(), function, *args, **kwargs)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function)
+
+    def _run(self, submitted, function, *args, **kwargs):
+        waited = time.perf_counter() - submitted
+        with self.lock:
+            self.queued -= 1
+            self.in_use += 1
+            self.runs += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        connection = self.pool.getconn()
+        try:
+            return function(connection, *args, **kwargs)
+        finally:
+            broken = connection.closed
+            self.pool.putconn(connection, close=bool(broken))
+            with self.lock:
+                self.in_use -= 1
+
+    def get_stats(self):
+        """Returns a dictionary of the pool metrics. Wait times are in milliseconds."""
+        with self.lock:
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'queued': self.queued,
+                'runs': self.runs,
+                'saturated': self.saturated,
+                'average_wait': (self.total_wait / self.runs * 1000) if self.runs else 0,
+                'max_wait': self.max_wait * 1000
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        try:
+            self.pool.closeall()
+        except psycopg2.pool.PoolError:
+            pass
+        logger.debug("Database pool closed.")
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """A connection that keeps track of the statements prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = OrderedDict()
+        self.generation = 0
+        self.statements = 0
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_positional(query):
+    """Converts the %s placeholders of the query to $1, $2, etc.
+
+    Returns a tuple of (query, number of placeholders), or None if the query
+    can't be prepared.
+    """
+    if query.lstrip()[:6].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+        return
+    if '$' in query:
+        return
+    parts, count, index = [], 0, 0
+    while index < len(query):
+        character = query[index]
+        if character == '%':
+            following = query[index + 1:index + 2]
+            if following == 's':
+                count += 1
+                parts.append('${}'.format(count))
+            elif following == '%':
+                parts.append('%')
+            else:  # Named placeholders are not supported
+                return
+            index += 2
+        else:
+            parts.append(character)
+            index += 1
+    return ''.join(parts), count
+
+
+class StatementCache():
+    def __init__(self, threshold=5, size=256):
+        """Prepares queries on the server once they have been run enough times.
+
+        Keyword arguments:
+        threshold -- Number of times a query has to run before it is prepared. 0 disables this.
+        size -- Number of statements prepared per connection. The oldest ones are deallocated.
+        """
+        self.threshold = threshold
+        self.size = size
+        self.counts = OrderedDict()
+        self.generation = 1
+        self.lock = threading.Lock()
+        self.prepares = 0
+        self.executes = 0
+
+    def invalidate(self):
+        """Deallocates all prepared statements (lazily, on their connection's next query).
+
+        Should be called whenever tables are created or dropped.
+        """
+        with self.lock:
+            self.generation += 1
+
+    def execute(self, connection, cursor, query, input_args):
+        """Executes the query with the cursor, using a prepared statement if possible."""
+        name = None
+        if self.threshold and isinstance(connection, PreparingConnection):
+            name = self._get_statement(connection, cursor, query, input_args)
+        if name is None:
+            cursor.execute(query, input_args)
+            return
+        try:
+            if input_args:
+                placeholders = ', '.join('%s' for it in input_args)
+                cursor.execute('EXECUTE {} ({})'.format(name, placeholders), input_args)
+            else:
+                cursor.execute('EXECUTE {}'.format(name))
+        except Exception:
+            connection.generation = 0  # Start over after the rollback
+            raise
+        with self.lock:
+            self.executes += 1
+
+    def _get_statement(self, connection, cursor, query, input_args):
+        """Gets the name of the prepared statement for the query, preparing it if needed."""
+        if not isinstance(input_args, (list, tuple)):
+            return
+        with self.lock:
+            generation = self.generation
+            count = self.counts.pop(query, 0) + 1
+            self.counts[query] = count
+            if len(self.counts) > self.size * 4:
+                self.counts.popitem(last=False)
+        if connection.generation != generation:
+            if connection.prepared:
+                cursor.execute('DEALLOCATE ALL')
+                connection.prepared.clear()
+            connection.generation = generation
+
+        if query in connection.prepared:
+            connection.prepared.move_to_end(query)
+            return connection.prepared[query]
+        if count < self.threshold:
+            return
+        positional = _get_positional(query)
+        if positional is None or positional[1] != len(input_args):
+            return
+
+        connection.statements += 1
+        name = 'jshbot_{}'.format(connection.statements)
+        cursor.execute('SAVEPOINT jshbot_prepare')
+        try:
+            cursor.execute('PREPARE {} AS {}'.format(name, positional[0]))
+        except psycopg2.Error:  # Like if parameter types can't be determined
+            cursor.execute('ROLLBACK TO SAVEPOINT jshbot_prepare')
+            with self.lock:
+                self.counts[query] = float('-inf')
+            return
+        cursor.execute('RELEASE SAVEPOINT jshbot_prepare')
+        connection.prepared[query] = name
+        if len(connection.prepared) > self.size:
+            _, oldest = connection.prepared.popitem(last=False)
+            cursor.execute('DEALLOCATE {}'.format(oldest))
+        with self.lock:
+            self.prepares += 1
+        return name
+
+    def get_stats(self):
+        with self.lock:
+            return {'prepares': self.prepares, 'executes': self.executes}
+
+
+class CachedCursor():
+    """A read-only stand-in for a cursor whose results came from the result cache."""
+
+    def __init__(self, rows, description, rowcount):
+        self.rows = rows
+        self.description = description
+        self.rowcount = rowcount
+        self.index = 0
+
+    def _copy(self, row):
+        """Copies the row so that callers can't change the cached results.
+
+        Rows with mutable values (like JSON objects and arrays) are copied deeply.
+        """
+        values = row.values() if isinstance(row, dict) else row
+        if any(isinstance(it, (dict, list, set, bytearray)) for it in values):
+            return copy.deepcopy(row)
+        return row if isinstance(row, tuple) else copy.copy(row)
+
+    def fetchone(self):
+        if self.index >= len(self.rows):
+            return None
+        self.index += 1
+        return self._copy(self.rows[self.index - 1])
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.index:self.index + size]
+        self.index += len(rows)
+        return [self._copy(it) for it in rows]
+
+    def fetchall(self):
+        rows = self.rows[self.index:]
+        self.index = len(self.rows)
+        return [self._copy(it) for it in rows]
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        pass
+
+
+def _get_size(rows):
+    """Roughly estimates how much memory the rows take up in bytes."""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(it) for it in row)
+    return size
+
+
+class ResultCache():
+    def __init__(self, size):
+        """Caches the results of selections until a table they read from changes.
+
+        Keyword arguments:
+        size -- Approximate memory limit in bytes. The least recently used results are evicted.
+        """
+        self.size = size
+        self.total = 0
+        self.entries = OrderedDict()  # key: (tables, rows, description, rowcount, size)
+        self.tables = {}  # table: set of keys
+        self.versions = {}  # table: number of times it was invalidated
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns a CachedCursor for the key, or None if the result is not cached."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return CachedCursor(entry[1], entry[2], entry[3])
+
+    def get_versions(self, tables):
+        """Gets the versions of the tables. Pass these to put after running the query."""
+        with self.lock:
+            return tuple(self.versions.get(it, 0) for it in tables)
+
+    def put(self, key, tables, versions, cursor):
+        """Fetches the cursor results and caches them. Returns a CachedCursor.
+
+        Nothing is cached if any of the tables were invalidated since the
+        versions were taken, or if the results are too large.
+        """
+        rows = cursor.fetchall() if cursor.description else []
+        result = CachedCursor(rows, cursor.description, cursor.rowcount)
+        size = _get_size(rows)
+        if size > self.size / 4:
+            return result
+        with self.lock:
+            if versions != tuple(self.versions.get(it, 0) for it in tables):
+                return result
+            self._remove(key)
+            self.entries[key] = (tables, rows, cursor.description, cursor.rowcount, size)
+            for table in tables:
+                self.tables.setdefault(table, set()).add(key)
+            self.total += size
+            while self.total > self.size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return result
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total -= entry[4]
+        for table in entry[0]:
+            keys = self.tables.get(table)
+            keys.discard(key)
+            if not keys:
+                del self.tables[table]
+
+    def invalidate(self, table):
+        """Removes every cached result that read from the table."""
+        with self.lock:
+            self.versions[table] = self.versions.get(table, 0) + 1
+            for key in list(self.tables.get(table, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.total,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions
+            }
+
+
+# Upper bounds of the latency histogram buckets in milliseconds
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_table_pattern = re.compile(
+    r'\b(?:FROM|JOIN|INTO|UPDATE|TABLE(?: IF (?:NOT )?EXISTS)?|COPY)\s+([A-Za-z_][\w.]*)',
+    re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_shape(query):
+    """Gets the statement shape of the query, with literals replaced by ? and no extra spaces.
+
+    Returns a tuple of (shape, tables used).
+    """
+    shape = ' '.join(_literal_pattern.sub('?', query).split())
+    tables = tuple(sorted(set(
+        it.lower() for it in _table_pattern.findall(shape) if it.upper() != 'STDIN')))
+    return shape, tables
+
+
+def redact(input_args):
+    """Describes the query arguments by type only, so that they can be logged."""
+    if isinstance(input_args, dict):
+        return '{' + ', '.join(
+            '{}: {}'.format(key, type(value).__name__) for key, value in input_args.items()) + '}'
+    elif isinstance(input_args, (list, tuple)):
+        return '(' + ', '.join(type(it).__name__ for it in input_args) + ')'
+    return type(input_args).__name__
+
+
+class QueryLog():
+    def __init__(self, threshold=100, explain=False, size=1024):
+        """Keeps timing statistics of queries.
+
+        Keyword arguments:
+        threshold -- Queries that take at least this many milliseconds are logged. 0 disables this.
+        explain -- Whether or not slow queries should also have their plan logged.
+        size -- Number of statement shapes to keep statistics for.
+        """
+        self.threshold = threshold
+        self.explain = explain
+        self.size = size
+        self.lock = threading.Lock()
+        self.tables = {}  # table: histogram
+        self.plugins = {}  # plugin: histogram
+        self.shapes = OrderedDict()  # shape: [count, total time, max time, slow count]
+        self.queries = 0
+        self.slow = 0
+
+    def record(self, query, input_args, elapsed, plugin):
+        """Records that the query took the given number of seconds.
+
+        Returns True if the query was slow and its plan should be logged with explain.
+        """
+        milliseconds = elapsed * 1000
+        shape, tables = get_shape(query)
+        bucket = next(
+            index for index, bound in enumerate(HISTOGRAM_BUCKETS) if milliseconds < bound)
+        slow = bool(self.threshold) and milliseconds >= self.threshold
+        with self.lock:
+            self.queries += 1
+            for histograms, key in [(self.tables, it) for it in tables] + [(self.plugins, plugin)]:
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = histograms[key] = [0] * len(HISTOGRAM_BUCKETS)
+                histogram[bucket] += 1
+            statistics = self.shapes.pop(shape, None) or [0, 0, 0, 0]
+            self.shapes[shape] = statistics
+            if len(self.shapes) > self.size:
+                self.shapes.popitem(last=False)
+            statistics[0] += 1
+            statistics[1] += milliseconds
+            statistics[2] = max(statistics[2], milliseconds)
+            if slow:
+                statistics[3] += 1
+                self.slow += 1
+        if slow:
+            logger.warn(
+                "Slow query (%.1f ms, plugin %s): %s %s",
+                milliseconds, plugin, shape, redact(input_args))
+        return slow and self.explain
+
+    def explain_query(self, connection, query, input_args):
+        """Logs the plan of the query. Meant to be run on a pooled connection.
+
+        On PostgreSQL 16 and up, a generic plan is used so that the arguments
+        don't show up in the plan.
+        """
+        if get_shape(query)[0][:6].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            return
+        positional = _get_positional(query)
+        try:
+            cursor = connection.cursor()
+            if positional and connection.server_version >= 160000:
+                cursor.execute('EXPLAIN (GENERIC_PLAN) ' + positional[0])
+            else:
+                cursor.execute('EXPLAIN ' + query, input_args)
+            plan = '\n'.join(it[0] for it in cursor.fetchall())
+        except Exception as e:
+            logger.warn("Failed to explain the slow query: %s", e)
+            plan = None
+        connection.rollback()
+        if plan:
+            logger.warn("Plan of the slow query:\n%s", plan)
+
+    def get_slowest(self, count=10):
+        """Returns up to count tuples of (shape, calls, average ms, max ms, slow calls)."""
+        with self.lock:
+            shapes = [
+                (shape, it[0], it[1] / it[0], it[2], it[3]) for shape, it in self.shapes.items()]
+        return sorted(shapes, key=lambda it: it[3], reverse=True)[:count]
+
+    def get_percentile(self, histogram, percentile):
+        """Gets the upper bound of the bucket that the percentile of the histogram is in."""
+        target = sum(histogram) * percentile
+        total = 0
+        for bound, number in zip(HISTOGRAM_BUCKETS, histogram):
+            total += number
+            if total >= target:
+                return bound
+        return HISTOGRAM_BUCKETS[-1]
+
+    def get_stats(self):
+        """Returns the number of queries, slow queries, and copies of the histograms."""
+        with self.lock:
+            return {
+                'queries': self.queries,
+                'slow': self.slow,
+                'tables': {key: list(value) for key, value in self.tables.items()},
+                'plugins': {key: list(value) for key, value in self.plugins.items()}
+            }
+
+
+_create_pattern = re.compile(
+    r'CREATE (?:OR REPLACE )?(?:UNIQUE )?(?:TEMP |TEMPORARY |UNLOGGED |MATERIALIZED )?'
+    r'(TABLE|INDEX|VIEW|SEQUENCE|TYPE)(?: CONCURRENTLY)?(?: IF NOT EXISTS)? '
+    r'(?!ON )("[^"]+"|[\w.]+)(?: |\(|$)', re.IGNORECASE)
+_drop_pattern = re.compile(
+    r'DROP (?:MATERIALIZED )?(TABLE|INDEX|VIEW|SEQUENCE|TYPE)(?: CONCURRENTLY)?(?: IF EXISTS)? '
+    r'((?:"[^"]+"|[\w.]+)(?:, ?(?:"[^"]+"|[\w.]+))*)(?: CASCADE| RESTRICT)?;?$',
+    re.IGNORECASE)
+
+
+# How a table is partitioned (see data.db_add_partitioning)
+Partitioning = namedtuple('Partitioning', ['key', 'key_type', 'method', 'partitions', 'interval'])
+
+_relation_kinds = {'TABLE': 'r', 'INDEX': 'i', 'VIEW': 'v', 'SEQUENCE': 'S'}
+
+
+def normalize_name(name):
+    """Normalizes an identifier like PostgreSQL does (lowercase unless quoted).
+
+    Schema qualified names lose their schema.
+    """
+    name = name.strip()
+    if name.startswith('"') and name.endswith('"'):
+        return name[1:-1]
+    return name.split('.')[-1].lower()
+
+
+class SchemaCatalog():
+    def __init__(self):
+        """Keeps track of the relations (tables, indexes, etc.) and types in the database.
+
+        The catalog is loaded from pg_catalog, and is kept up to date with the
+        schema changes made through the bot (see apply). Schema changes that
+        can't be followed mark the catalog as stale, so that it is reloaded.
+        """
+        self.relations = {}  # name: relkind (r for tables, i for indexes, etc.)
+        self.types = set()
+        self.stale = True
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.loads = 0
+
+    def load(self, connection):
+        """Loads the catalog on the connection."""
+        with self.lock:
+            generation = self.generation
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT relname, relkind FROM pg_catalog.pg_class "
+                "WHERE pg_catalog.pg_table_is_visible(oid)")
+            relations = dict(cursor.fetchall())
+            cursor.execute("SELECT typname FROM pg_catalog.pg_type")
+            types = set(it[0] for it in cursor.fetchall())
+        except Exception:
+            connection.rollback()
+            raise
+        connection.commit()
+        with self.lock:
+            self.relations, self.types = relations, types
+            self.stale = generation != self.generation
+            self.loads += 1
+
+    def invalidate(self):
+        """Marks the catalog as stale so that it is reloaded before its next use."""
+        with self.lock:
+            self.stale = True
+            self.generation += 1
+
+    def apply(self, query):
+        """Updates the catalog with a query that ran successfully.
+
+        Returns True if the query changed the schema.
+        """
+        if not query.lstrip()[:6].upper().startswith(('CREATE', 'DROP', 'ALTER')):
+            return False
+        statement = ' '.join(query.split())
+        created = _create_pattern.match(statement)
+        dropped = _drop_pattern.match(statement)
+        with self.lock:
+            self.generation += 1
+            if created:
+                kind, name = created.groups()
+                kind, name = kind.upper(), normalize_name(name)
+                if kind == 'TYPE':
+                    self.types.add(name)
+                else:
+                    if kind == 'TABLE' and ' PARTITION BY ' in statement.upper():
+                        self.relations[name] = 'p'
+                    else:
+                        self.relations[name] = _relation_kinds[kind]
+                    if kind == 'TABLE':  # Tables also have a row type
+                        self.types.add(name)
+            elif dropped:
+                kind, names = dropped.groups()
+                for name in names.split(','):
+                    if kind.upper() == 'TYPE':
+                        self.types.discard(normalize_name(name))
+                    else:
+                        self.relations.pop(normalize_name(name), None)
+                if kind.upper() == 'TABLE':  # Indexes, types and partitions are dropped too
+                    self.stale = True
+            else:  # Like ALTER ... RENAME, or an unnamed index
+                self.stale = True
+        return True
+
+    def has_relation(self, name):
+        """Returns the normalized name if the relation exists, or None otherwise."""
+        name = normalize_name(name)
+        return name if name in self.relations else None
+
+    def get_tables(self):
+        """Returns a list of the names of all (non-partitioned) tables."""
+        return [name for name, kind in self.relations.items() if kind == 'r']
+
+    def has_type(self, name):
+        """Returns True if the type exists, or None otherwise. Type names are not normalized."""
+        return True if name in self.types else None
@@ -0,0 +1,121 @@
+"""Bounded executor for plugin event listeners.
+
+Each plugin gets its own lane: at most `concurrency` of its listeners run at
+once, and the rest wait in the lane's queues. A lane only has as many worker
+tasks as listeners running, and each worker keeps taking calls until the
+queues are empty.
+
+Internal events (bot_*) are queued ahead of gateway events, and are never
+dropped. Gateway events are limited to `queue_size` per lane. Once a lane is
+full, either the new event is dropped ('drop'), or the oldest queued gateway
+event is dropped to make room for it ('shed').
+"""
+import asyncio
+import traceback
+
+from collections import deque
+
+from jshbot import logger
+
+POLICIES = ('drop', 'shed')
+
+
+class Lane():
+    def __init__(self):
+        self.high = deque()  # Internal events
+        self.low = deque()  # Gateway events
+        self.running = 0
+        self.tasks = set()  # Workers
+        self.calls = 0
+        self.dropped = 0
+        self.peak = 0
+
+
+class EventExecutor():
+    def __init__(self, concurrency=16, queue_size=1000, policy='shed'):
+        """Runs listener calls in per-plugin lanes.
+
+        Keyword arguments:
+        concurrency -- How many listeners of each plugin can run at once.
+        queue_size -- How many gateway events each plugin can have queued.
+        policy -- What to do with gateway events when the queue is full (see POLICIES).
+        """
+        if policy not in POLICIES:
+            logger.warn("Unknown event overflow policy %s, using 'shed'", policy)
+            policy = 'shed'
+        self.concurrency = max(concurrency, 1)
+        self.queue_size = queue_size
+        self.policy = policy
+        self.lanes = {}  # plugin: lane
+
+    def submit(self, plugin, priority, function, args, kwargs):
+        """Calls function(*args, **kwargs) in the plugin's lane.
+
+        Returns False if the call was dropped.
+        """
+        lane = self.lanes.get(plugin)
+        if lane is None:
+            lane = self.lanes[plugin] = Lane()
+        call = (function, args, kwargs)
+        if lane.running < self.concurrency:
+            lane.running += 1
+            task = asyncio.ensure_future(self._work(lane, call))
+            lane.tasks.add(task)
+            task.add_done_callback(lane.tasks.discard)
+            return True
+        if priority:
+            lane.high.append(call)
+        elif len(lane.low) < self.queue_size:
+            lane.low.append(call)
+        elif self.policy == 'shed' and lane.low:
+            lane.low.popleft()
+            lane.low.append(call)
+            lane.dropped += 1
+        else:
+            lane.dropped += 1
+            return False
+        lane.peak = max(lane.peak, len(lane.high) + len(lane.low))
+        return True
+
+    def clear(self, plugin):
+        """Drops the calls queued for the plugin and cancels the running ones.
+
+        Used when the plugin is reloaded.
+        """
+        lane = self.lanes.get(plugin)
+        if lane:
+            lane.high.clear()
+            lane.low.clear()
+            for task in list(lane.tasks):
+                task.cancel()
+
+    async def _work(self, lane, call):
+        while True:
+            function, args, kwargs = call
+            lane.calls += 1
+            try:
+                await function(*args, **kwargs)
+            except asyncio.CancelledError:
+                lane.running -= 1
+                raise
+            except Exception as e:
+                logger.error("Plugin event listener %s failed: %s", function.__name__, e)
+                logger.error(traceback.format_exc())
+            if lane.high:
+                call = lane.high.popleft()
+            elif lane.low:
+                call = lane.low.popleft()
+            else:
+                lane.running -= 1
+                return
+
+    def get_stats(self):
+        """Gets the queue depths and counts of each lane, keyed by plugin."""
+        return {
+            plugin: {
+                'queued': len(lane.high) + len(lane.low),
+                'running': lane.running,
+                'calls': lane.calls,
+                'dropped': lane.dropped,
+                'peak': lane.peak
+            } for plugin, lane in self.lanes.items()}
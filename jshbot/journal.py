@@ -0,0 +1,145 @@
+"""Write-ahead journal for persistent data.
+
+Every change made through the data module is recorded as a single line in an
+append-only journal segment. Records are idempotent: each one either sets a
+key to its new value, or deletes a key. Replaying every segment in order on
+top of the data files restores any changes that did not make it into a save.
+
+Whenever a save takes a snapshot, the journal is checkpointed by starting a
+new segment. Once the snapshot is written, the segments before the checkpoint
+are no longer needed and are deleted (compaction).
+"""
+import json
+import os
+import threading
+
+from jshbot import logger
+
+
+class Journal():
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        segments = self.get_segments()
+        self.segment = (segments[-1] + 1) if segments else 0  # Fresh segment every boot
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.deleted_below = 0
+        self.outstanding = {}
+        self.failed = set()
+        self.size = sum(os.path.getsize(self.get_path(it)) for it in segments)
+
+    def get_path(self, segment):
+        return '{}{:010d}.log'.format(self.directory, segment)
+
+    def get_segments(self):
+        """Returns a sorted list of segment numbers that exist on disk."""
+        segments = []
+        for entry in os.listdir(self.directory):
+            if entry.endswith('.log') and entry[:-4].isdigit():
+                segments.append(int(entry[:-4]))
+        return sorted(segments)
+
+    def record(self, location_key, path, *value):
+        """Buffers a record. If a value is given, the path is set, otherwise it is deleted.
+
+        Records are only written to disk when the buffer is flushed.
+        """
+        line = json.dumps([location_key, path] + list(value), separators=(',', ':'))
+        self.buffer.append((self.segment, line))
+
+    def take(self):
+        """Takes the buffered records to be written. Call from the event loop."""
+        entries, self.buffer = self.buffer, []
+        return entries
+
+    def write(self, entries):
+        """Appends the entries to their segments and syncs them to disk."""
+        segments = {}
+        for segment, line in entries:
+            segments.setdefault(segment, []).append(line)
+        with self.lock:
+            for segment, lines in segments.items():
+                if segment < self.deleted_below:  # Already folded into the data files
+                    continue
+                text = '\n'.join(lines) + '\n'
+                with open(self.get_path(segment), 'a') as segment_file:
+                    segment_file.write(text)
+                    segment_file.flush()
+                    os.fsync(segment_file.fileno())
+                self.size += len(text)
+
+    def flush(self):
+        """Writes all buffered records on the calling thread."""
+        self.write(self.take())
+
+    def checkpoint(self):
+        """Starts a new segment for a snapshot that is about to be taken.
+
+        Returns the checkpoint, which should be passed to complete once the
+        snapshot has been written.
+        """
+        self.segment += 1
+        self.outstanding[self.segment] = set(self.outstanding)
+        return self.segment
+
+    def complete(self, checkpoint, success):
+        """Marks the snapshot for the checkpoint as written.
+
+        Returns the checkpoint if the segments before it can be deleted (see
+        delete), or None otherwise. Segments are kept if the snapshot failed, or
+        if a snapshot taken before this one has not been written yet.
+        """
+        previous = self.outstanding.pop(checkpoint)
+        if not success:
+            self.failed.add(checkpoint)
+            return
+        if any(it in self.outstanding or it in self.failed for it in previous):
+            return
+        self.failed = set(it for it in self.failed if it > checkpoint)
+        self.buffer = [it for it in self.buffer if it[0] >= checkpoint]
+        return checkpoint
+
+    def delete(self, checkpoint):
+        """Deletes all segments before the checkpoint."""
+        if checkpoint is None:
+            return
+        with self.lock:
+            self.deleted_below = max(self.deleted_below, checkpoint)
+            for segment in self.get_segments():
+                if segment < checkpoint:
+                    os.remove(self.get_path(segment))
+            self.size = sum(os.path.getsize(self.get_path(it)) for it in self.get_segments())
+
+    def discard(self):
+        """Deletes every segment and buffered record, like when data is restored from a backup.
+
+        Writing continues in a new segment. Snapshots that are still being
+        written can complete their checkpoints, but nothing before the new
+        segment is replayed or written again.
+        """
+        with self.lock:
+            self.buffer = []
+            self.segment += 1
+            self.deleted_below = self.segment
+            self.failed = set()
+            for segment in self.get_segments():
+                os.remove(self.get_path(segment))
+            self.size = 0
+
+    def replay(self):
+        """Yields every record on disk in order.
+
+        A torn record at the end of a segment (from a crash in the middle of a
+        write) ends that segment.
+        """
+        for segment in self.get_segments():
+            with open(self.get_path(segment), 'r') as segment_file:
+                for line in segment_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warn("Ignoring torn journal record in segment %s", segment)
+                        break
+                    yield record
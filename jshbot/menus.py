@@ -0,0 +1,132 @@
+"""Reaction router for interactive menus.
+
+Open menus are indexed by message ID, so each reaction event is routed to
+the one menu (if any) that it belongs to, instead of being checked against
+every pending wait_for predicate.
+
+Menus time out after going without a reaction for their timeout. Rather than
+one timer per menu, the router keeps a min-heap of deadlines. Reactions only
+update the menu's deadline, and a heap item whose menu has a later deadline
+is pushed back when it comes up.
+"""
+import asyncio
+import heapq
+import time
+
+REACTION_EVENTS = ('reaction_add', 'reaction_remove', 'raw_reaction_add', 'raw_reaction_remove')
+
+
+class Menu():
+    def __init__(self, message_id, events, timeout, check):
+        """An open menu that reads reaction events for a message.
+
+        Keyword arguments:
+        events -- The reaction events read by the menu.
+        timeout -- Seconds until the menu times out without a reaction. None for no timeout.
+        check -- Called with the event arguments. Events are ignored if it returns False.
+        """
+        self.message_id = message_id
+        self.events = events
+        self.timeout = timeout
+        self.check = check
+        self.deadline = float('inf') if timeout is None else time.monotonic() + timeout
+        self.queue = asyncio.Queue()
+
+    async def read(self):
+        """Gets the next reaction event, given as wait_for would return it.
+
+        Raises asyncio.TimeoutError if the menu timed out.
+        """
+        result = await self.queue.get()
+        if result is None:
+            raise asyncio.TimeoutError()
+        elif isinstance(result, Exception):
+            raise result
+        return result
+
+    def drain(self):
+        """Gets the reaction events that are already queued, without waiting.
+
+        Events that raised an exception in the check are dropped.
+        """
+        results = []
+        while not self.queue.empty():
+            result = self.queue.get_nowait()
+            if result is None:  # Timed out, so read should still raise
+                self.queue.put_nowait(None)
+                break
+            elif not isinstance(result, Exception):
+                results.append(result)
+        return results
+
+
+class MenuRouter():
+    def __init__(self):
+        self.menus = {}  # message ID: menu
+        self.expiry = []  # (deadline when pushed, message ID)
+        self.changed = asyncio.Event()
+        self.task = None
+        self.routed = 0
+
+    def open(self, message_id, events, timeout=300, check=None):
+        """Opens a menu on the given message and returns it. See Menu."""
+        menu = Menu(message_id, events, timeout, check)
+        self.menus[message_id] = menu
+        if timeout is None:
+            return menu
+        heapq.heappush(self.expiry, (menu.deadline, message_id))
+        if self.expiry[0][1] == message_id:
+            self.changed.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+        return menu
+
+    def close(self, menu):
+        """Stops routing events to the menu."""
+        if self.menus.get(menu.message_id) is menu:
+            del self.menus[menu.message_id]
+
+    def route(self, event, *args):
+        """Passes the reaction event to the menu on its message."""
+        if event.startswith('raw_'):
+            message_id, result = args[0].message_id, args[0]
+        else:
+            message_id, result = args[0].message.id, args
+        menu = self.menus.get(message_id)
+        if menu is None or event not in menu.events:
+            return
+        try:
+            if menu.check and not menu.check(*args):
+                return
+        except Exception as e:  # Raised in the menu, like wait_for would
+            result = e
+        if menu.timeout is not None:
+            menu.deadline = time.monotonic() + menu.timeout
+        menu.queue.put_nowait(result)
+        self.routed += 1
+
+    async def _run(self):
+        """Times out menus as their deadlines pass."""
+        while True:
+            self.changed.clear()
+            now = time.monotonic()
+            while self.expiry and self.expiry[0][0] <= now:
+                message_id = heapq.heappop(self.expiry)[1]
+                menu = self.menus.get(message_id)
+                if menu is None:
+                    continue
+                elif menu.deadline == float('inf'):  # Replaced by a menu without a timeout
+                    continue
+                elif menu.deadline > now:
+                    heapq.heappush(self.expiry, (menu.deadline, message_id))
+                else:
+                    del self.menus[message_id]
+                    menu.queue.put_nowait(None)
+            timeout = (self.expiry[0][0] - now) if self.expiry else None
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self):
+        return {'open': len(self.menus), 'routed': self.routed}
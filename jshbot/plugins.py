@@ -1,15 +1,13 @@
 import asyncio
 import copy
+import discord
 import yaml
 import importlib.util
 import os.path
 import sys
 import re
 
-# Debug
-import traceback
-
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 
 from jshbot import commands, utilities, data, logger
 from jshbot.exceptions import ErrorTypes, BotException, ConfiguredBotException
@@ -44,9 +42,22 @@ def on_load(function):
     return function
 
 
-def listen_for(event_name):
-    """Decorator for registering event functions."""
+def listen_for(event_name, events=None, guilds=None, channels=None):
+    """Decorator for registering event functions.
+
+    Filters are checked before the function is called. Guilds and channels are
+    taken from the first event argument (see get_event_location).
+
+    Keyword arguments:
+    events -- For 'all' listeners, the events to listen for.
+    guilds -- Guild IDs the events must come from.
+    channels -- Channel IDs the events must come from.
+    """
     def _decorator(function):
+        if not hasattr(function, 'event_filters'):
+            function.event_filters = {}
+        function.event_filters[event_name] = tuple(
+            None if it is None else frozenset(it) for it in (events, guilds, channels))
         event_functions.append((event_name, function))
         return function
     return _decorator
@@ -85,6 +96,8 @@ def load_plugin(bot, plugin_name):
                     to_remove.append(function)
             for function in to_remove:
                 function_list.remove(function)
+        compile_subscriptions(bot)
+        bot.event_executor.clear(plugin_name)
 
         # Delete plugin commands
         to_remove = []
@@ -140,6 +153,8 @@ def load_plugin(bot, plugin_name):
             utilities.add_bot_permissions(bot, plugin_name, **function(bot))
     except Exception as e:
         raise CBException("Failed to initialize external plugin.", plugin_name, e=e)
+    finally:
+        compile_subscriptions(bot)
 
 
 def add_plugins(bot):
@@ -182,6 +197,7 @@ def add_plugins(bot):
     while plugin_permissions:
         function = plugin_permissions.pop()
         utilities.add_bot_permissions(bot, 'core', **function(bot))
+    compile_subscriptions(bot)
 
     # Add plugins in plugin folder
     for plugin_name in plugins_list:
@@ -479,19 +495,77 @@ def get_manual(bot, subject_id=None, topic_index=None, page=None, guild=None, sa
         return crumbs, subject_listing, page, total_subject_pages
 
 
+def compile_subscriptions(bot):
+    """Builds the table of listeners that broadcast_event uses for each event.
+
+    Each listener is a tuple of (function, takes the event name, guilds, channels).
+    'all' listeners without an events filter are used for any event not in the table.
+    """
+    def _get_listeners(event_name):
+        for function in bot.event_functions.get(event_name, []):
+            events, guilds, channels = getattr(function, 'event_filters', {}).get(
+                event_name, (None, None, None))
+            yield function, events, guilds, channels
+
+    subscriptions = {}
+    for event_name in bot.event_functions:
+        if event_name == 'all':
+            continue
+        subscriptions[event_name] = [
+            (function, False, guilds, channels)
+            for function, _, guilds, channels in _get_listeners(event_name)]
+    for _, events, _, _ in _get_listeners('all'):  # Events only 'all' listeners use
+        for event_name in events or []:
+            subscriptions.setdefault(event_name, [])
+    catch_all = []
+    for function, events, guilds, channels in _get_listeners('all'):
+        listener = (function, True, guilds, channels)
+        if events is None:
+            catch_all.append(listener)
+        for event_name in (subscriptions if events is None else events):
+            subscriptions.setdefault(event_name, []).append(listener)
+    bot.event_subscriptions = {key: tuple(value) for key, value in subscriptions.items()}
+    bot.event_catch_all = tuple(catch_all)
+    if not hasattr(bot, 'event_counts'):
+        bot.event_counts = Counter()  # Listener calls made for each event
+
+
+def get_event_location(args):
+    """Gets the guild and channel IDs of the first event argument (None if not found)."""
+    if not args:
+        return None, None
+    it = args[0]
+    if isinstance(it, discord.Guild):
+        return it.id, None
+    elif isinstance(it, discord.abc.GuildChannel):
+        return it.guild.id, it.id
+    elif isinstance(it, discord.Reaction):
+        it = it.message
+    guild_id = getattr(it, 'guild_id', None)
+    if guild_id is None:
+        guild_id = getattr(getattr(it, 'guild', None), 'id', None)
+    channel_id = getattr(it, 'channel_id', None)
+    if channel_id is None:
+        channel_id = getattr(getattr(it, 'channel', None), 'id', None)
+    return guild_id, channel_id
+
+
 def broadcast_event(bot, event, *args, **kwargs):
-    """Calls functions registered to the given event."""
+    """Calls functions registered to the given event through the event executor."""
     if not bot.ready:
         return
-    for function in bot.event_functions.get(event, []):
-        try:
-            asyncio.ensure_future(function(bot, *args, **kwargs))
-        except TypeError as e:
-            logger.error("Bypassing event error: %s", e)
-            logger.error(traceback.format_exc())
-    for function in bot.event_functions.get('all', []):
-        try:
-            asyncio.ensure_future(function(bot, event, *args, **kwargs))
-        except TypeError as e:
-            logger.error("Bypassing event error: %s", e)
-            logger.error(traceback.format_exc())
+    listeners = bot.event_subscriptions.get(event, bot.event_catch_all)
+    if not listeners:
+        return
+    location = None
+    priority = event.startswith('bot_')  # Internal events
+    for function, takes_event, guilds, channels in listeners:
+        if guilds is not None or channels is not None:
+            if location is None:
+                location = get_event_location(args)
+            if ((guilds is not None and location[0] not in guilds) or
+                    (channels is not None and location[1] not in channels)):
+                continue
+        bot.event_counts[event] += 1
+        arguments = (bot, event) + args if takes_event else (bot,) + args
+        bot.event_executor.submit(function.__module__, priority, function, arguments, kwargs)
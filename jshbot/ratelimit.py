@@ -0,0 +1,74 @@
+"""Rate limiter for commands.
+
+Each key (usually a user ID) has a token bucket that holds up to `limit`
+tokens and refills at `limit` tokens per `timeout` seconds. Buckets are
+tracked by the time at which they will be full again (the generic cell rate
+algorithm), so refilling is lazy and every check is O(1).
+
+Buckets that have been refilled are idle and are evicted through a min-heap
+ordered by that time, so memory only grows with the number of active keys.
+Buckets are not pushed again on every hit. Instead, a bucket that was hit
+again by the time it comes up is pushed back with its new time.
+"""
+import heapq
+import time
+
+
+class RateLimiter():
+    def __init__(self, limit, timeout):
+        """Allows bursts of up to limit hits, refilling over timeout seconds."""
+        self.limit = limit
+        self.timeout = timeout
+        self.buckets = {}  # key: [full time, warned]
+        self.expiry = []  # (full time when pushed, key)
+        self.limited = 0
+
+    def _evict(self, now):
+        """Removes the buckets that have refilled completely."""
+        while self.expiry and self.expiry[0][0] <= now:
+            key = heapq.heappop(self.expiry)[1]
+            if self.buckets[key][0] <= now:
+                del self.buckets[key]
+            else:
+                heapq.heappush(self.expiry, (self.buckets[key][0], key))
+
+    def hit(self, key, limit=None, now=None):
+        """Takes a token from the key's bucket.
+
+        Returns 0 if a token was taken, or the number of seconds until one is
+        available otherwise.
+
+        Keyword arguments:
+        limit -- Overrides the limit for this hit (like a per-guild limit).
+        now -- The current time, for testing.
+        """
+        limit = self.limit if limit is None else limit
+        if self.timeout <= 0 or limit <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        interval = self.timeout / limit
+        bucket = self.buckets.get(key)
+        full_time = now if bucket is None else max(bucket[0], now)
+        wait = full_time + interval - now - self.timeout
+        if wait > 0:
+            self.limited += 1
+            return wait
+        full_time += interval
+        if bucket is None:
+            self.buckets[key] = [full_time, False]
+            heapq.heappush(self.expiry, (full_time, key))
+        else:
+            bucket[0], bucket[1] = full_time, False
+        return 0
+
+    def warn(self, key):
+        """Returns True only the first time this is called after the key was limited."""
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket[1]:
+            return False
+        bucket[1] = True
+        return True
+
+    def get_stats(self):
+        return {'tracked': len(self.buckets), 'limited': self.limited}
@@ -0,0 +1,442 @@
+"""In-memory scheduler for the schedule table.
+
+Entries that are due within the lookahead window are kept in a min-heap
+ordered by time. The heap is filled from the database once per window, and
+is kept in sync as entries are added, updated and removed through the
+utilities schedule functions. Entries that become due at the same time are
+deleted with a single query and fired together.
+
+Updated and removed entries are not taken out of the heap. Instead, heap
+items whose entry no longer matches are skipped when they come up (lazy
+deletion).
+
+Entries that became overdue while the bot was offline are found on startup
+and dispatched in the background (catch-up), with bounded concurrency and a
+minimum interval between calls for the same destination. Each one is only
+claimed right before it is called, so the entries that were not called yet
+stay in the table if the bot stops during catch-up.
+
+More than one bot process can share the schedule table by splitting it into
+shards (by destination). Each process owns a fair share of the shards through
+PostgreSQL advisory locks, which are held by a dedicated connection and
+released if the process disconnects. Locks are taken on a worker thread.
+Entries are claimed with DELETE ... FOR UPDATE SKIP LOCKED, so each one is
+executed exactly once, and the table is polled for entries added by other
+processes. With a single shard, one process is elected to run everything.
+"""
+import asyncio
+import heapq
+import time
+
+import psycopg2
+
+from psycopg2.extras import NamedTupleCursor
+
+from jshbot import data, logger, utilities
+
+SHARD_LOCK = 1785948258  # Advisory lock key spaces
+MEMBER_LOCK = 1785948259
+SHARD_FILTER = 'mod(hashtext(coalesce(destination, id::text)) & 2147483647, {}) = ANY(%s)'
+CLAIM_QUERY = (
+    'DELETE FROM schedule WHERE id IN (SELECT id FROM schedule WHERE {} AND {} '
+    'FOR UPDATE SKIP LOCKED) RETURNING *')
+
+
+class Scheduler():
+    def __init__(
+            self, bot, lookahead=3600, catch_up_concurrency=8, catch_up_interval=1,
+            shards=0, poll_interval=5):
+        """Keeps upcoming schedule entries in memory.
+
+        Keyword arguments:
+        lookahead -- How many seconds ahead of time entries are loaded.
+        catch_up_concurrency -- How many overdue entries can run at once on startup.
+        catch_up_interval -- Seconds between overdue entries for the same destination.
+        shards -- Number of shards shared between bot processes. 0 if this is
+            the only process using the schedule table.
+        poll_interval -- Seconds between polls for entries when using shards.
+        """
+        self.bot = bot
+        self.lookahead = lookahead
+        self.catch_up_concurrency = catch_up_concurrency
+        self.catch_up_interval = catch_up_interval
+        self.shards = shards
+        self.poll_interval = poll_interval
+        self.owned = set()  # Shards locked by this process
+        self.nodes = 1
+        self.member = False
+        self.connection = None  # Holds the advisory locks (see _query)
+        self.next_poll = 0
+        self.retry_delay = 0  # Backoff after failing to claim due entries
+        self.heap = []  # (time, id)
+        self.entries = {}  # id: entry
+        self.horizon = None  # Every entry due up to this time is in memory
+        self.refilling = False
+        self.touched = set()  # Entries changed while refilling
+        self.changed = asyncio.Event()
+        self.task = None
+        self.catch_up_task = None
+        self.late = {}  # id: time of entries waiting for catch-up
+        self.caught_up = 0
+        self.fired = 0
+        self.batches = 0
+
+    def start(self):
+        """Starts the scheduler if it isn't running already."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+
+    def wake(self):
+        """Makes the scheduler check for due entries again."""
+        self.changed.set()
+
+    def add(self, entry):
+        """Adds or replaces the entry (a schedule table row)."""
+        if self.refilling:
+            self.touched.add(entry.id)
+        self.entries.pop(entry.id, None)
+        if self.horizon is None or entry.time > self.horizon:
+            return
+        self.entries[entry.id] = entry
+        heapq.heappush(self.heap, (entry.time, entry.id))
+        if self.heap[0][1] == entry.id:
+            self.wake()
+
+    def add_many(self, entries):
+        """Adds or replaces all of the given entries, then wakes the scheduler once."""
+        for entry in entries:
+            if self.refilling:
+                self.touched.add(entry.id)
+            self.entries.pop(entry.id, None)
+            if self.horizon is not None and entry.time <= self.horizon:
+                self.entries[entry.id] = entry
+                self.heap.append((entry.time, entry.id))
+        heapq.heapify(self.heap)
+        self.wake()
+
+    def remove(self, entry_ids):
+        """Removes the entries with the given IDs."""
+        for entry_id in entry_ids:
+            if self.refilling:
+                self.touched.add(entry_id)
+            self.entries.pop(entry_id, None)
+
+    def _peek(self):
+        """Gets the earliest entry, discarding stale heap items. Returns None if empty."""
+        while self.heap:
+            scheduled_time, entry_id = self.heap[0]
+            entry = self.entries.get(entry_id)
+            if entry is not None and entry.time == scheduled_time:
+                return entry
+            heapq.heappop(self.heap)
+
+    def _pop_due(self, now):
+        """Takes out every entry that is due."""
+        due = []
+        entry = self._peek()
+        while entry is not None and entry.time <= now:
+            heapq.heappop(self.heap)
+            due.append(self.entries.pop(entry.id))
+            entry = self._peek()
+        return due
+
+    async def _refill(self, now):
+        """Loads the entries due up to the next horizon."""
+        previous, self.horizon = self.horizon, int(now + self.lookahead)
+        self.refilling, self.touched = True, set()
+        try:
+            if previous is None:
+                where_arg, input_args = 'time <= %s', [self.horizon]
+            else:
+                where_arg, input_args = 'time > %s AND time <= %s', [previous, self.horizon]
+            cursor = await data.db_select_async(
+                self.bot, from_arg='schedule', where_arg=where_arg,
+                input_args=input_args, safe=False)
+            entries = cursor.fetchall()
+        except Exception:
+            self.horizon = previous
+            raise
+        finally:
+            self.refilling = False
+        for entry in entries:
+            if entry.id not in self.touched and self.late.get(entry.id) != entry.time:
+                self.entries[entry.id] = entry
+                self.heap.append((entry.time, entry.id))
+        heapq.heapify(self.heap)
+        logger.debug("Loaded %s scheduled entries up to %s", len(entries), self.horizon)
+
+    def _shard_filter(self, shards=None):
+        """Gets a WHERE clause and arguments matching entries in the given or owned shards."""
+        if not self.shards:
+            return 'TRUE', []
+        return SHARD_FILTER.format(self.shards), [sorted(self.owned if shards is None else shards)]
+
+    def _query(self, query, input_args):
+        """Runs the query on the lock connection, which holds this process's locks.
+
+        Returns the values of the first column.
+        """
+        if self.connection is None or self.connection.closed:
+            self.connection = psycopg2.connect(data.get_connection_parameters(self.bot))
+            self.connection.autocommit = True
+        cursor = self.connection.cursor()
+        cursor.execute(query, input_args)
+        return [it[0] for it in cursor.fetchall()]
+
+    def _lock_shards(self, owned):
+        """Locks or unlocks shards so that every process owns a fair share of them.
+
+        Runs on a worker thread. Returns a tuple of (nodes, released, acquired).
+        """
+        if not self.member:
+            self._query('SELECT pg_advisory_lock(%s, pg_backend_pid())', [MEMBER_LOCK])
+            self.member = True
+        nodes = self._query(
+            "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND granted "
+            "AND classid = %s AND database = (SELECT oid FROM pg_database "
+            "WHERE datname = current_database())", [MEMBER_LOCK])[0]
+        share = -(-self.shards // max(nodes, 1))
+        released = sorted(owned)[share:]
+        if released:
+            self._query(
+                'SELECT pg_advisory_unlock(%s, shard) FROM unnest(%s::integer[]) shard',
+                [SHARD_LOCK, released])
+        wanted = share - (len(owned) - len(released))
+        acquired = []
+        if wanted > 0:  # Owned shards are skipped first, since locks would stack
+            acquired = self._query(
+                'SELECT shard FROM generate_series(0, %s) shard WHERE CASE WHEN shard = ANY(%s) '
+                'THEN false ELSE pg_try_advisory_lock(%s, shard) END LIMIT %s',
+                [self.shards - 1, sorted(owned), SHARD_LOCK, wanted])
+        return nodes, released, acquired
+
+    async def _balance(self):
+        """Rebalances the shards off the event loop. Returns the shards that were newly locked."""
+        try:
+            self.nodes, released, acquired = await utilities.future(
+                self._lock_shards, set(self.owned))
+        except Exception:
+            if self.connection is not None and self.connection.closed:  # Locks are gone
+                self.owned.clear()
+                self.member = False
+            raise
+        self.owned.difference_update(released)
+        self.owned.update(acquired)
+        if acquired:
+            logger.debug("Took scheduler shards %s (%s processes)", acquired, self.nodes)
+        return set(acquired)
+
+    async def _claim(self, where_arg, input_args, shards=None):
+        """Deletes and returns matching entries that have not been claimed by another process.
+
+        Only entries in the given or owned shards are claimed.
+        """
+        shard_arg, shard_args = self._shard_filter(shards)
+        cursor = await data.db_execute_async(
+            self.bot, CLAIM_QUERY.format(where_arg, shard_arg),
+            input_args=input_args + shard_args, mark='schedule', propagate_error=True,
+            cursor_kwargs={'cursor_factory': NamedTupleCursor})
+        return cursor.fetchall()
+
+    def _dispatch(self, entries, now):
+        for entry in entries:
+            try:
+                function = getattr(self.bot.plugins[entry.plugin], entry.function)
+                late = now - entry.time > 60
+                asyncio.ensure_future(function(
+                    self.bot, entry.time, entry.payload, entry.search,
+                    entry.destination, late, entry.info, entry.id))
+                self.fired += 1
+            except Exception as e:
+                logger.warn("Failed to execute scheduled function: %s", e)
+
+    def _restore(self, due):
+        """Puts due entries back in the heap, unless they were changed in the meantime."""
+        for entry in due:
+            if entry.id not in self.entries:
+                self.entries[entry.id] = entry
+                heapq.heappush(self.heap, (entry.time, entry.id))
+
+    async def _fire(self, due, now):
+        """Claims the due entries in one query, then calls the ones that were claimed.
+
+        Entries that could not be claimed were removed elsewhere, or belong to
+        a shard owned by another process. If the query fails, the entries are
+        put back to be retried. Returns whether or not the query succeeded.
+        """
+        due = [it for it in due if it.id not in self.late]  # Left for catch-up
+        if not due:
+            return True
+        try:
+            entries = await self._claim('id = ANY(%s)', [[it.id for it in due]])
+        except Exception as e:
+            logger.warn("Failed to delete due schedule entries: %s", e)
+            self._restore(due)
+            return False
+        self.batches += 1
+        self._dispatch(entries, now)
+        return True
+
+    async def _poll(self, now):
+        """Rebalances shards, then claims due entries that may have been added elsewhere.
+
+        Overdue entries in newly locked shards are caught up on.
+        """
+        acquired = await self._balance()
+        if acquired:
+            await self._catch_up(now, acquired)
+        entries = await self._claim('time <= %s AND NOT id = ANY(%s)', [int(now), list(self.late)])
+        if entries:
+            self.batches += 1
+            self._dispatch(entries, now)
+
+    def _group_late(self, entries, now):
+        """Groups the entries by destination for catch-up.
+
+        Late entries for functions decorated with utilities.coalesce_late are
+        merged into a single call per destination. Returns a list of call lists,
+        where the calls in each list are made one after another.
+        """
+        groups, coalesced = {}, {}
+        for entry in entries:
+            try:
+                function = getattr(self.bot.plugins[entry.plugin], entry.function)
+            except Exception as e:
+                logger.warn("Failed to find scheduled function: %s", e)
+                self.late.pop(entry.id, None)
+                continue
+            late = now - entry.time > 60
+            if entry.destination is None:  # Not rate limited
+                calls = groups.setdefault(('entry', entry.id), [])
+            else:
+                calls = groups.setdefault(entry.destination, [])
+            if late and getattr(function, 'coalesce_late', False):
+                key = (entry.plugin, entry.function, entry.destination)
+                if key in coalesced:
+                    coalesced[key].append(entry)
+                    continue
+                coalesced[key] = [entry]
+                calls.append((function, coalesced[key], late))
+            else:
+                calls.append((function, entry, late))
+        return list(groups.values())
+
+    async def _call(self, function, entry, late):
+        """Claims the entry, then calls the scheduled function if it was claimed.
+
+        Coalesced entries (a list) are given as lists. If they can't be claimed,
+        they are put in the heap to be retried.
+        """
+        entries = entry if isinstance(entry, list) else [entry]
+        try:
+            claimed = await self._claim(
+                'id = ANY(%s) AND time <= %s',
+                [[it.id for it in entries], max(it.time for it in entries)])
+        except Exception:
+            self._restore(entries)
+            self.wake()
+            raise
+        finally:
+            for it in entries:
+                self.late.pop(it.id, None)
+        if not claimed:  # Removed, updated, or claimed elsewhere
+            return
+        claimed.sort(key=lambda it: (it.time, it.id))
+        entry = claimed if isinstance(entry, list) else claimed[0]
+        if isinstance(entry, list):
+            await function(
+                self.bot, [it.time for it in entry], [it.payload for it in entry],
+                [it.search for it in entry], entry[0].destination, late,
+                [it.info for it in entry], [it.id for it in entry])
+            self.caught_up += len(entry)
+        else:
+            await function(
+                self.bot, entry.time, entry.payload, entry.search,
+                entry.destination, late, entry.info, entry.id)
+            self.caught_up += 1
+
+    async def _dispatch_group(self, semaphore, calls):
+        for index, call in enumerate(calls):
+            if index:
+                await asyncio.sleep(self.catch_up_interval)
+            async with semaphore:
+                try:
+                    await self._call(*call)
+                except Exception as e:
+                    logger.warn("Failed to execute overdue scheduled function: %s", e)
+
+    async def _dispatch_late(self, entries, now):
+        semaphore = asyncio.Semaphore(self.catch_up_concurrency)
+        groups = self._group_late(entries, now)
+        await asyncio.gather(*(self._dispatch_group(semaphore, it) for it in groups))
+        logger.info("Finished catching up on %s overdue scheduled entries", len(entries))
+
+    async def _catch_up(self, now, shards=None):
+        """Finds the overdue entries in the given or owned shards and dispatches them
+        in the background. Entries are claimed as they are called (see _call).
+        """
+        shard_arg, shard_args = self._shard_filter(shards)
+        cursor = await data.db_select_async(
+            self.bot, from_arg='schedule', where_arg='time <= %s AND ' + shard_arg,
+            input_args=[int(now)] + shard_args, safe=False, propagate_error=True)
+        entries = [it for it in cursor.fetchall() if it.id not in self.late]
+        entries.sort(key=lambda it: (it.time, it.id))
+        for entry in entries:
+            self.late[entry.id] = entry.time
+        if entries:
+            logger.info("Catching up on %s overdue scheduled entries", len(entries))
+            self.catch_up_task = asyncio.ensure_future(self._dispatch_late(entries, now))
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        if not self.shards:  # Otherwise done when shards are locked
+            try:
+                await self._catch_up(time.time())
+            except Exception as e:  # Left for the main loop
+                logger.warn("Failed to catch up on overdue scheduled entries: %s", e)
+        while True:
+            self.changed.clear()
+            now = time.time()
+            if self.shards and now >= self.next_poll:
+                self.next_poll = now + self.poll_interval
+                try:
+                    await self._poll(now)
+                except Exception as e:
+                    logger.warn("Failed to poll scheduled entries: %s", e)
+            if self.horizon is None or now + self.lookahead / 2 > self.horizon:
+                try:
+                    await self._refill(now)
+                except Exception as e:
+                    logger.warn("Failed to load scheduled entries: %s", e)
+                    await asyncio.sleep(10)
+                    continue
+            due = self._pop_due(now)
+            if due:
+                if await self._fire(due, now):
+                    self.retry_delay = 0
+                else:
+                    self.retry_delay = min(max(self.retry_delay * 2, 1), 60)
+                    await asyncio.sleep(self.retry_delay)
+                continue
+            entry = self._peek()
+            wake_time = self.horizon - self.lookahead / 2
+            if entry is not None:
+                wake_time = min(wake_time, entry.time)
+            if self.shards:
+                wake_time = min(wake_time, self.next_poll)
+            try:
+                await asyncio.wait_for(self.changed.wait(), max(wake_time - time.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self):
+        return {
+            'pending': len(self.entries),
+            'horizon': self.horizon,
+            'fired': self.fired,
+            'caught_up': self.caught_up,
+            'batches': self.batches,
+            'shards': self.shards,
+            'owned': len(self.owned),
+            'nodes': self.nodes
+        }
@@ -0,0 +1,656 @@
+"""Internal persistence helpers used by the data module.
+
+Anything in here may be run on a worker thread (see utilities.future), so it
+must not touch the bot or the event loop directly.
+"""
+import json
+import os
+import psycopg2
+import psycopg2.extras
+import sqlite3
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from jshbot import logger
+from jshbot.exceptions import ConfiguredBotException
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CBException = ConfiguredBotException('Storage')
+
+
+class DirtyTracker():
+    def __init__(self):
+        """Tracks which parts of the data have unsaved changes.
+
+        Changes are tracked per location key (see data.get_location), and per
+        top-level key in that location (a plugin name, or a channel or user ID).
+        A location can also be marked as changed as a whole. Marking is O(1).
+
+        For compatibility, this can still be used like the list of changed
+        location keys it replaces.
+        """
+        self.locations = {}
+        self.marks = 0
+
+    def mark(self, location_key, key=None):
+        """Marks the given key in the location as changed.
+
+        If no key is given, the whole location is marked as changed.
+        """
+        self.marks += 1
+        if key is None:
+            self.locations[location_key] = None
+        else:
+            keys = self.locations.setdefault(location_key, set())
+            if keys is not None:
+                keys.add(key)
+
+    def append(self, location_key):
+        self.mark(location_key)
+
+    def take(self):
+        """Returns the changes as a dictionary of location keys to sets of keys and clears them.
+
+        A set of None means that the whole location changed.
+        """
+        locations, self.locations = self.locations, {}
+        return locations
+
+    def restore(self, changes):
+        """Merges changes returned by take back in, like when they failed to save."""
+        for location_key, keys in changes.items():
+            if keys is None:
+                self.locations[location_key] = None
+            else:
+                current = self.locations.setdefault(location_key, set())
+                if current is not None:
+                    current.update(keys)
+
+    def get_stats(self):
+        """Returns a tuple of (locations, subtrees, marks).
+
+        Subtrees does not include locations that were changed as a whole.
+        """
+        subtrees = sum(len(it) for it in self.locations.values() if it is not None)
+        return len(self.locations), subtrees, self.marks
+
+    def __contains__(self, location_key):
+        return location_key in self.locations
+
+    def __iter__(self):
+        return iter(list(self.locations))
+
+    def __len__(self):
+        return len(self.locations)
+
+
+class LazyData(MutableMapping):
+    def __init__(self, load, budget=0, check=None, evicted=None, pinned=(), idle=300):
+        """A dictionary of location keys to data that is loaded on first access.
+
+        Keys can be registered without loading them. Loaded entries are kept in
+        least recently used order, and once the total size of loaded entries
+        goes over the budget, the oldest ones are unloaded again. Entries are
+        only unloaded once they have gone unused for the idle time, since
+        callers may still be holding on to their data (like across an await).
+
+        Arguments:
+        load -- Called with a key to load it. Returns a tuple of (data, size).
+
+        Keyword arguments:
+        budget -- Total size that loaded entries can take up. 0 disables unloading.
+        check -- Called with a key before unloading it. Returns whether or not it can be.
+        evicted -- Called with a key after it was unloaded.
+        pinned -- Keys that are never unloaded.
+        idle -- Seconds an entry must go unused before it can be unloaded.
+        """
+        self.load = load
+        self.budget = budget
+        self.check = check
+        self.evicted = evicted
+        self.pinned = set(pinned)
+        self.idle = idle
+        self.known = set()
+        self.loaded = OrderedDict()
+        self.sizes = {}
+        self.accessed = {}  # key: time of the last access
+        self.total = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def register(self, key):
+        """Adds the key without loading it."""
+        self.known.add(key)
+
+    def is_loaded(self, key):
+        return key in self.loaded
+
+    def loaded_keys(self):
+        return list(self.loaded)
+
+    def resize(self, key, size):
+        """Updates the size of a loaded entry (like after it was saved)."""
+        if key in self.loaded:
+            self.total += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+
+    def _touch(self, key):
+        """Marks the key as used, and moves it to the end of the unloading order."""
+        self.loaded.move_to_end(key)
+        self.accessed[key] = time.monotonic()
+
+    def evict(self, keep=None):
+        """Unloads the least recently used entries until the total size is within the budget.
+
+        Only entries that have gone unused for the idle time are unloaded.
+
+        Keyword arguments:
+        keep -- A key that should not be unloaded (like the one being loaded).
+        """
+        if not self.budget:
+            return
+        cutoff = time.monotonic() - self.idle
+        for key in list(self.loaded):
+            if self.total <= self.budget or self.accessed.get(key, 0) > cutoff:
+                break  # Entries after this one were used more recently
+            if key == keep or key in self.pinned or (self.check and not self.check(key)):
+                continue
+            del self.loaded[key]
+            del self.accessed[key]
+            self.total -= self.sizes.pop(key, 0)
+            self.evictions += 1
+            if self.evicted:
+                self.evicted(key)
+
+    def __contains__(self, key):
+        return key in self.known
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            self._touch(key)
+            return self.loaded[key]
+        if key not in self.known:
+            raise KeyError(key)
+        value, size = self.load(key)
+        self.loads += 1
+        self.loaded[key] = value
+        self.sizes[key] = size
+        self.total += size
+        self._touch(key)
+        self.evict(keep=key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.known.add(key)
+        self.loaded[key] = value
+        self._touch(key)
+        self.resize(key, self.sizes.get(key, 0))
+
+    def __delitem__(self, key):
+        self.known.remove(key)
+        self.loaded.pop(key, None)
+        self.accessed.pop(key, None)
+        self.total -= self.sizes.pop(key, 0)
+
+    def __iter__(self):
+        return iter(list(self.known))
+
+    def __len__(self):
+        return len(self.known)
+
+
+class SnapshotWriter():
+    def __init__(self, backend):
+        """Writes data snapshots to the given storage backend.
+
+        Every snapshot is assigned a sequence number when it is taken. Writes
+        are prepared first (serialized, and written to a temporary file for
+        files), then committed atomically, and a snapshot will never replace
+        data that was written by a newer snapshot. This allows writes to happen
+        on any thread without older saves clobbering newer ones.
+
+        The writer remembers which top-level keys of each location are stored,
+        so a snapshot only has to contain the keys that changed (see write).
+        """
+        self.backend = backend
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.written = {}
+        self.taken = {}
+        self.sizes = {}
+        self.stored = {}
+        self.serialized = 0
+        self.reused = 0
+
+    def next_sequence(self):
+        """Gets the sequence number for a new snapshot. Call from the event loop."""
+        self.sequence += 1
+        return self.sequence
+
+    def get_reusable(self, key, sequence):
+        """Gets the stored keys that the snapshot being taken does not have to include.
+
+        Stored keys can only be reused if the last snapshot taken of the key was
+        written. Returns None otherwise. Call from the event loop, for every key
+        in the snapshot.
+        """
+        with self.lock:
+            stored = self.stored.get(key)
+            reusable = stored is not None and stored[0] == self.taken.get(key, 0)
+        self.taken[key] = sequence
+        return stored[1] if reusable else None
+
+    def is_written(self, key):
+        """Checks if the last snapshot taken of the key was written (or discarded)."""
+        with self.lock:
+            return self.taken.get(key, 0) <= self.written.get(key, 0)
+
+    def forget(self, key=None):
+        """Forgets what is stored for the key, or everything if no key is given.
+
+        The next snapshot of a forgotten key includes all of its data.
+        """
+        with self.lock:
+            if key is None:
+                self.stored.clear()
+            else:
+                self.stored.pop(key, None)
+            self.backend.forget(key)
+
+    def load(self, key):
+        """Loads the data for the key. Returns a tuple of (data, size, outdated).
+
+        If outdated is True, the data is not stored in the current format and
+        should be saved again. Raises KeyError if there is no data for the key.
+        """
+        value, size, outdated = self.backend.load(key)
+        if self.backend.partial_after_load and not outdated:
+            with self.lock:
+                if key not in self.stored and self.taken.get(key, 0) == 0:
+                    self.stored[key] = (0, set(value))
+        return value, size, outdated
+
+    def write(self, sequence, snapshot, keep=None):
+        """Serializes and writes the snapshot. Returns a list of keys that failed.
+
+        Arguments:
+        sequence -- The sequence number given by next_sequence when the snapshot was taken.
+        snapshot -- A dictionary of location keys to tuples of (order, values). The order
+            is the list of top-level keys in the location, and the values are a dictionary
+            of the keys that changed to data that is no longer shared. Keys in the order
+            that are not in the values are already stored.
+
+        Keyword arguments:
+        keep -- If given, locations with keys not in this collection are removed.
+        """
+        failed = []
+        for key, (order, values) in snapshot.items():
+            prepared = None
+            try:
+                if len(values) == len(order):
+                    removed = None
+                else:
+                    with self.lock:
+                        removed = self.stored[key][1].difference(order)
+                prepared = self.backend.prepare(key, order, values, removed)
+                with self.lock:
+                    if self.written.get(key, 0) > sequence:  # A newer snapshot got here first
+                        logger.debug("Discarding stale snapshot of %s", key)
+                        self.backend.discard(prepared)
+                        continue
+                    self.sizes[key] = self.backend.commit(key, prepared)
+                    self.written[key] = sequence
+                    self.stored[key] = (sequence, set(order))
+            except Exception as e:
+                logger.error('Failed to save data for %s: (%s) %s', key, type(e).__name__, e)
+                failed.append(key)
+                if prepared is not None:
+                    self.backend.discard(prepared)
+            else:
+                logger.debug("Saved %s", key)
+                self.serialized += len(values)
+                self.reused += len(order) - len(values)
+
+        if keep is not None:  # Check to see if any guild was removed
+            for key in self.backend.keys():
+                if key not in keep:
+                    logger.debug("Removing data for {}".format(key))
+                    with self.lock:
+                        self.written[key] = sequence
+                        self.sizes.pop(key, None)
+                        self.stored.pop(key, None)
+                        self.backend.remove(key)
+
+        return failed
+
+
+class PrettyJSONFormat():
+    """Indented JSON, identical to json.dumps(data, indent=4)."""
+    extension = '.json'
+
+    def fragment(self, key, value):  # Strip the surrounding '{\n    ' and '\n}'
+        return json.dumps({key: value}, indent=4)[6:-2].encode()
+
+    def join(self, fragments):
+        if not fragments:
+            return b'{}'
+        return b'{\n    ' + b',\n    '.join(fragments) + b'\n}'
+
+    def is_current(self, raw):
+        return raw.startswith(b'{\n') or raw == b'{}'
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+class CompactJSONFormat(PrettyJSONFormat):
+    """JSON without any whitespace."""
+
+    def fragment(self, key, value):
+        return json.dumps({key: value}, separators=(',', ':'))[1:-1].encode()
+
+    def join(self, fragments):
+        return b'{' + b','.join(fragments) + b'}'
+
+    def is_current(self, raw):
+        return not raw.startswith(b'{\n')
+
+
+class FastJSONFormat(CompactJSONFormat):
+    """Compact JSON written and read with orjson.
+
+    Anything orjson can't write is written with json, but note that orjson
+    reads integers over 64 bits as floats.
+    """
+
+    def fragment(self, key, value):
+        try:
+            return orjson.dumps({key: value}, option=orjson.OPT_NON_STR_KEYS)[1:-1]
+        except TypeError:  # Like integers over 64 bits
+            return super().fragment(key, value)
+
+    def decode(self, raw):
+        return orjson.loads(raw)
+
+
+class MessagePackFormat():
+    """MessagePack. Unlike JSON, non-string dictionary keys keep their type."""
+    extension = '.msgpack'
+
+    def fragment(self, key, value):
+        return msgpack.packb(key, use_bin_type=True) + msgpack.packb(value, use_bin_type=True)
+
+    def join(self, fragments):
+        return msgpack.Packer().pack_map_header(len(fragments)) + b''.join(fragments)
+
+    def is_current(self, raw):
+        return True
+
+    def decode(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+def decode(raw, extension):
+    """Decodes data read from a file in a format other than the current one."""
+    if extension == '.msgpack':
+        if msgpack is None:
+            raise CBException("The msgpack module is needed to read MessagePack data.")
+        return MessagePackFormat().decode(raw)
+    return json.loads(raw)
+
+
+def get_format(name):
+    """Gets the file format with the given name (see the data_format config key)."""
+    if name == 'pretty':
+        return PrettyJSONFormat()
+    elif name == 'compact':
+        return CompactJSONFormat()
+    elif name == 'fast':
+        if orjson is None:
+            logger.warn("orjson is not installed. Using compact JSON instead.")
+            return CompactJSONFormat()
+        return FastJSONFormat()
+    elif name == 'msgpack':
+        if msgpack is None:
+            raise CBException("The msgpack format requires the msgpack module.")
+        return MessagePackFormat()
+    else:
+        raise CBException("Unknown data format '{}'.".format(name))
+
+
+class FileBackend():
+    """Stores each location as a file in a directory.
+
+    The serialized form of each top-level key of a location is cached so that
+    a file can be rebuilt without serializing the keys that did not change.
+
+    Files in any format are read, and files that are not in the configured
+    format are reported as outdated by load so that they can be rewritten.
+    """
+    partial_after_load = False
+    extensions = ('.json', '.msgpack')
+
+    def __init__(self, directory, data_format=None):
+        self.directory = directory
+        self.format = data_format or PrettyJSONFormat()
+        self.fragments = {}
+
+    def get_path(self, key, extension=None):
+        return '{}{}{}'.format(self.directory, key, extension or self.format.extension)
+
+    def keys(self):
+        keys = set()
+        for entry in os.listdir(self.directory):
+            name, extension = os.path.splitext(entry)
+            if extension in self.extensions and not name.startswith('.'):
+                keys.add(name)
+        return list(keys)
+
+    def load(self, key):
+        """Returns a tuple of (data, size, outdated)."""
+        extensions = sorted(self.extensions, key=lambda it: it != self.format.extension)
+        for extension in extensions:
+            try:
+                with open(self.get_path(key, extension), 'rb') as data_file:
+                    raw = data_file.read()
+            except FileNotFoundError:
+                continue
+            if extension == self.format.extension:
+                value, outdated = self.format.decode(raw), not self.format.is_current(raw)
+            else:
+                value, outdated = decode(raw, extension), True
+            return value, len(raw), outdated
+        raise KeyError(key)
+
+    def forget(self, key=None):
+        if key is None:
+            self.fragments.clear()
+        else:
+            self.fragments.pop(key, None)
+
+    def prepare(self, key, order, values, removed):
+        """Builds the file in a temporary file."""
+        cached = {} if removed is None else self.fragments[key]
+        fragments = {}
+        for subkey in order:
+            if subkey in values:
+                fragments[subkey] = self.format.fragment(subkey, values[subkey])
+            else:
+                fragments[subkey] = cached[subkey]
+        raw = self.format.join([fragments[it] for it in order])
+
+        file_descriptor, temp_path = tempfile.mkstemp(
+            dir=self.directory, prefix='.{}.'.format(key), suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                temp_file.write(raw)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+        except:
+            self.discard((temp_path, None, None))
+            raise
+        return temp_path, fragments, len(raw)
+
+    def commit(self, key, prepared):
+        """Atomically replaces the file. Returns the size of the data."""
+        temp_path, fragments, size = prepared
+        os.replace(temp_path, self.get_path(key))
+        self.fragments[key] = fragments
+        for extension in self.extensions:  # Remove files in other formats
+            if extension != self.format.extension:
+                self._remove_file(self.get_path(key, extension))
+        return size
+
+    def discard(self, prepared):
+        self._remove_file(prepared[0])
+
+    def remove(self, key):
+        self.fragments.pop(key, None)
+        for extension in self.extensions:
+            self._remove_file(self.get_path(key, extension))
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class _DatabaseBackend():
+    """Stores each top-level key of a location as a row in a database table.
+
+    Only the keys that changed are written. Subclasses provide the connection
+    and the SQL.
+    """
+    partial_after_load = True
+    placeholder = '?'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def keys(self):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT DISTINCT location FROM {}'.format(self.table))
+            return [it[0] for it in cursor.fetchall()]
+
+    def load(self, key):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute(self.select_sql, (key,))
+            rows = cursor.fetchall()
+            self.connection.commit()
+        if not rows:
+            raise KeyError(key)
+        value = dict((it[0], json.loads(it[1])) for it in rows)
+        return value, sum(len(it[1]) for it in rows), False
+
+    def forget(self, key=None):
+        pass
+
+    def prepare(self, key, order, values, removed):
+        rows = [(key, subkey, json.dumps(values[subkey])) for subkey in order if subkey in values]
+        return rows, removed
+
+    def commit(self, key, prepared):
+        """Writes the changed rows in one transaction. Returns the size of the written rows."""
+        rows, removed = prepared
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                if removed is None:  # Everything is being replaced
+                    cursor.execute(
+                        'DELETE FROM {} WHERE location = {}'.format(
+                            self.table, self.placeholder), (key,))
+                elif removed:
+                    cursor.execute(
+                        'DELETE FROM {0} WHERE location = {1} AND key IN ({2})'.format(
+                            self.table, self.placeholder,
+                            ', '.join([self.placeholder] * len(removed))),
+                        (key,) + tuple(removed))
+                if rows:
+                    self.upsert(cursor, rows)
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+        return sum(len(it[2]) for it in rows)
+
+    def discard(self, prepared):
+        pass
+
+    def remove(self, key):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                'DELETE FROM {} WHERE location = {}'.format(self.table, self.placeholder), (key,))
+            self.connection.commit()
+
+
+class SQLiteBackend(_DatabaseBackend):
+    """Stores data in an embedded SQLite database file."""
+    table = 'data'
+    select_sql = 'SELECT key, value FROM data WHERE location = ?'
+
+    def __init__(self, path):
+        super().__init__()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS data ('
+            'location TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'PRIMARY KEY (location, key))')
+        self.connection.commit()
+
+    def upsert(self, cursor, rows):
+        cursor.executemany('INSERT OR REPLACE INTO data VALUES (?, ?, ?)', rows)
+
+
+class PostgreSQLBackend(_DatabaseBackend):
+    """Stores data in a JSONB table in the PostgreSQL database.
+
+    This uses its own connection, so writes on worker threads never share a
+    transaction with the bot's connection.
+    """
+    table = 'bot_data'
+    placeholder = '%s'
+    select_sql = 'SELECT key, value::text FROM bot_data WHERE location = %s'
+
+    def __init__(self, connection_parameters):
+        super().__init__()
+        self.connection = psycopg2.connect(connection_parameters)
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS bot_data ('
+            'location text NOT NULL, key text NOT NULL, value jsonb NOT NULL, '
+            'PRIMARY KEY (location, key))')
+        self.connection.commit()
+
+    def upsert(self, cursor, rows):
+        psycopg2.extras.execute_values(
+            cursor,
+            'INSERT INTO bot_data (location, key, value) VALUES %s '
+            'ON CONFLICT (location, key) DO UPDATE SET value = EXCLUDED.value',
+            rows, template='(%s, %s, %s::jsonb)')
+
+
+def migrate(source, destination):
+    """Copies every location from the source backend to the destination backend."""
+    keys = source.keys()
+    for key in keys:
+        value = source.load(key)[0]
+        prepared = destination.prepare(key, list(value), value, None)
+        destination.commit(key, prepared)
+    return len(keys)
@@ -2,9 +2,11 @@ import asyncio
 import datetime
 import functools
 import io
+import json
 import os
 import shutil
 import socket
+import tempfile
 import time
 import zipfile
 
@@ -12,9 +14,9 @@ import aiohttp
 import discord
 
 from urllib.parse import urlparse
-from psycopg2.extras import Json
+from psycopg2.extras import Json, NamedTupleCursor
 
-from jshbot import data, configurations, core, logger
+from jshbot import data, configurations, core, logger, storage
 from jshbot.exceptions import BotException, ConfiguredBotException
 
 
@@ -347,6 +349,7 @@ async def request(
 async def upload_to_discord(bot, fp, filename=None, rewind=True, close=False):
     """Uploads the given file-like object to the upload channel.
 
+    fp can also be an async iterator of bytes (like data.db_copy_stream).
     If the upload channel is specified in the configuration files, files
     will be uploaded there. Otherwise, a new guild will be created, and
     used as the upload channel."""
@@ -370,6 +373,10 @@ async def upload_to_discord(bot, fp, filename=None, rewind=True, close=False):
     if channel is None:  # Shouldn't happen
         raise CBException("Failed to get upload channel.")
 
+    if hasattr(fp, '__aiter__'):  # Async iterator of bytes
+        fp = await get_stream_as_file(fp)
+        rewind, close = False, True
+
     try:
         discord_file = discord.File(fp, filename=filename)
         message = await channel.send(file=discord_file)
@@ -660,13 +667,37 @@ async def get_log_text(bot, channel, **log_arguments):
 
 
 async def send_text_as_file(channel, text, filename, extra=None, extension='txt'):
-    """Sends the given text as a text file."""
-    discord_file = discord.File(
-        get_text_as_file(text), filename='{}.{}'.format(filename, extension))
+    """Sends the given text as a text file.
+
+    The text can also be a binary file-like object, or an async iterator of
+    bytes (like data.db_copy_stream), which is written to a temporary file first.
+    """
+    if hasattr(text, '__aiter__'):
+        text = await get_stream_as_file(text)
+    elif not hasattr(text, 'read'):
+        text = get_text_as_file(text)
+    discord_file = discord.File(text, filename='{}.{}'.format(filename, extension))
     reference = await channel.send(content=extra, file=discord_file)
     return reference
 
 
+async def get_stream_as_file(stream):
+    """Writes the async iterator of bytes into a temporary file.
+
+    Returns the rewound file, which is deleted once it is closed.
+    """
+    try:
+        temporary_file = tempfile.TemporaryFile()
+        async for chunk in stream:
+            temporary_file.write(chunk)
+        temporary_file.seek(0)
+        return temporary_file
+    except BotException:
+        raise
+    except Exception as e:
+        raise CBException("Failed to write the stream to a file.", e=e)
+
+
 def get_text_as_file(text):
     """Converts the text into a bytes object using BytesIO."""
     try:
@@ -756,7 +787,10 @@ def db_backup(bot, safe=True):
     try:
         logger.debug("Attemping to connect to the database container...")
         if bot.dump_exclusions:
-            exclusions = '-T "' + '" -T "'.join(bot.dump_exclusions) + '"'
+            excluded = list(bot.dump_exclusions)
+            excluded += [  # Partitions of partitioned tables (see data.db_add_partitioning)
+                '{}__*'.format(it) for it in bot.dump_exclusions if it in bot.db_partitions]
+            exclusions = '-T "' + '" -T "'.join(excluded) + '"'
         else:
             exclusions = ''
         command = (
@@ -797,12 +831,23 @@ def make_backup(bot):
 
 
 def restore_backup(bot, backup_file):
-    """Restores a backup file given the backup filename."""
+    """Restores a backup file given the backup filename.
+
+    If the data is stored in a database (see the data_backend option), the
+    backup is unpacked to a temporary directory and copied into it instead.
+    """
     logger.info("Restoring from a backup file...")
     try:
-        core.bot_data = {'global_users': {}, 'global_plugins': {}}
-        core.volatile_data = {'global_users': {}, 'global_plugins': {}}
-        shutil.unpack_archive(backup_file, '{}/data'.format(bot.path))
+        data.reset_data(bot, volatile=True)
+        if bot.journal:  # Changes made since the backup must not be replayed over it
+            bot.journal.discard()
+        if isinstance(bot.data_writer.backend, storage.FileBackend):
+            shutil.unpack_archive(backup_file, '{}/data'.format(bot.path))
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                shutil.unpack_archive(backup_file, directory)
+                total = data.import_backup(bot, directory + '/')
+            logger.info("Copied %s locations from the backup to the data backend.", total)
         data.check_all(bot)
         data.load_data(bot)
     except Exception as e:
@@ -906,7 +951,13 @@ def remove_schedule_entries(
         if destination is not None:
             where_arg += ' AND destination = %s'
             input_args.append(destination)
-    return data.db_delete(bot, 'schedule', where_arg=where_arg, input_args=input_args)
+    cursor = data.db_execute(
+        bot, 'DELETE FROM schedule WHERE {} RETURNING id'.format(where_arg),
+        input_args=input_args, safe=True, mark='schedule')
+    if cursor is None:
+        return
+    bot.scheduler.remove(it[0] for it in cursor.fetchall())
+    return cursor.rowcount
 
 
 def update_schedule_entries(
@@ -956,8 +1007,24 @@ def update_schedule_entries(
         set_input_args.append(info)
     set_arg = ', '.join(set_args)
     input_args = set_input_args + input_args
-    data.db_update(bot, 'schedule', set_arg=set_arg, where_arg=where_arg, input_args=input_args)
-    asyncio.ensure_future(_start_scheduler(bot))
+    cursor = data.db_update(
+        bot, 'schedule', set_arg=set_arg, where_arg=where_arg, input_args=input_args,
+        use_tuple_cursor=True)
+    for entry in cursor.fetchall():
+        bot.scheduler.add(entry)
+    return cursor.rowcount
+
+
+def coalesce_late(function):
+    """Decorator for scheduled functions that can handle late entries together.
+
+    When the bot catches up after downtime, late entries for the decorated
+        function are merged into one call per destination. In that call,
+        scheduled_time, payload, search, info, and id are lists with a value
+        for each entry (oldest first).
+    """
+    function.coalesce_late = True
+    return function
 
 
 def schedule(
@@ -995,8 +1062,69 @@ def schedule(
         destination,
         info
     ]
-    data.db_insert(bot, 'schedule', input_args=input_args, safe=False)
-    asyncio.ensure_future(_start_scheduler(bot))
+    cursor = data.db_insert(bot, 'schedule', input_args=input_args, safe=False)
+    bot.scheduler.add(cursor.fetchone())
+
+
+def schedule_many(bot, plugin_name, entries):
+    """Adds all of the given entries to the schedule table with a single query.
+
+    Each entry is a sequence of the arguments given to schedule after the
+        plugin name: (scheduled_time, function, payload, search, destination, info).
+        Trailing arguments can be omitted, and default to None.
+    See schedule for how the functions are called.
+
+    Returns the number of entries added.
+    """
+    columns = [[], [], [], [], [], []]
+    for entry in entries:
+        if not 2 <= len(entry) <= 6:
+            raise CBException("Schedule entries must have between 2 and 6 values.")
+        scheduled_time, function, *rest = entry
+        rest += [None] * (4 - len(rest))
+        values = [int(scheduled_time), function.__name__, json.dumps(rest[0])] + rest[1:]
+        for column, value in zip(columns, values):
+            column.append(value)
+    if not columns[0]:
+        return 0
+    cursor = data.db_execute(
+        bot, (
+            'INSERT INTO schedule (time, plugin, function, payload, search, destination, info) '
+            'SELECT time, %s, function, payload::json, search, destination, info FROM unnest('
+            '%s::bigint[], %s::text[], %s::text[], %s::text[], %s::text[], %s::text[]) '
+            'AS entries (time, function, payload, search, destination, info) RETURNING *'),
+        input_args=[plugin_name] + columns, mark='schedule',
+        cursor_kwargs={'cursor_factory': NamedTupleCursor})
+    bot.scheduler.add_many(cursor.fetchall())
+    return cursor.rowcount
+
+
+def remove_schedule_entries_many(
+        bot, plugin_name, searches=None, destinations=None, entry_ids=None):
+    """Removes the entries that match any of the given values with a single query.
+
+    If more than one list is given, entries must match a value in each of them.
+    Returns the number of entries removed.
+
+    Keyword arguments:
+    searches -- List of search values.
+    destinations -- List of destinations.
+    entry_ids -- List of entry IDs.
+    """
+    where_arg = 'plugin = %s'
+    input_args = [plugin_name]
+    for column, values in (('search', searches), ('destination', destinations)):
+        if values is not None:
+            where_arg += ' AND {} = ANY(%s::text[])'.format(column)
+            input_args.append(list(values))
+    if entry_ids is not None:
+        where_arg += ' AND id = ANY(%s::integer[])'
+        input_args.append(list(entry_ids))
+    cursor = data.db_execute(
+        bot, 'DELETE FROM schedule WHERE {} RETURNING id'.format(where_arg),
+        input_args=input_args, mark='schedule')
+    bot.scheduler.remove(it[0] for it in cursor.fetchall())
+    return cursor.rowcount
 
 
 def get_messageable(bot, destination):
@@ -1013,48 +1141,7 @@ def get_messageable(bot, destination):
         raise CBException("Invalid destination format.", e=e)
 
 
-async def _schedule_timer(bot, entry, delay):
-    task_comparison = bot.schedule_timer
-    await asyncio.sleep(0.5)
-    logger.debug("Scheduler sleeping for %s seconds...", delay)
-    await asyncio.sleep(delay)
-    if task_comparison is not bot.schedule_timer:
-        logger.debug("_schedule_timer was not cancelled! Cancelling this scheduler...")
-        return
-    if int(time.time() + 1) < entry.time:
-        logger.warn("_schedule_timer was about to delete the entry early! Restarting loop...")
-        asyncio.ensure_future(_start_scheduler(bot))
-        return
-    try:
-        deleted = data.db_delete(
-            bot, 'schedule', where_arg='id=%s', input_args=[entry.id], safe=False)
-    except Exception as e:
-        logger.warn("_schedule_timer failed to delete a schedule entry. %s", e)
-    if deleted:
-        try:
-            logger.debug("_schedule_timer done sleeping for %s seconds!", delay)
-            function = getattr(bot.plugins[entry.plugin], entry.function)
-            late = delay < -60
-            asyncio.ensure_future(function(
-                bot, entry.time, entry.payload, entry.search,
-                entry.destination, late, entry.info, entry.id))
-        except Exception as e:
-            logger.warn("Failed to execute scheduled function: %s", e)
-    asyncio.ensure_future(_start_scheduler(bot))
-
-
 async def _start_scheduler(bot):
-    """Starts the interal scheduler."""
-    await bot.wait_until_ready()
-    if bot.schedule_timer:  # Scheduler already running
-        bot.schedule_timer.cancel()
-        bot.schedule_timer = None
-    cursor = data.db_select(
-        bot, from_arg='schedule', additional='ORDER BY time ASC', limit=1, safe=False)
-    result = cursor.fetchone()
-    if result:
-        delta = result.time - time.time()
-        logger.debug("Starting scheduled event %s", result.id)
-        bot.schedule_timer = asyncio.ensure_future(_schedule_timer(bot, result, delta))
-    else:
-        logger.debug("No pending scheduled event available.")
+    """Starts the internal scheduler (see scheduler.py), or wakes it up if it is running."""
+    bot.scheduler.start()
+    bot.scheduler.wake()
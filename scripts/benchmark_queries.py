@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import time
+
+from types import SimpleNamespace
+
+import psycopg2
+
+# Measures the per-call overhead of db_select, db_insert and db_update with and
+#   without the query text cache and prepared statements.
+# Usage: python3 benchmark_queries.py "dbname=... user=..." [--calls 2000]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jshbot import data, database  # noqa: E402
+
+BUILDERS = ('_select_query', '_insert_query', '_update_query', '_delete_query')
+
+
+def run(bot, calls):
+    """Runs a mix of queries and returns the time per call in microseconds."""
+    start = time.perf_counter()
+    for it in range(calls):
+        data.db_insert(bot, 'benchmark', specifiers=['id', 'value'], input_args=[it, 'text'])
+        data.db_select(
+            bot, select_arg=['id', 'value'], from_arg='benchmark',
+            where_arg='id=%s', input_args=[it])
+        data.db_update(
+            bot, 'benchmark', set_arg='value=%s', where_arg='id=%s', input_args=['new', it])
+    return (time.perf_counter() - start) / (calls * 3) * 1000000
+
+
+def check_partitioned(bot):
+    """Moves a suffixed table with a primary key into a partitioned table."""
+    specification = 'id bigint PRIMARY KEY, value text'
+    data.db_create_table(bot, 'benchmark', table_suffix='1', specification=specification)
+    data.db_insert(bot, 'benchmark', table_suffix='1', input_args=[1, 'moved'])
+    data.db_add_partitioning(bot, 'benchmark', partitions=4)
+    data.db_create_table(bot, 'benchmark', table_suffix='2', specification=specification)
+    data.db_insert(bot, 'benchmark', table_suffix='2', input_args=[1, 'new'])
+    rows = [
+        data.db_select(bot, from_arg='benchmark', table_suffix=it, safe=False).fetchall()
+        for it in ('1', '2')]
+    if [len(it) for it in rows] != [1, 1] or 'benchmark_1' in bot.db_catalog.get_tables():
+        raise AssertionError('Unexpected partitioned rows: {}'.format(rows))
+    print('Suffixed tables with a primary key can be partitioned')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks database query overhead.')
+    parser.add_argument('parameters', help='Connection parameters')
+    parser.add_argument('--calls', type=int, default=2000)
+    arguments = parser.parse_args()
+
+    connection = psycopg2.connect(
+        arguments.parameters, connection_factory=database.PreparingConnection)
+    bot = SimpleNamespace(
+        db_connection=connection, db_templates={}, tables_changed=[], db_cache=None,
+        db_log=None, db_catalog=database.SchemaCatalog(), db_partitions={})
+    cached = {name: getattr(data, name) for name in BUILDERS}
+    print('{:<28} {:>14}'.format('Mode', 'Per call (us)'))
+
+    modes = (
+        ('uncached', False, 0),
+        ('query text cache', True, 0),
+        ('cache + prepared statements', True, 5))
+    try:
+        for name, use_cache, threshold in modes:
+            for builder, function in cached.items():
+                setattr(data, builder, function if use_cache else function.__wrapped__)
+            bot.db_statements = database.StatementCache(threshold)
+            data.db_drop_table(bot, 'benchmark', safe=True)
+            data.db_create_table(bot, 'benchmark', specification='id bigint, value text')
+            print('{:<28} {:>14.1f}'.format(name, run(bot, arguments.calls)))
+        data.db_drop_table(bot, 'benchmark', safe=True)
+        check_partitioned(bot)
+    finally:
+        for builder, function in cached.items():
+            setattr(data, builder, function)
+        data.db_drop_table(bot, 'benchmark', safe=True)
+        data.db_drop_table(bot, 'benchmark', table_suffix='1', safe=True)
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
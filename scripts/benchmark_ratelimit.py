@@ -0,0 +1,57 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+# Measures the time per check of the command rate limiter, and compares it
+#   against the old counter dictionary that was cleared periodically.
+# Usage: python3 benchmark_ratelimit.py [--checks 1000000] [--users 10000]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jshbot import ratelimit  # noqa: E402
+
+LIMIT, TIMEOUT = 20, 60
+
+
+def run_counter(users, duration):
+    """Runs the checks against a counter dictionary. Returns the largest size reached."""
+    counters, largest, cleared = {}, 0, 0
+    for user, now in zip(users, duration):
+        if now - cleared >= TIMEOUT:
+            counters.clear()
+            cleared = now
+        if counters.get(user, 0) < LIMIT:
+            counters[user] = counters.get(user, 0) + 1
+        largest = max(largest, len(counters))
+    return largest
+
+
+def run_limiter(users, duration):
+    """Runs the checks against the rate limiter. Returns the largest number of buckets."""
+    limiter, largest = ratelimit.RateLimiter(LIMIT, TIMEOUT), 0
+    for user, now in zip(users, duration):
+        limiter.hit(user, now=now)
+        largest = max(largest, len(limiter.buckets))
+    return largest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the command rate limiter.')
+    parser.add_argument('--checks', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--rate', type=float, default=1000, help='Checks per second')
+    arguments = parser.parse_args()
+
+    users = [random.randrange(arguments.users) for it in range(arguments.checks)]
+    duration = [it / arguments.rate for it in range(arguments.checks)]
+    print('{:<12} {:>14} {:>14}'.format('Mode', 'Per check (ns)', 'Largest size'))
+    for name, function in (('counter', run_counter), ('limiter', run_limiter)):
+        start = time.perf_counter()
+        largest = function(users, duration)
+        elapsed = (time.perf_counter() - start) / arguments.checks * 1000000000
+        print('{:<12} {:>14.0f} {:>14}'.format(name, elapsed, largest))
+
+
+if __name__ == '__main__':
+    main()
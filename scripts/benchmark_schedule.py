@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import time
+
+from types import SimpleNamespace
+
+import psycopg2
+
+# Compares scheduling and removing entries one call at a time against
+#   schedule_many and remove_schedule_entries_many.
+# Usage: python3 benchmark_schedule.py "dbname=... user=..." [--entries 2000]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jshbot import data, database, scheduler, utilities  # noqa: E402
+
+TEMPLATE = (
+    'time bigint NOT NULL, plugin text NOT NULL, function text NOT NULL, payload json, '
+    'search text, destination text, info text, id serial')
+
+
+async def reminder(bot, scheduled_time, payload, search, destination, late, info, id):
+    pass
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def check_prepared(bot, entries):
+    """Schedules entries in bulk past the prepare threshold, once the query is prepared."""
+    calls = bot.db_statements.threshold + 2
+    added = sum(utilities.schedule_many(bot, 'benchmark', entries) for it in range(calls))
+    removed = utilities.remove_schedule_entries_many(bot, 'benchmark', [it[3] for it in entries])
+    if added != removed or added != len(entries) * calls:
+        raise AssertionError('Added {} and removed {} entries, expected {}'.format(
+            added, removed, len(entries) * calls))
+    print('Bulk scheduling still works after being prepared ({} calls)'.format(calls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks bulk scheduling.')
+    parser.add_argument('parameters', help='Connection parameters')
+    parser.add_argument('--entries', type=int, default=2000)
+    arguments = parser.parse_args()
+
+    connection = psycopg2.connect(
+        arguments.parameters, connection_factory=database.PreparingConnection)
+    bot = SimpleNamespace(
+        db_connection=connection, db_templates={}, tables_changed=[], db_cache=None,
+        db_log=None, db_catalog=database.SchemaCatalog(), db_partitions={},
+        db_statements=database.StatementCache(5))
+    bot.scheduler = scheduler.Scheduler(bot)
+    bot.scheduler.horizon = time.time() + 1000000  # Keep every entry in memory
+    now = int(time.time()) + 3600
+    entries = [
+        (now + it, reminder, {'text': 'Reminder'}, str(it), 'c{}'.format(it), 'Reminder')
+        for it in range(arguments.entries)]
+    searches = [it[3] for it in entries]
+
+    def single_add():
+        for entry in entries:
+            utilities.schedule(bot, 'benchmark', *entry)
+
+    def single_remove():
+        for search in searches:
+            utilities.remove_schedule_entries(bot, 'benchmark', search=search)
+
+    print('{:<12} {:>14} {:>14}'.format('Operation', 'Per call (s)', 'Bulk (s)'))
+    try:
+        data.db_drop_table(bot, 'schedule', safe=True)
+        data.db_create_table(bot, 'schedule', specification=TEMPLATE)
+        single = [timed(single_add), timed(single_remove)]
+        bulk = [
+            timed(utilities.schedule_many, bot, 'benchmark', entries),
+            timed(utilities.remove_schedule_entries_many, bot, 'benchmark', searches)]
+        results = zip(('schedule', 'remove'), single, bulk)
+        for name, single, bulk in results:
+            print('{:<12} {:>14.3f} {:>14.3f}'.format(name, single, bulk))
+        check_prepared(bot, entries[:10])
+    finally:
+        data.db_drop_table(bot, 'schedule', safe=True)
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+# Measures how fast data can be saved and loaded with each data format and
+#   storage backend, using randomly generated guild data.
+# Usage: python3 benchmark_storage.py [--guilds 200] [--postgres "dbname=..."]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jshbot import storage, logger  # noqa: E402
+
+
+def random_text(length):
+    return ''.join(random.choice(string.ascii_letters) for it in range(length))
+
+
+def make_guild(plugins, users):
+    """Makes data that looks like a guild with some plugin, channel and user data."""
+    guild = {}
+    for plugin in range(plugins):
+        guild['plugin_{}'.format(plugin)] = {
+            'enabled': True,
+            'counter': random.randint(0, 1000000),
+            'tags': {random_text(8): random_text(60) for it in range(20)},
+            'blocked': [random.randint(10**17, 10**18) for it in range(30)]}
+    for user in range(users):
+        guild[str(random.randint(10**17, 10**18))] = {
+            'plugin_0': {'points': random.randint(0, 1000), 'name': random_text(16)}}
+    return guild
+
+
+def write(writer, sequence, snapshot):
+    failed = writer.write(sequence, snapshot)
+    assert not failed, failed
+
+
+def benchmark(name, backend, guilds):
+    writer = storage.SnapshotWriter(backend)
+    full = {key: (list(value), value) for key, value in guilds.items()}
+
+    start = time.perf_counter()
+    write(writer, 1, full)
+    save_time = time.perf_counter() - start
+    size = sum(writer.sizes.values())
+
+    start = time.perf_counter()
+    for key in guilds:
+        backend.load(key)
+    load_time = time.perf_counter() - start
+
+    partial = {}
+    for key, value in guilds.items():  # Change one plugin in every guild
+        value['plugin_0']['counter'] += 1
+        writer.get_reusable(key, 2)
+        partial[key] = (list(value), {'plugin_0': value['plugin_0']})
+    start = time.perf_counter()
+    write(writer, 2, partial)
+    partial_time = time.perf_counter() - start
+
+    megabytes = size / 1024 / 1024
+    print('{:<18} {:>9.2f} {:>11.1f} {:>11.1f} {:>14.1f}'.format(
+        name, megabytes, megabytes / save_time, megabytes / load_time,
+        len(guilds) / partial_time))
+
+
+def check_eviction():
+    """Holds guild data across an await while other guilds push it over the memory budget."""
+    data = storage.LazyData(lambda key: ({}, 10), budget=15, idle=0.2)
+    for key in ('held', 'other_1', 'other_2', 'later'):
+        data.register(key)
+
+    async def plugin():
+        held = data['held']
+        await asyncio.sleep(0.05)
+        held['changed'] = True
+        return data['held'] is held
+
+    async def others():
+        for key in ('other_1', 'other_2'):
+            data[key]
+            await asyncio.sleep(0.01)
+
+    async def run():
+        kept = (await asyncio.gather(plugin(), others()))[0]
+        await asyncio.sleep(0.2)
+        data['later']
+        return kept, data.is_loaded('held')
+
+    kept, loaded = asyncio.run(run())
+    if not kept or loaded:
+        raise AssertionError('Held data was unloaded, or idle data was kept')
+    print('Data held across an await is only unloaded once idle')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks data formats and backends.')
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--plugins', type=int, default=10)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--postgres', default='', help='Connection parameters to also test')
+    arguments = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    random.seed(0)
+    guilds = {
+        str(10**17 + it): make_guild(arguments.plugins, arguments.users)
+        for it in range(arguments.guilds)}
+    print('{:<18} {:>9} {:>11} {:>11} {:>14}'.format(
+        'Storage', 'Size (MB)', 'Save (MB/s)', 'Load (MB/s)', 'Partial (g/s)'))
+
+    for format_name in ('pretty', 'compact', 'fast', 'msgpack'):
+        directory = tempfile.mkdtemp() + '/'
+        try:
+            backend = storage.FileBackend(directory, storage.get_format(format_name))
+        except Exception as e:
+            print('{:<18} skipped ({})'.format('files/' + format_name, e))
+            continue
+        try:
+            benchmark('files/' + format_name, backend, guilds)
+        finally:
+            shutil.rmtree(directory)
+
+    directory = tempfile.mkdtemp()
+    try:
+        benchmark('sqlite', storage.SQLiteBackend(directory + '/data.sqlite3'), guilds)
+    finally:
+        shutil.rmtree(directory)
+
+    if arguments.postgres:
+        backend = storage.PostgreSQLBackend(arguments.postgres)
+        try:
+            benchmark('postgresql', backend, guilds)
+        finally:
+            for key in guilds:
+                backend.remove(key)
+
+    check_eviction()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,5 +11,8 @@ setup(
         'discord.py[voice]',
         'pyyaml',
         'psycopg2-binary==2.8.6'
-    ]
+    ],
+    extras_require={
+        'storage': ['orjson', 'msgpack']
+    }
 )